@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from http import HTTPStatus
+from urllib.parse import unquote
+
+'''
+asyncio forwarding instance (FORWARDING_MODE=async).
+
+Serves /kvs/<key> on an event loop and forwards every request to the main
+instance over a small pool of keep-alive connections, so no thread waits
+on the main instance. Concurrent GETs of the same key share one upstream
+request: under a read storm on a popular key the main instance sees one
+GET per key at a time instead of one per client. A PUT or DELETE of the key
+starts a new round, so a GET that comes after a write never gets the
+answer of a GET that went out before it.
+
+GET answers are also kept in a bounded LRU cache. The main instance stamps
+every answer with its write counter and tells the forwarders, over a
+long-polled GET /invalidations, which keys each write touched; a forwarder
+drops those keys and caches an answer only if it can't have missed a newer
+write to the key. While it can't reach the main instance it caches nothing.
+'''
+
+UPSTREAM_CONNECTIONS = int(os.environ.get('UPSTREAM_CONNECTIONS', 16))
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', 5))
+# GET answers kept on the forwarder, 0 for none
+CACHE_KEYS = int(os.environ.get('CACHE_KEYS', 10000))
+# seconds a request for invalidations waits on the main instance
+INVALIDATION_WAIT = 20
+# seconds before listening to the main instance again after losing it
+LISTEN_RETRY = 1
+
+
+class Upstream:
+    ''' Keep-alive HTTP/1.1 connections to the main instance '''
+    def __init__(self, address, size=UPSTREAM_CONNECTIONS):
+        self.host, _, port = address.partition(':')
+        self.port = int(port or 80)
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def request(self, method, path, body=None, timeout=UPSTREAM_TIMEOUT):
+        ''' Return: (status, {lower-case header: value}, body bytes) '''
+        async with self.slots:
+            reused = bool(self.idle)
+            try:
+                return await asyncio.wait_for(self._send(method, path, body), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+            # the main instance closed an idle connection on us; once more on a fresh one
+            return await asyncio.wait_for(self._send(method, path, body, fresh=True), timeout)
+
+    async def _send(self, method, path, body, fresh=False):
+        if self.idle and not fresh:
+            reader, writer = self.idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+            if body is not None:
+                head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            writer.write((head + "\r\n").encode('latin-1') + (body or b''))
+            await writer.drain()
+            status, headers = await _read_head(reader)
+            if status is None:
+                raise ConnectionError("connection closed")
+            status = int(status.split()[1])
+            chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+            if chunked:
+                content = await _read_chunked(reader)
+            elif 'content-length' in headers:
+                content = await reader.readexactly(int(headers['content-length']))
+            else:
+                # neither: the body ends with the connection
+                content = await reader.read()
+        except BaseException:
+            writer.close()
+            raise
+        if headers.get('connection', '').lower() == 'close' or not (chunked or 'content-length' in headers):
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+        return status, headers, content
+
+
+class ForwardingProxy:
+    def __init__(self, forwarding_address, cache_keys=CACHE_KEYS):
+        self.upstream = Upstream(forwarding_address)
+        self.inflight = {} # key -> future of the GET under way
+        # GET answers by key, least recently used first: key -> (status, body)
+        self.cache = OrderedDict()
+        self.cache_keys = cache_keys
+        # the main instance's write counter, up to which its invalidations
+        # have been applied here (None while not listening to it)
+        self.epoch = None
+        self.seen = 0
+        self.channel = Upstream(forwarding_address, size=1)
+        self.listener = None # the task running listen()
+
+    async def forward(self, method, key, body):
+        path = f"/kvs/{key}"
+        if method != 'GET':
+            # later GETs must not join one that started before this write
+            self.invalidate(key)
+            status, headers, content = await self.upstream.request(method, path, body)
+            self.invalidate(key)
+            epoch, version = _version(headers)
+            if epoch == self.epoch:
+                # GETs that went out before this write mustn't be cached
+                self.seen = max(self.seen, version)
+            return status, content
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        shared = self.inflight.get(key)
+        if shared is not None:
+            return await asyncio.shield(shared)
+        shared = asyncio.ensure_future(self._get(key, path))
+        self.inflight[key] = shared
+        try:
+            return await asyncio.shield(shared)
+        finally:
+            if self.inflight.get(key) is shared:
+                del self.inflight[key]
+
+    async def _get(self, key, path):
+        status, headers, content = await self.upstream.request('GET', path)
+        epoch, version = _version(headers)
+        # only if no write to key newer than this answer can have been missed
+        if status in (200, 404) and self.cache_keys and self.epoch is not None \
+                and epoch == self.epoch and version >= self.seen:
+            self.cache[key] = (status, content)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.cache_keys:
+                self.cache.popitem(last=False)
+        return status, content
+
+    def invalidate(self, key):
+        self.cache.pop(key, None)
+        self.inflight.pop(key, None)
+
+    async def listen(self):
+        ''' Follow the main instance's writes and drop the keys they touch.
+            Every write goes through the main instance, so a write through
+            any forwarder reaches every forwarder's cache this way. '''
+        while True:
+            query = f"epoch={self.epoch}&since={self.seen}&wait={INVALIDATION_WAIT}" if self.epoch else ""
+            try:
+                _, _, content = await self.channel.request('GET', f"/invalidations?{query}", timeout=INVALIDATION_WAIT + UPSTREAM_TIMEOUT)
+                changes = json.loads(content)
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                # can't tell what changed meanwhile: nothing cached is trusted
+                self.cache.clear()
+                self.epoch = None
+                await asyncio.sleep(LISTEN_RETRY)
+                continue
+            if changes.get("reset") or changes["epoch"] != self.epoch:
+                self.cache.clear()
+                self.epoch, self.seen = changes["epoch"], changes["version"]
+                continue
+            for key in changes["keys"]:
+                self.invalidate(key)
+            self.seen = max(self.seen, changes["version"])
+
+    def start_listening(self):
+        self.listener = asyncio.ensure_future(self.listen())
+        self.listener.add_done_callback(self._listener_done)
+
+    def _listener_done(self, task):
+        # nobody drops written keys anymore: stop caching until a new
+        # listener has caught up, and start one unless we were stopped
+        self.cache.clear()
+        self.epoch = None
+        if not task.cancelled():
+            task.exception() # retrieved, or asyncio reports it at exit
+            asyncio.get_running_loop().call_later(LISTEN_RETRY, self.start_listening)
+
+    async def handle(self, method, target, body):
+        path = target.split('?', 1)[0]
+        if not path.startswith('/kvs/') or len(path) == len('/kvs/') or method not in ('GET', 'PUT', 'DELETE'):
+            return 404, _dumps({"error": "Not found"})
+        key = unquote(path[len('/kvs/'):])
+        if method == 'PUT':
+            try:
+                value = json.loads(body)['value']
+            except (ValueError, KeyError, TypeError):
+                return 400, _dumps({"error": "PUT request does not specify a value"})
+            body = _dumps({"value": value})
+        try:
+            return await self.forward(method, key, body if method == 'PUT' else None)
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            # ValueError: an answer we can't parse
+            return 503, _dumps({"error": "Cannot forward request"})
+
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                line, headers = await _read_head(reader)
+                if line is None:
+                    break
+                method, target, version = line.split(' ', 2)
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, content = await self.handle(method, target, body)
+                keep_alive = headers.get('connection', '').lower() != 'close' if version == 'HTTP/1.1' \
+                    else headers.get('connection', '').lower() == 'keep-alive'
+                writer.write((f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                              f"Content-Type: application/json\r\n"
+                              f"Content-Length: {len(content)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def run(self, host, port):
+        async def serve():
+            server = await asyncio.start_server(self.connection, host, port, backlog=2048)
+            if self.cache_keys:
+                self.start_listening()
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve())
+
+
+async def _read_head(reader):
+    ''' Return: (first line, {lower-case header: value}), (None, None) at EOF '''
+    line = await reader.readline()
+    if not line:
+        return None, None
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return line.decode('latin-1').strip(), headers
+
+
+async def _read_chunked(reader):
+    ''' Return: a body sent with Transfer-Encoding: chunked '''
+    chunks = []
+    while True:
+        line = await reader.readline()
+        if not line.endswith(b'\n'):
+            raise asyncio.IncompleteReadError(line, None)
+        size = int(line.split(b';', 1)[0], 16)
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2) # CRLF after the chunk
+    # trailers, up to an empty line
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n'):
+            return b''.join(chunks)
+        if not line:
+            raise asyncio.IncompleteReadError(b'', None)
+
+
+def _version(headers):
+    ''' Return: (epoch, write counter) the main instance stamped an answer with '''
+    epoch, _, version = headers.get('x-kvs-version', '').partition(':')
+    return (epoch, int(version)) if version else (None, 0)
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value).encode('utf-8')
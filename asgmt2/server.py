@@ -1,6 +1,16 @@
 from flask import Flask, request, jsonify
+from werkzeug.serving import WSGIRequestHandler
+from collections import deque
 import os
 import requests
+import threading
+import uuid
+
+# 'async' serves a forwarding instance on an event loop (aproxy.py) instead of Flask
+FORWARDING_MODE = os.environ.get('FORWARDING_MODE', 'flask')
+
+# writes the main instance remembers for forwarders catching up on invalidations
+CHANGE_LOG = int(os.environ.get('CHANGE_LOG', 10000))
 
 app = Flask(__name__)
 
@@ -9,6 +19,30 @@ class Kv_store:
         self.kv_store = {}
         self.forwarding_address = os.environ.get('FORWARDING_ADDRESS')
         self.main_instance = not self.forwarding_address
+        # every write bumps version and logs its key; forwarders follow the
+        # log to invalidate their caches (see aproxy.py). epoch tells them
+        # when the counter started over.
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.changes = deque(maxlen=CHANGE_LOG)
+        self.changed = threading.Condition()
+
+    def stamp(self):
+        return {"X-Kvs-Version": f"{self.epoch}:{self.version}"}
+
+    def record_change(self, key):
+        self.version += 1
+        self.changes.append(key)
+        self.changed.notify_all()
+
+    def changes_since(self, epoch, since, wait):
+        with self.changed:
+            if epoch == self.epoch and since == self.version:
+                self.changed.wait_for(lambda: self.version != since, timeout=wait)
+            if epoch != self.epoch or since is None or not self.version - len(self.changes) <= since <= self.version:
+                return {"epoch": self.epoch, "version": self.version, "reset": True}
+            changed = list(self.changes)[len(self.changes) - (self.version - since):]
+            return {"epoch": self.epoch, "version": self.version, "keys": list(dict.fromkeys(changed))}
 
     def get_forwarding_request(self, req):
         return f'http://{self.forwarding_address}/kvs/{req}'
@@ -26,12 +60,14 @@ class Kv_store:
         if len(key) > 50:
             return jsonify({"error": "Key is too long"}), 400
         
-        if key in self.kv_store:
+        with self.changed:
+            self.record_change(key)
+            if key in self.kv_store:
+                self.kv_store[key] = value
+                return jsonify({"result": "replaced"}), 200, self.stamp()
+
             self.kv_store[key] = value
-            return jsonify({"result": "replaced"}), 200
-        
-        self.kv_store[key] = value
-        return jsonify({"result": "created"}), 201
+            return jsonify({"result": "created"}), 201, self.stamp()
     
     def get(self, key):
         if not self.main_instance:
@@ -43,10 +79,11 @@ class Kv_store:
             except:
                 return jsonify({"error": "Cannot forward request"}), 503
         
-        if key in self.kv_store:
-            return jsonify({"result": "found", "value": self.kv_store[key]}), 200
-        
-        return jsonify({"error": "Key does not exist"}), 404
+        with self.changed:
+            if key in self.kv_store:
+                return jsonify({"result": "found", "value": self.kv_store[key]}), 200, self.stamp()
+
+            return jsonify({"error": "Key does not exist"}), 404, self.stamp()
     
     def delete(self, key):
         if not self.main_instance:
@@ -58,11 +95,13 @@ class Kv_store:
             except:
                 return jsonify({"error": "Cannot forward request"}), 503
         
-        if key in self.kv_store:
-            del self.kv_store[key]
-            return jsonify({"result": "deleted"}), 200
-        else:
-            return jsonify({"error": "Key does not exist"}), 404
+        with self.changed:
+            if key in self.kv_store:
+                self.record_change(key)
+                del self.kv_store[key]
+                return jsonify({"result": "deleted"}), 200, self.stamp()
+            else:
+                return jsonify({"error": "Key does not exist"}), 404, self.stamp()
 
 kv_store = Kv_store()
 
@@ -86,5 +125,17 @@ def get_key_value(key):
 def delete_key_value(key):
     return kv_store.delete(key)
 
+# long-polled by forwarding instances: the keys written since their last call
+@app.route('/invalidations', methods=['GET'])
+def get_invalidations():
+    wait = min(request.args.get('wait', 0, type=float), 30)
+    return jsonify(kv_store.changes_since(request.args.get('epoch'), request.args.get('since', type=int), wait))
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8090, debug=True)
\ No newline at end of file
+    if not kv_store.main_instance and FORWARDING_MODE == 'async':
+        from aproxy import ForwardingProxy
+        ForwardingProxy(kv_store.forwarding_address).run('0.0.0.0', 8090)
+    else:
+        # keep-alive, so a forwarder's pooled connections stay open between requests
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+        app.run(host='0.0.0.0', port=8090, debug=True)
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+import aproxy
+from aproxy import ForwardingProxy
+
+class FakeMain:
+    ''' The main instance: a dict behind /kvs/<key> that counts the
+        connections and requests it gets '''
+    def __init__(self):
+        self.kvs = {}
+        self.requests = []
+        self.connections = 0
+        self.gate = None       # GET answers wait for it to be set
+        self.chunked = False   # answer with Transfer-Encoding: chunked
+        self.hang_up = False   # close every connection after one answer
+        self.version = 0
+        # answers to GET /invalidations, in order
+        self.invalidations = asyncio.Queue()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+        self.address = f"127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line, headers = await aproxy._read_head(reader)
+                if line is None:
+                    break
+                method, path, _ = line.split(' ', 2)
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests.append((method, path))
+                key = path[len('/kvs/'):]
+                # stamped with the write counter of when the key was read
+                version = self.version
+                if path.startswith('/invalidations'):
+                    status, answer = 200, await self.invalidations.get()
+                elif method == 'PUT':
+                    self.version += 1
+                    version = self.version
+                    status, answer = 201, {"result": "created"}
+                    self.kvs[key] = json.loads(body)["value"]
+                elif key in self.kvs:
+                    status, answer = 200, {"result": "found", "value": self.kvs[key]}
+                else:
+                    status, answer = 404, {"error": "Key does not exist"}
+                if method == 'GET' and path.startswith('/kvs/') and self.gate is not None:
+                    await self.gate.wait()
+                content = json.dumps(answer).encode()
+                head = f"HTTP/1.1 {status} X\r\nX-Kvs-Version: e:{version}\r\n"
+                if self.chunked:
+                    half = len(content) // 2
+                    writer.write((head + "Transfer-Encoding: chunked\r\n\r\n").encode()
+                                 + b"%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n" % (half, content[:half], len(content) - half, content[half:]))
+                else:
+                    writer.write((head + f"Content-Length: {len(content)}\r\n\r\n").encode() + content)
+                await writer.drain()
+                if self.hang_up:
+                    break
+        except asyncio.CancelledError:
+            pass # the test is over
+        finally:
+            writer.close()
+
+    def count(self, method):
+        return sum(1 for m, _ in self.requests if m == method)
+
+
+class TestForwardingProxy(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.main = FakeMain()
+        await self.main.start()
+        self.main.kvs["a"] = 1
+        # no cache unless a test turns it on: every GET goes upstream
+        self.proxy = ForwardingProxy(self.main.address, cache_keys=0)
+
+    async def asyncTearDown(self):
+        await self.main.stop()
+
+    async def test_concurrent_gets_share_one_request(self):
+        self.main.gate = asyncio.Event()
+        gets = [ asyncio.ensure_future(self.proxy.handle('GET', '/kvs/a', b'')) for _ in range(50) ]
+        await asyncio.sleep(0.05)
+        self.main.gate.set()
+        answers = await asyncio.gather(*gets)
+        self.assertEqual(self.main.count('GET'), 1)
+        self.assertEqual({ status for status, _ in answers }, {200})
+        self.assertEqual(json.loads(answers[0][1])["value"], 1)
+        self.assertEqual(self.proxy.inflight, {})
+
+    async def test_write_starts_new_round(self):
+        self.main.gate = asyncio.Event()
+        before = asyncio.ensure_future(self.proxy.handle('GET', '/kvs/a', b''))
+        await asyncio.sleep(0.05)
+        put = asyncio.ensure_future(self.proxy.handle('PUT', '/kvs/a', b'{"value": 2}'))
+        await asyncio.sleep(0.05)
+        after = asyncio.ensure_future(self.proxy.handle('GET', '/kvs/a', b''))
+        await asyncio.sleep(0.05)
+        self.main.gate.set()
+        await asyncio.gather(before, put)
+        status, content = await after
+        self.assertEqual(self.main.count('GET'), 2)
+        self.assertEqual(json.loads(content)["value"], 2)
+
+    async def test_unreachable_main_is_503(self):
+        await self.main.stop()
+        status, content = await self.proxy.handle('GET', '/kvs/a', b'')
+        self.assertEqual(status, 503)
+        self.assertEqual(json.loads(content), {"error": "Cannot forward request"})
+        # and the failed GET doesn't stay in flight for the next one to join
+        self.assertEqual(self.proxy.inflight, {})
+
+    async def test_bad_requests(self):
+        self.assertEqual((await self.proxy.handle('PUT', '/kvs/a', b'{}'))[0], 400)
+        self.assertEqual((await self.proxy.handle('GET', '/view', b''))[0], 404)
+        self.assertEqual(self.main.requests, [])
+
+    async def test_connection_reused(self):
+        for _ in range(5):
+            self.assertEqual((await self.proxy.handle('GET', '/kvs/a', b''))[0], 200)
+        self.assertEqual(self.main.connections, 1)
+        self.assertEqual(len(self.proxy.upstream.idle), 1)
+
+    async def test_closed_connection_replaced(self):
+        # the main instance drops idle connections: the pooled one fails,
+        # the request goes again on a fresh one
+        self.main.hang_up = True
+        for _ in range(3):
+            self.assertEqual((await self.proxy.handle('GET', '/kvs/a', b''))[0], 200)
+        self.assertEqual(self.main.count('GET'), 3)
+        self.assertEqual(self.main.connections, 3)
+        self.assertLessEqual(len(self.proxy.upstream.idle), 1)
+
+    async def test_chunked_answer(self):
+        self.main.chunked = True
+        for _ in range(2):
+            status, content = await self.proxy.handle('GET', '/kvs/a', b'')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(content)["value"], 1)
+        # the end of a chunked body is known, so the connection is kept
+        self.assertEqual(self.main.connections, 1)
+
+
+class TestCacheInvalidation(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.main = FakeMain()
+        await self.main.start()
+        self.main.kvs["a"] = 1
+        self.proxy = ForwardingProxy(self.main.address, cache_keys=10)
+        self.proxy.start_listening()
+        await self.invalidate({"epoch": "e", "version": 0, "reset": True})
+
+    async def asyncTearDown(self):
+        self.proxy.listener.cancel()
+        await self.main.stop()
+
+    async def invalidate(self, changes):
+        ''' Answer the proxy's pending GET /invalidations with changes '''
+        await self.main.invalidations.put(changes)
+        while not self.main.invalidations.empty():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+
+    async def get(self, key):
+        status, content = await self.proxy.handle('GET', f'/kvs/{key}', b'')
+        return status
+
+    async def test_written_keys_dropped(self):
+        self.assertEqual(await self.get("a"), 200)
+        self.assertEqual(await self.get("b"), 404)
+        self.assertEqual(set(self.proxy.cache), {"a", "b"})
+        # a write through another forwarder
+        await self.invalidate({"epoch": "e", "version": 1, "keys": ["a"]})
+        self.assertEqual(set(self.proxy.cache), {"b"})
+        self.assertEqual(self.proxy.seen, 1)
+        self.assertIn("since=1", self.main.requests[-1][1])
+
+    async def test_restart_or_overflow_drops_everything(self):
+        await self.get("a")
+        # the main instance started over: its counter means something else now
+        await self.invalidate({"epoch": "f", "version": 0})
+        self.assertEqual(self.proxy.cache, {})
+        self.assertEqual((self.proxy.epoch, self.proxy.seen), ("f", 0))
+        # answers stamped by the old epoch aren't cached anymore
+        await self.get("a")
+        self.assertEqual(self.proxy.cache, {})
+
+        self.main.version = 5
+        await self.invalidate({"epoch": "e", "version": 5, "reset": True})
+        await self.get("a")
+        self.assertIn("a", self.proxy.cache)
+        # we fell behind further than the main instance remembers
+        await self.invalidate({"epoch": "e", "version": 20000, "reset": True})
+        self.assertEqual(self.proxy.cache, {})
+        self.assertEqual(self.proxy.seen, 20000)
+
+    async def test_answer_older_than_a_write_not_cached(self):
+        self.main.gate = asyncio.Event()
+        get = asyncio.ensure_future(self.get("a"))
+        await asyncio.sleep(0.05)
+        # the GET read version 0; this write makes it 1 before the answer arrives
+        self.assertEqual((await self.proxy.handle('PUT', '/kvs/a', b'{"value": 2}'))[0], 201)
+        self.main.gate.set()
+        self.assertEqual(await get, 200)
+        self.assertNotIn("a", self.proxy.cache)
+
+        self.assertEqual(await self.get("a"), 200)
+        self.assertIn("a", self.proxy.cache)
+        # same for a write the invalidations report first
+        self.main.gate.clear()
+        self.proxy.cache.clear()
+        get = asyncio.ensure_future(self.get("a"))
+        await asyncio.sleep(0.05)
+        await self.invalidate({"epoch": "e", "version": 2, "keys": ["a"]})
+        self.main.gate.set()
+        await get
+        self.assertNotIn("a", self.proxy.cache)
+
+    async def test_unreachable_main_caches_nothing(self):
+        await self.get("a")
+        await self.main.stop()
+        self.proxy.listener.cancel()
+        self.proxy.start_listening()
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.proxy.cache, {})
+        self.assertIsNone(self.proxy.epoch)
+
+    async def test_listener_restarted(self):
+        await self.get("a")
+        old = self.proxy.listener
+        with mock.patch('aproxy.LISTEN_RETRY', 0.05):
+            # an answer the listener chokes on
+            await self.invalidate({"version": 1})
+            self.assertTrue(old.done())
+            self.assertEqual(self.proxy.cache, {})
+            self.assertIsNone(self.proxy.epoch)
+            await self.invalidate({"epoch": "e", "version": 1, "reset": True})
+        self.assertIsNot(self.proxy.listener, old)
+        self.assertEqual(self.proxy.epoch, "e")
+
+
+if __name__ == '__main__':
+    unittest.main()
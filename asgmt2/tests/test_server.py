@@ -0,0 +1,53 @@
+import threading
+import unittest
+from unittest import mock
+import server
+
+class TestInvalidations(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('server.CHANGE_LOG', 3):
+            self.store = server.Kv_store()
+        patcher = mock.patch('server.kv_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = server.app.test_client()
+
+    def put(self, key, value):
+        return self.client.put(f'/kvs/{key}', json={"value": value})
+
+    def test_writes_are_stamped(self):
+        self.assertEqual(self.put("a", 1).headers["X-Kvs-Version"], f"{self.store.epoch}:1")
+        self.assertEqual(self.client.get('/kvs/a').headers["X-Kvs-Version"], f"{self.store.epoch}:1")
+        self.assertEqual(self.client.delete('/kvs/a').headers["X-Kvs-Version"], f"{self.store.epoch}:2")
+        # a DELETE of nothing changes nothing, but is stamped like a GET
+        res = self.client.delete('/kvs/a')
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.headers["X-Kvs-Version"], f"{self.store.epoch}:2")
+        self.assertEqual(self.store.version, 2)
+
+    def test_keys_since(self):
+        self.put("a", 1)
+        self.put("b", 1)
+        self.put("a", 2)
+        res = self.client.get(f'/invalidations?epoch={self.store.epoch}&since=1')
+        self.assertEqual(res.json, {"epoch": self.store.epoch, "version": 3, "keys": ["b", "a"]})
+        self.assertEqual(self.store.changes_since(self.store.epoch, 3, 0)["keys"], [])
+
+    def test_reset(self):
+        # a new forwarder, one from before a restart, one further behind than the log
+        res = self.client.get('/invalidations')
+        self.assertEqual(res.json, {"epoch": self.store.epoch, "version": 0, "reset": True})
+        self.assertTrue(self.store.changes_since("old", 0, 0)["reset"])
+        for i in range(5):
+            self.put(str(i), i)
+        self.assertTrue(self.store.changes_since(self.store.epoch, 1, 0)["reset"])
+        self.assertEqual(self.store.changes_since(self.store.epoch, 2, 0)["keys"], ["2", "3", "4"])
+
+    def test_waits_for_a_write(self):
+        threading.Timer(0.05, self.put, ("a", 1)).start()
+        changes = self.store.changes_since(self.store.epoch, 0, 5)
+        self.assertEqual(changes["keys"], ["a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
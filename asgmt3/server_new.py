@@ -4,6 +4,8 @@ from concurrent.futures import ThreadPoolExecutor
 import os
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.serving import WSGIRequestHandler
 import logging
 import json
 from types import SimpleNamespace
@@ -17,6 +19,12 @@ VIEW = os.environ.get('VIEW')
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
 logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level=LOG_LEVEL)
 
+# keep-alive connections to the other replicas, shared by View and Kv_store;
+# urllib3 keeps one pool of PEER_POOL_SIZE connections per replica
+PEER_POOL_SIZE = int(os.environ.get('PEER_POOL_SIZE', 10))
+peer_session = requests.Session()
+peer_session.mount('http://', HTTPAdapter(pool_connections=PEER_POOL_SIZE, pool_maxsize=PEER_POOL_SIZE))
+
 # managed by View, used by Kv_store
 local_causal_metadata = []
 md_lock = threading.Lock() # to sync changes to local_causal_metadata
@@ -179,10 +187,9 @@ class View:
     def _ping(self, addr: str):
         ''' ping addr with /helo URL to see if it's still alive '''
         try:
-            session = requests.Session()
             url = "http://" + addr + "/helo"
             data = {'socket-address': self.addr}
-            response = session.put(url, json=data)
+            response = peer_session.put(url, json=data)
             #response = requests.get(url)
             return response.status_code
         except Exception as e:
@@ -265,9 +272,9 @@ class View:
             data = {"socket-address": socket_address, "sender-id": self.addr}
             logging.debug(data)
             if action == "PUT":
-                response = requests.put(url, json=data, headers=headers)
+                response = peer_session.put(url, json=data, headers=headers)
             elif action == "DELETE":
-                response = requests.delete(url, json=data, headers=headers)
+                response = peer_session.delete(url, json=data, headers=headers)
             logging.debug(f"{response.url}'s response: {response.status_code}, {response.text}")
             return response.status_code
         except:
@@ -524,9 +531,9 @@ class Kv_store:
             response = None
             if action == "PUT":
                 logging.debug(f"sending PUT to {url}")
-                response = requests.put(url, data=data, headers=headers)
+                response = peer_session.put(url, data=data, headers=headers)
             elif action == "DELETE":
-                response = requests.delete(url, data=data, headers=headers)
+                response = peer_session.delete(url, data=data, headers=headers)
             logging.debug(f"{id} response code: {response.status_code}")
         except:
             logging.warning(traceback.format_exc())
@@ -651,4 +658,6 @@ def kvs_operations(key):
 if __name__ == '__main__':
     a = SOCKET_ADDRESS.split(":")
     #app.run(host=a[0], port=a[1], debug=True)
+    # HTTP/1.1 so the other replicas can keep their connections to us open
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host='0.0.0.0', port=a[1], debug=True)
\ No newline at end of file
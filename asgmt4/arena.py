@@ -0,0 +1,184 @@
+import json
+import struct
+import threading
+from array import array
+from storage import StorageEngine
+
+'''
+Compact storage engine (STORAGE_ENGINE=arena).
+
+Instead of one Python str, one value object and a dict slot per entry,
+everything lives in three flat buffers:
+- keys:   bytearray of key_len (u8) | key bytes. Keys are capped at 50
+          characters by KV_Store.put, so their UTF-8 form always fits a u8.
+- values: bytearray slab of value_len (u32) | JSON encoded value
+- index:  open-addressing hash table (linear probing) made of two int64
+          arrays holding the offsets of a key and its value
+
+Overwrites append the new value and deletes only mark the slot, so dead
+bytes pile up in the buffers; compact() rewrites them once more than half
+of the bytes are garbage.
+'''
+
+_EMPTY = -1
+_DELETED = -2
+_VALUE_LEN = struct.Struct('<I')
+MAX_KEY_BYTES = 255
+
+
+class ArenaEngine(StorageEngine):
+    def __init__(self, capacity=1024, max_load=0.7, compact_ratio=0.5):
+        '''
+            Parameters:
+            - capacity: initial number of index slots (rounded up to a power of 2)
+            - max_load: grow the index once this fraction of slots is in use
+            - compact_ratio: compact once this fraction of buffer bytes is dead
+        '''
+        self.max_load = max_load
+        self.compact_ratio = compact_ratio
+        self.lock = threading.RLock()
+        self.n_keys = 0
+        self._reset(capacity)
+
+    def _reset(self, capacity):
+        size = 8
+        while size < capacity:
+            size *= 2
+        self.keys = bytearray()
+        self.values = bytearray()
+        self.key_slots = array('q', [_EMPTY]) * size
+        self.value_slots = array('q', [_EMPTY]) * size
+        self.used_slots = 0 # live + deleted, what the probe sequences see
+        self.dead_bytes = 0
+
+    def _key_at(self, offset):
+        length = self.keys[offset]
+        return bytes(self.keys[offset + 1:offset + 1 + length])
+
+    def _value_at(self, offset):
+        length = _VALUE_LEN.unpack_from(self.values, offset)[0]
+        start = offset + _VALUE_LEN.size
+        return json.loads(self.values[start:start + length])
+
+    def _value_size(self, offset):
+        return _VALUE_LEN.size + _VALUE_LEN.unpack_from(self.values, offset)[0]
+
+    def _append_value(self, value):
+        encoded = json.dumps(value).encode('utf-8')
+        offset = len(self.values)
+        self.values += _VALUE_LEN.pack(len(encoded))
+        self.values += encoded
+        return offset
+
+    def _find(self, key_bytes):
+        ''' Return: (slot of the key or None, first free slot on its probe path) '''
+        mask = len(self.key_slots) - 1
+        slot = hash(key_bytes) & mask
+        free = None
+        while True:
+            offset = self.key_slots[slot]
+            if offset == _EMPTY:
+                return None, free if free is not None else slot
+            if offset == _DELETED:
+                if free is None:
+                    free = slot
+            elif self.keys[offset] == len(key_bytes) and self._key_at(offset) == key_bytes:
+                return slot, free
+            slot = (slot + 1) & mask
+
+    def get(self, key, default=None):
+        with self.lock:
+            slot, _ = self._find(key.encode('utf-8'))
+            if slot is None:
+                return default
+            return self._value_at(self.value_slots[slot])
+
+    def put(self, key, value):
+        key_bytes = key.encode('utf-8')
+        if len(key_bytes) > MAX_KEY_BYTES:
+            raise ValueError(f"key longer than {MAX_KEY_BYTES} bytes")
+        with self.lock:
+            slot, free = self._find(key_bytes)
+            if slot is not None:
+                self.dead_bytes += self._value_size(self.value_slots[slot])
+                self.value_slots[slot] = self._append_value(value)
+                self._maybe_compact()
+                return
+
+            key_offset = len(self.keys)
+            self.keys.append(len(key_bytes))
+            self.keys += key_bytes
+            if self.key_slots[free] == _EMPTY:
+                self.used_slots += 1
+            self.key_slots[free] = key_offset
+            self.value_slots[free] = self._append_value(value)
+            self.n_keys += 1
+            if self.used_slots > len(self.key_slots) * self.max_load:
+                self._rebuild(len(self.key_slots) * 2 if self.n_keys > len(self.key_slots) * self.max_load / 2
+                              else len(self.key_slots))
+
+    def delete(self, key) -> bool:
+        with self.lock:
+            slot, _ = self._find(key.encode('utf-8'))
+            if slot is None:
+                return False
+            key_offset = self.key_slots[slot]
+            self.dead_bytes += 1 + self.keys[key_offset] + self._value_size(self.value_slots[slot])
+            self.key_slots[slot] = _DELETED
+            self.value_slots[slot] = _EMPTY
+            self.n_keys -= 1
+            self._maybe_compact()
+            return True
+
+    def items(self):
+        # decode under the lock so compaction can't move bytes underneath us
+        with self.lock:
+            entries = [ (self._key_at(k).decode('utf-8'), self._value_at(v))
+                        for k, v in zip(self.key_slots, self.value_slots) if k >= 0 ]
+        return iter(entries)
+
+    def size(self) -> int:
+        return self.n_keys
+
+    def clear(self):
+        with self.lock:
+            self.n_keys = 0
+            self._reset(1024)
+
+    def memory_usage(self) -> int:
+        ''' Bytes held by the buffers and the index '''
+        return (len(self.keys) + len(self.values) +
+                self.key_slots.itemsize * len(self.key_slots) +
+                self.value_slots.itemsize * len(self.value_slots))
+
+    def _maybe_compact(self):
+        total = len(self.keys) + len(self.values)
+        if total > 4096 and self.dead_bytes > total * self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        ''' Copy live entries into fresh buffers, dropping overwritten values
+            and deleted entries, and rebuild the index without tombstones.
+        '''
+        with self.lock:
+            self._rebuild(len(self.key_slots))
+
+    def _rebuild(self, capacity):
+        live = [ (k, v) for k, v in zip(self.key_slots, self.value_slots) if k >= 0 ]
+        old_keys, old_values = self.keys, self.values
+        self._reset(capacity)
+        mask = len(self.key_slots) - 1
+        for key_offset, value_offset in live:
+            length = old_keys[key_offset]
+            key_bytes = bytes(old_keys[key_offset + 1:key_offset + 1 + length])
+            value_size = _VALUE_LEN.size + _VALUE_LEN.unpack_from(old_values, value_offset)[0]
+
+            slot = hash(key_bytes) & mask
+            while self.key_slots[slot] != _EMPTY:
+                slot = (slot + 1) & mask
+            self.key_slots[slot] = len(self.keys)
+            self.value_slots[slot] = len(self.values)
+            self.keys.append(length)
+            self.keys += key_bytes
+            self.values += old_values[value_offset:value_offset + value_size]
+            self.used_slots += 1
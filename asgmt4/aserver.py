@@ -0,0 +1,489 @@
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import random
+import sys
+from http import HTTPStatus
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, unquote_to_bytes
+from werkzeug.exceptions import HTTPException
+import peers
+import wire
+
+'''
+asyncio serving mode (SERVER_MODE=async).
+
+The node speaks HTTP/1.1 on an asyncio event loop instead of Flask's
+threaded server, and keeps the peer round trips of the data path off
+threads altogether:
+
+- a /kvs/<key> request for a key another shard owns is forwarded with the
+  async peer client below; nothing waits on a thread meanwhile
+- any other request runs the very same Flask route on a small worker pool,
+  which only does local work (the store, the WAL). If the route broadcasts
+  a write, KV_Store.broadcast hands it back through deferred_replication
+  instead of sending it, and the fan-out, the ack policy and the retries
+  happen here on the loop. With replication streams (stream.py) the write
+  is already queued on them, and only the wait for the acks happens here
+
+A forwarded request gets the checks the route would make first
+(KV_Store.check_request): the X-Shard-Id 421, ttl and acks.
+
+Out of scope, and still on threads with the blocking client: routes that
+reorganise the cluster (/view, /shard/add-member, reshard, /shard-alloc),
+which are rare and mostly wait on each other anyway, and the background
+work that no client waits on: the replication streams (stream.py), the
+tombstone compactor, anti-entropy and snapshot transfers.
+
+AsyncPeerPool keeps connections to each peer open like peers.PeerPool,
+reports to the same PeerHealth, raises the same requests exceptions and
+speaks msgpack to the peers that do (see wire.py).
+'''
+
+# set by AsyncServer around a route call; KV_Store.broadcast appends
+# (method, key, payload, targets, acks needed, policy, stream seqs or None) to it
+deferred_replication = contextvars.ContextVar('deferred_replication', default=None)
+
+# connections waiting to be accepted, so a burst of clients isn't refused
+BACKLOG = 2048
+
+
+async def _read_head(reader):
+    ''' Return: (start line, lower-cased headers), or (None, None) if the
+        connection was closed before a new message began '''
+    line = await reader.readline()
+    if not line:
+        return None, None
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n'):
+            break
+        if not header:
+            raise asyncio.IncompleteReadError(header, None)
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return line.decode('latin-1').rstrip('\r\n'), headers
+
+
+async def _read_body(reader, headers, until_eof=False):
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # trailers, if any
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    return await reader.read() if until_eof else b''
+
+
+class AsyncResponse:
+    ''' The parts of requests.Response the callers use '''
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        if wire.is_wire(self.headers.get('content-type')):
+            return wire.decode(self.content)
+        return json.loads(self.content)
+
+
+class AsyncPeerPool:
+    def __init__(self, pool_size=10, health: peers.PeerHealth = None):
+        '''
+            Parameters:
+            - pool_size: idle connections kept open to each peer
+            - health: told about the outcome of every request
+        '''
+        self.health = health if health is not None else peers.PeerHealth()
+        self.pool_size = pool_size
+        self.idle = {} # "ip:port" -> [(reader, writer)]
+        self.wire_peers = set() # peers that answered in msgpack
+
+    async def _connect(self, addr, timeout):
+        host, _, port = addr.rpartition(':')
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ConnectTimeout(f"connecting to {addr} timed out")
+        except (OSError, ValueError) as e:
+            raise requests.exceptions.ConnectionError(f"cannot connect to {addr}: {e}")
+
+    def _checkin(self, addr, conn):
+        idle = self.idle.setdefault(addr, [])
+        if len(idle) < self.pool_size:
+            idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def request(self, method, url, json=None, timeout=1):
+        parts = urlsplit(url)
+        addr = parts.netloc
+        target = parts.path + (f'?{parts.query}' if parts.query else '')
+        head = f"{method} {target} HTTP/1.1\r\nHost: {addr}\r\nAccept: {wire.ACCEPT}\r\n"
+        if json is None:
+            body = b''
+        elif wire.ENABLED and addr in self.wire_peers:
+            body = wire.encode(json)
+            head += f"Content-Type: {wire.MIMETYPE}\r\n"
+        else:
+            body = _dumps(json)
+            head += "Content-Type: application/json\r\n"
+        head += f"Content-Length: {len(body)}\r\n"
+        message = (head + "\r\n").encode('latin-1') + body
+
+        while True:
+            idle = self.idle.get(addr)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                try:
+                    reader, writer = await self._connect(addr, timeout)
+                except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout):
+                    self.health.failure(addr)
+                    raise
+            try:
+                writer.write(message)
+                status, headers, content = await asyncio.wait_for(self._response(reader, writer), timeout)
+            except asyncio.TimeoutError:
+                writer.close()
+                raise requests.exceptions.ReadTimeout(f"{method} {url} timed out")
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                writer.close()
+                if reused:
+                    # the peer had closed the idle connection; use a new one
+                    continue
+                self.health.failure(addr)
+                raise requests.exceptions.ConnectionError(f"{method} {url} failed: {e}")
+            break
+
+        self.health.success(addr)
+        if wire.is_wire(headers.get('content-type')):
+            self.wire_peers.add(addr)
+        if headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self._checkin(addr, (reader, writer))
+        return AsyncResponse(status, headers, content)
+
+    async def _response(self, reader, writer):
+        await writer.drain()
+        line, headers = await _read_head(reader)
+        if line is None:
+            raise asyncio.IncompleteReadError(b'', None)
+        status = int(line.split()[1])
+        if status in (204, 304):
+            return status, headers, b''
+        return status, headers, await _read_body(reader, headers, until_eof=True)
+
+    def close(self):
+        for idle in self.idle.values():
+            for _, writer in idle:
+                writer.close()
+        self.idle.clear()
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value).encode('utf-8')
+
+
+class AsyncServer:
+    def __init__(self, server, workers=32, keepalive=75.0):
+        '''
+            Parameters:
+            - server: the Server whose routes are served
+            - workers: threads that run route handlers
+            - keepalive: seconds an idle client connection is kept open
+        '''
+        self.server = server
+        self.app = server.app
+        self.kv_store = server.kv_store
+        self.workers = ThreadPoolExecutor(workers, thread_name_prefix='route')
+        self.keepalive = keepalive
+        self.peers = AsyncPeerPool(peers.PEER_POOL_SIZE, peers.health)
+        self.routes = self.app.url_map.bind('localhost')
+        self.background = set() # replication still under way after the reply
+
+    def run(self, host, port):
+        async def serve():
+            listener = await self.start(host, port)
+            async with listener:
+                await listener.serve_forever()
+        asyncio.run(serve())
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self._connection, host, port, backlog=BACKLOG)
+
+    async def _connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    line, headers = await asyncio.wait_for(_read_head(reader), self.keepalive)
+                except asyncio.TimeoutError:
+                    break
+                if line is None:
+                    break
+                method, target, version = line.split(' ', 2)
+                body = await _read_body(reader, headers)
+                status, response_headers, content = await self.handle(method, target, version, headers, body, peer)
+
+                keep_alive = headers.get('connection', '').lower() != 'close' if version == 'HTTP/1.1' \
+                    else headers.get('connection', '').lower() == 'keep-alive'
+                head = [f"HTTP/1.1 {status}"]
+                head += [ f"{name}: {value}" for name, value in response_headers
+                          if name.lower() not in ('content-length', 'connection', 'transfer-encoding') ]
+                if isinstance(content, bytes):
+                    head.append(f"Content-Length: {len(content)}")
+                else:
+                    head.append("Transfer-Encoding: chunked")
+                head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+                if isinstance(content, bytes):
+                    writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + content)
+                    await writer.drain()
+                else:
+                    writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+                    await self._send_chunked(writer, content)
+                if not keep_alive:
+                    break
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            logging.info(f"[aserver] dropping connection from {peer}: {e}")
+        finally:
+            writer.close()
+
+    async def _send_chunked(self, writer, content):
+        ''' Send a streamed body, producing each piece on a worker (it may
+            read the store) and waiting for the client to take it first '''
+        loop = asyncio.get_running_loop()
+        pieces = iter(content)
+        try:
+            while True:
+                piece = await loop.run_in_executor(self.workers, next, pieces, None)
+                if piece is None:
+                    break
+                if piece:
+                    writer.write(f"{len(piece):x}\r\n".encode('latin-1') + piece + b"\r\n")
+                    await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            if hasattr(content, 'close'):
+                await loop.run_in_executor(self.workers, content.close)
+
+    async def handle(self, method, target, version, headers, body, peer=None):
+        ''' Return: (status line, [(header, value)], body bytes or, if streamed, an iterable of them) '''
+        path, _, query = target.partition('?')
+        key = self._key(path, method)
+        if key is not None:
+            res = await self._forward_if_remote(method, key, headers, body)
+            if res is not None:
+                return res
+
+        environ = self._environ(method, path, query, version, headers, body, peer)
+        loop = asyncio.get_running_loop()
+        status, response_headers, content, deferred = await loop.run_in_executor(self.workers, self._call, environ)
+        if deferred:
+            for write in deferred:
+                await self._fan_out(*write)
+            content = self._refresh_causal_metadata(content, dict(response_headers).get('Content-Type'))
+        return status, response_headers, content
+
+    def _key(self, path, method):
+        ''' Return: the key if path is /kvs/<key>, None otherwise '''
+        try:
+            endpoint, args = self.routes.match(path, method)
+        except HTTPException:
+            return None
+        return args.get('key') if endpoint == 'kvs_api' else None
+
+    def _environ(self, method, path, query, version, headers, body, peer):
+        host, _, port = headers.get('host', 'localhost').partition(':')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': host,
+            'SERVER_PORT': port or '80',
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0] if peer else '',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if 'content-type' in headers:
+            environ['CONTENT_TYPE'] = headers['content-type']
+        for name, value in headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    def _call(self, environ):
+        ''' Run the Flask route (on a worker thread), keeping its broadcasts '''
+        deferred = []
+        token = deferred_replication.set(deferred)
+        started = {}
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+        try:
+            result = self.app.wsgi_app(environ, start_response)
+            if int(started['status'].split()[0]) not in (204, 304) \
+                    and not any(name.lower() == 'content-length' for name, _ in started['headers']):
+                # streamed (fetchAll as NDJSON): the connection pulls it piece by piece
+                return started['status'], started['headers'], result, deferred
+            try:
+                content = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            deferred_replication.reset(token)
+        return started['status'], started['headers'], content, deferred
+
+    def _refresh_causal_metadata(self, content, content_type):
+        ''' The reply was built before the replicas answered; give the
+            client the causal metadata as it is now '''
+        binary = wire.is_wire(content_type)
+        try:
+            data = wire.decode(content) if binary else json.loads(content)
+        except ValueError:
+            return content
+        if isinstance(data, dict) and 'causal-metadata' in data:
+            data['causal-metadata'] = dict(self.kv_store.local_causal_metadata)
+            return wire.encode(data) if binary else _dumps(data)
+        return content
+
+    async def _forward_if_remote(self, method, key, headers, body):
+        kv_store = self.kv_store
+        shard_id = kv_store._hash(key)
+        if shard_id is None or kv_store.address in kv_store.shard_members[shard_id]:
+            return None
+        try:
+            if not body:
+                req = {}
+            elif wire.is_wire(headers.get('content-type')):
+                req = wire.decode(body)
+            else:
+                req = json.loads(body)
+        except Exception:
+            # malformed; let the route answer it
+            return None
+        # the same checks the route makes before it forwards
+        error = kv_store.check_request(method, key, req, headers.get('x-shard-id'))
+        if error is not None:
+            error, status = error
+            return f"{status} {_reason(status)}", [("Content-Type", "application/json")], _dumps(error)
+        try:
+            payload = kv_store._forward_payload(method, dict(req, key=key))
+        except Exception:
+            return None
+
+        destinations = [ addr for addr in kv_store.shard_members[shard_id] if addr != kv_store.address ]
+        random.shuffle(destinations)
+        for addr in destinations:
+            # skip replicas we know are down (see peers.py)
+            if not peers.is_up(addr):
+                continue
+            try:
+                res = await self.peers.request(method, f'http://{addr}/kvs/{key}', json=payload, timeout=1)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                logging.info(f"\tFailed to forward to {addr}, trying the next one")
+                continue
+            content_type, content = res.headers.get('content-type', 'application/json'), res.content
+            if wire.is_wire(content_type) and wire.MIMETYPE not in headers.get('accept', ''):
+                # a client, not a peer
+                content_type, content = 'application/json', _dumps(res.json())
+            return f"{res.status_code} {_reason(res.status_code)}", [("Content-Type", content_type)], content
+        error = {"error": "No replica of the shard is reachable; try again later"}
+        return "503 SERVICE UNAVAILABLE", [("Content-Type", "application/json")], _dumps(error)
+
+    async def _fan_out(self, method, key, payload, targets, needed, policy, seqs=None):
+        ''' Send a write to targets at once and return once `needed` of them
+            have it; the rest keep going in the background '''
+        if seqs is not None:
+            acked = await self._await_acks(seqs, needed)
+            if acked < needed:
+                logging.warning(f"##### {method} {key}: {acked + 1}/{len(targets) + 1} replicas have it, wanted {policy}")
+            return
+        pending = { self._spawn(self._replicate(method, view, key, payload)) for view in targets }
+        acked = 0
+        while pending and acked < needed:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            acked += sum(1 for task in done if task.result())
+        if acked < needed:
+            logging.warning(f"##### {method} {key}: {acked + 1}/{len(targets) + 1} replicas have it, wanted {policy}")
+
+    async def _await_acks(self, seqs, needed) -> int:
+        ''' KV_Store._await_acks, waiting on the loop instead of a thread '''
+        if needed == 0:
+            return 0
+        loop = asyncio.get_running_loop()
+        pending = set()
+        for view, seq in seqs.items():
+            if not peers.is_up(view):
+                continue
+            future = loop.create_future()
+            # acks come in on the stream's thread
+            self.kv_store._stream(view).when_acked(
+                seq, lambda ok, future=future: loop.call_soon_threadsafe(_settle, future, ok))
+            pending.add(future)
+        acked = 0
+        deadline = loop.time() + self.kv_store.ack_timeout
+        while pending and acked < needed:
+            done, pending = await asyncio.wait(pending, timeout=max(0, deadline - loop.time()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            acked += sum(1 for future in done if future.result())
+        for future in pending:
+            future.cancel()
+        return acked
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+    async def _replicate(self, method, view, key, payload, attempt=0) -> bool:
+        status = None
+        if peers.is_up(view):
+            try:
+                res = await self.peers.request(method, f'http://{view}/kvs/{key}', json=payload, timeout=1)
+                status = res.status_code
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                logging.warning(f"##### broadcast to {view} failed")
+        ok, delay = self.kv_store._replicated(method, view, key, payload, status, attempt)
+        if delay is not None:
+            asyncio.get_running_loop().call_later(
+                delay, lambda: self._spawn(self._replicate(method, view, key, payload, attempt + 1)))
+        return ok
+
+
+def _settle(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _reason(status):
+    try:
+        return HTTPStatus(status).phrase.upper()
+    except ValueError:
+        return ''
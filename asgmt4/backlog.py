@@ -0,0 +1,73 @@
+import json
+import os
+
+'''
+Spilling a replication stream's backlog to disk.
+
+A replication stream (stream.py) holds the entries its replica hasn't
+acknowledged in memory, up to a limit. When the replica is down or far
+behind, the entries past the limit are written to the stream's spill file
+instead, in order, and read back into memory as the older ones get
+acknowledged. A replica that was away for a while then gets every write it
+missed, in order, as soon as it is back, and the coordinator never holds
+more than the limit in memory.
+
+This is an extension of the stream's memory, not a durable hint log: it
+is neither synced nor replayed after a restart. The entries in memory
+ahead of it die with the process anyway, and their sequence numbers belong
+to a stream that ended with it, so every run starts a new, empty file.
+Whatever a replica missed across a restart (or past max_bytes, when
+nothing more is written) is repaired by anti-entropy (see merkle.py).
+
+The file is append-only JSON lines with a read position; it is emptied
+whenever it has been read to the end.
+'''
+
+class BacklogSpill:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'w+b')
+        self.size = 0
+        self.read_pos = 0
+        self.count = 0
+
+    def append(self, entry) -> bool:
+        ''' Return: False if the file is full and entry wasn't written '''
+        data = json.dumps(entry).encode('utf-8') + b'\n'
+        if self.size + len(data) > self.max_bytes:
+            return False
+        self.file.seek(self.size)
+        self.file.write(data)
+        self.size += len(data)
+        self.count += 1
+        return True
+
+    def read(self, n) -> list:
+        ''' Take up to n entries, oldest first '''
+        self.file.flush()
+        self.file.seek(self.read_pos)
+        entries = []
+        while len(entries) < n:
+            line = self.file.readline()
+            if not line:
+                break
+            entries.append(json.loads(line))
+        self.read_pos = self.file.tell()
+        self.count -= len(entries)
+        if self.count == 0:
+            self.file.seek(0)
+            self.file.truncate()
+            self.size = self.read_pos = 0
+        return entries
+
+    def close(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return self.count
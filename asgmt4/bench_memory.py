@@ -0,0 +1,79 @@
+import logging
+import sys
+import time
+import tracemalloc
+from unittest import mock
+from storage import open_engine
+
+'''
+Per-key memory of the storage engines, bare and under a KV_Store.
+
+    python3 bench_memory.py [n_keys] [value_size]
+
+Keys look like the ones the tests use ("key" + number) and values are
+strings of value_size characters. Memory is measured with tracemalloc, so
+it counts everything the engine allocates, object headers included.
+
+The "store" rows write through KV_Store.put on a node that is its own shard,
+so they also count what the store keeps next to the engine for every key
+(versions, the ordered index, the Merkle tree, ...): that is what a node
+actually uses per key.
+'''
+
+ADDRESS = '127.0.0.1:8090'
+
+def value(i, value_size):
+    return ("v%d" % i).ljust(value_size, 'x')
+
+def measure(name, n_keys, value_size):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kvs = open_engine(name)
+    start = time.perf_counter()
+    for i in range(n_keys):
+        kvs.put(f"key{i}", value(i, value_size))
+    elapsed = time.perf_counter() - start
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, elapsed, kvs
+
+def measure_store(name, n_keys, value_size):
+    import server
+    with mock.patch('server.STORAGE_ENGINE', name):
+        kserver = server.Server(f"bench_memory_{name}")
+    store = kserver.kv_store
+    store.address = ADDRESS
+    store.local_causal_metadata = {ADDRESS: 0}
+    store.shard_members = {"s0": [ADDRESS]}
+    store.shard_id = "s0"
+    with mock.patch('server.SOCKET_ADDRESS', ADDRESS), kserver.app.app_context():
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        for i in range(n_keys):
+            store.put(f"key{i}", value(i, value_size), {})
+        elapsed = time.perf_counter() - start
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+    return used, elapsed, kserver
+
+def main():
+    n_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    value_size = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    # the store logs every put; that's not what is measured here
+    logging.disable(logging.INFO)
+    print(f"{n_keys} keys, {value_size}-char values")
+    print(f"{'engine':<8} {'through':<8} {'bytes/key':>10} {'total MB':>10} {'put us/op':>10}")
+    for through, run in (('engine', measure), ('store', measure_store)):
+        baseline = None
+        for name in ('dict', 'arena'):
+            used, elapsed, kept = run(name, n_keys, value_size)
+            per_key = used / n_keys
+            if baseline is None:
+                baseline = per_key
+            print(f"{name:<8} {through:<8} {per_key:>10.1f} {used / 2**20:>10.1f} {elapsed / n_keys * 1e6:>10.2f}"
+                  f"   ({per_key / baseline:.0%} of dict)")
+            del kept
+
+if __name__ == '__main__':
+    main()
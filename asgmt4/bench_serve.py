@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import random
+import resource
+import time
+import requests
+from aserver import AsyncPeerPool
+from peers import PeerHealth
+
+'''
+Throughput and latency of a node under many concurrent clients, to compare
+SERVER_MODE=flask with SERVER_MODE=async.
+
+    python3 bench_serve.py <ip:port>[=label] ... [--clients 1000] [--seconds 10]
+                           [--keys 1000] [--writes 0.5]
+
+Start the cluster (see launch.sh) once per mode, or a node of each mode
+side by side, and point the benchmark at them, e.g.
+
+    python3 bench_serve.py localhost:8082=flask localhost:8092=async
+
+Every client keeps one connection open and sends GETs and PUTs (a
+`writes` fraction of them) of random keys until time is up, so with several
+shards most requests are forwarded, which is where the two modes differ
+most. Concurrent writes also trip the replicas' causal dependency check
+(they answer 503 and the coordinator retries), so --writes 0 measures the
+serving path alone.
+'''
+
+async def client(pool, addr, keys, writes, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        key = f"bench{random.randrange(keys)}"
+        method, body = ('PUT', {"value": key}) if random.random() < writes else ('GET', {})
+        start = time.perf_counter()
+        try:
+            res = await pool.request(method, f'http://{addr}/kvs/{key}', json=body, timeout=30)
+            failed = res.status_code >= 500
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            failed = True
+        latencies.append(time.perf_counter() - start)
+        errors[0] += failed
+
+async def run(addr, clients, seconds, keys, writes):
+    pool = AsyncPeerPool(pool_size=clients, health=PeerHealth())
+    latencies, errors = [], [0]
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(client(pool, addr, keys, writes, deadline, latencies, errors) for _ in range(clients)))
+    pool.close()
+    return latencies, errors[0]
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def main():
+    parser = argparse.ArgumentParser(description="requests/s and p99 of nodes under concurrent clients")
+    parser.add_argument('targets', nargs='+', help="ip:port of a node, optionally =label")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--writes', type=float, default=0.5, help="fraction of requests that are PUTs")
+    args = parser.parse_args()
+
+    # one socket per client
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < args.clients + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, args.clients + 1024), hard))
+
+    print(f"{args.clients} clients, {args.seconds:g}s, {args.keys} keys, {args.writes:.0%} writes")
+    print(f"{'node':<20} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for target in args.targets:
+        addr, _, label = target.partition('=')
+        latencies, errors = asyncio.run(run(addr, args.clients, args.seconds, args.keys, args.writes))
+        latencies.sort()
+        if not latencies:
+            print(f"{label or addr:<20} no requests completed")
+            continue
+        print(f"{label or addr:<20} {len(latencies):>9} {errors:>7} {len(latencies) / args.seconds:>9.0f}"
+              f" {percentile(latencies, 0.5) * 1e3:>8.1f} {percentile(latencies, 0.99) * 1e3:>8.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import json
+import sys
+import time
+import wire
+
+'''
+Size and encode/decode cost of peer messages, JSON against msgpack.
+
+    python3 bench_wire.py [n_keys]
+
+The messages are shaped like the real ones: a replicated PUT, a paxos
+ACCEPTED with the shard map, and a loadAll / fetchAll body of n_keys keys
+with their versions and deadlines. JSON is timed the way Flask and
+requests do it (dumps + encode, loads of the bytes).
+'''
+
+def messages(n_keys):
+    view = [ f"10.10.0.{i}:8090" for i in range(2, 8) ]
+    causal_metadata = { addr: 1000 + i for i, addr in enumerate(view) }
+    kvs = { f"key{i}": f"value-{i}" for i in range(n_keys) }
+    return {
+        "broadcast PUT": {"broadcast": False, "causal-metadata": causal_metadata, "socket_address": view[0],
+                          "version": 1700000000.123456, "value": "v" * 32, "value-encoded": True},
+        "paxos ACCEPTED": {"type": "ACCEPTED", "proposal": {"sender_id": view[0], "number": 12},
+                           "accepted_value": {"shards": {"alligator": view[:3], "buffalo": view[3:]}}},
+        f"loadAll {n_keys} keys": {"kvs": kvs, "causal_metadata": causal_metadata,
+                                   "versions": { key: 1700000000.0 + i for i, key in enumerate(kvs) },
+                                   "expires-at": { key: 1800000000.5 for key in list(kvs)[::10] }},
+    }
+
+def timed(fn, arg, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        out = fn(arg)
+    return (time.perf_counter() - start) / rounds * 1e6, out
+
+def main():
+    if not wire.ENABLED:
+        sys.exit("msgpack is not installed (pip install -r requirements.txt)")
+    n_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    codecs = {
+        "json": (lambda v: json.dumps(v).encode('utf-8'), json.loads),
+        "msgpack": (wire.encode, wire.decode),
+    }
+    print(f"{'message':<20} {'codec':<8} {'bytes':>9} {'encode us':>10} {'decode us':>10}")
+    for name, message in messages(n_keys).items():
+        rounds = 20 if "kvs" in message else 20000
+        for codec, (encode, decode) in codecs.items():
+            encode_us, data = timed(encode, message, rounds)
+            decode_us, _ = timed(decode, data, rounds)
+            print(f"{name:<20} {codec:<8} {len(data):>9} {encode_us:>10.1f} {decode_us:>10.1f}")
+
+if __name__ == '__main__':
+    main()
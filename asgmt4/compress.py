@@ -0,0 +1,108 @@
+import base64
+import json
+import lzma
+import threading
+import time
+import zlib
+
+'''
+Transparent compression of large values.
+
+Values whose JSON form is at least `threshold` bytes are replaced by
+{"$z": codec, "data": base64 of the compressed JSON} before they are stored,
+logged or sent to another node, and turned back into the original value
+only when a client reads them. Everything between the two ends (the engine,
+the WAL, snapshots, broadcast, fetchAll/loadAll) just moves the small
+marker around.
+
+A client value that happens to look like a marker is wrapped as
+{"$z": "raw", "data": value} so it can't be mistaken for one.
+'''
+
+MARKER = "$z"
+
+_CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+
+def is_encoded(value):
+    return isinstance(value, dict) and len(value) == 2 and MARKER in value and "data" in value
+
+
+class ValueCodec:
+    def __init__(self, threshold=1024, codec="zlib", level=6):
+        '''
+            Parameters:
+            - threshold: compress values whose JSON encoding is at least this
+              many bytes; 0 turns compression off
+            - codec: "zlib" or "lzma"
+            - level: compression level (zlib level / lzma preset)
+        '''
+        if codec not in _CODECS:
+            raise ValueError(f"unknown codec {codec}, expected one of {sorted(_CODECS)}")
+        self.threshold = threshold
+        self.codec = codec
+        self.level = level
+        self.lock = threading.Lock()
+        self.compressed = 0   # values compressed
+        self.raw_bytes = 0    # their JSON size
+        self.packed_bytes = 0 # their size once compressed
+        self.compress_cpu = 0.0
+        self.decompressed = 0
+        self.decompress_cpu = 0.0
+
+    def encode(self, value):
+        ''' Turn a client value into what gets stored and sent around '''
+        if is_encoded(value):
+            return {MARKER: "raw", "data": value}
+        if not self.threshold:
+            return value
+        raw = json.dumps(value).encode('utf-8')
+        if len(raw) < self.threshold:
+            return value
+
+        compress = _CODECS[self.codec][0]
+        start = time.thread_time()
+        packed = compress(raw, self.level)
+        elapsed = time.thread_time() - start
+        with self.lock:
+            self.compressed += 1
+            self.raw_bytes += len(raw)
+            self.packed_bytes += len(packed)
+            self.compress_cpu += elapsed
+        if len(packed) >= len(raw):
+            # incompressible, not worth the trouble
+            return value
+        return {MARKER: self.codec, "data": base64.b64encode(packed).decode('ascii')}
+
+    def decode(self, value):
+        ''' Turn a stored value back into what the client wrote '''
+        if not is_encoded(value):
+            return value
+        if value[MARKER] == "raw":
+            return value["data"]
+
+        decompress = _CODECS[value[MARKER]][1]
+        start = time.thread_time()
+        decoded = json.loads(decompress(base64.b64decode(value["data"])))
+        elapsed = time.thread_time() - start
+        with self.lock:
+            self.decompressed += 1
+            self.decompress_cpu += elapsed
+        return decoded
+
+    def stats(self):
+        with self.lock:
+            return {
+                "codec": self.codec,
+                "threshold": self.threshold,
+                "values-compressed": self.compressed,
+                "bytes-before": self.raw_bytes,
+                "bytes-after": self.packed_bytes,
+                "ratio": round(self.raw_bytes / self.packed_bytes, 3) if self.packed_bytes else None,
+                "compress-us-per-value": round(self.compress_cpu / self.compressed * 1e6, 1) if self.compressed else None,
+                "values-decompressed": self.decompressed,
+                "decompress-us-per-value": round(self.decompress_cpu / self.decompressed * 1e6, 1) if self.decompressed else None,
+            }
@@ -0,0 +1,103 @@
+import bisect
+import threading
+
+'''
+Ordered index over the keys of a KV store.
+
+Keys are kept in a list of sorted blocks (at most 2 * block_size keys each)
+plus a list with the largest key of every block. Finding a position is a
+bisect over the block maxes and one inside a block, so a range scan costs
+O(log n + k) and inserts/deletes only shift one small block.
+'''
+
+class SortedKeyIndex:
+    def __init__(self, keys=(), block_size=512):
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.rebuild(keys)
+
+    def rebuild(self, keys):
+        ''' Replace the whole index, e.g. after the store was replaced '''
+        ordered = sorted(set(keys))
+        blocks = [ ordered[i:i + self.block_size] for i in range(0, len(ordered), self.block_size) ]
+        with self.lock:
+            self.blocks = blocks
+            self.maxes = [ block[-1] for block in blocks ]
+            self.n_keys = len(ordered)
+
+    def add(self, key):
+        with self.lock:
+            if not self.blocks:
+                self.blocks.append([key])
+                self.maxes.append(key)
+                self.n_keys += 1
+                return
+            i = bisect.bisect_left(self.maxes, key)
+            if i == len(self.blocks):
+                i -= 1
+            block = self.blocks[i]
+            j = bisect.bisect_left(block, key)
+            if j < len(block) and block[j] == key:
+                return
+            block.insert(j, key)
+            self.maxes[i] = block[-1]
+            self.n_keys += 1
+            if len(block) > 2 * self.block_size:
+                half = len(block) // 2
+                self.blocks[i:i + 1] = [block[:half], block[half:]]
+                self.maxes[i:i + 1] = [block[half - 1], block[-1]]
+
+    def discard(self, key):
+        with self.lock:
+            i = bisect.bisect_left(self.maxes, key)
+            if i == len(self.blocks):
+                return
+            block = self.blocks[i]
+            j = bisect.bisect_left(block, key)
+            if j == len(block) or block[j] != key:
+                return
+            del block[j]
+            self.n_keys -= 1
+            if block:
+                self.maxes[i] = block[-1]
+            else:
+                del self.blocks[i]
+                del self.maxes[i]
+
+    def scan(self, start=None, end=None, prefix=None, after=None, limit=None):
+        ''' Keys in order, from `start` (inclusive) or `after` (exclusive) up
+            to `end` (exclusive), optionally only those starting with `prefix`.
+            Return:
+            - list of at most `limit` keys
+        '''
+        lower, inclusive = start, True
+        if prefix is not None and (lower is None or prefix > lower):
+            lower = prefix
+        if after is not None and (lower is None or after >= lower):
+            lower, inclusive = after, False
+
+        keys = []
+        with self.lock:
+            if lower is None:
+                i, j = 0, 0
+            else:
+                find = bisect.bisect_left if inclusive else bisect.bisect_right
+                i = find(self.maxes, lower)
+                j = find(self.blocks[i], lower) if i < len(self.blocks) else 0
+            while i < len(self.blocks):
+                block = self.blocks[i]
+                while j < len(block):
+                    key = block[j]
+                    if end is not None and key >= end:
+                        return keys
+                    if prefix is not None and not key.startswith(prefix):
+                        return keys
+                    keys.append(key)
+                    if limit is not None and len(keys) >= limit:
+                        return keys
+                    j += 1
+                i, j = i + 1, 0
+        return keys
+
+    def __len__(self):
+        return self.n_keys
@@ -0,0 +1,2 @@
+from .client import KVSClient, KVSError, shard_for
+from .aio import AsyncKVSClient
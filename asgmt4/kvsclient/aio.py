@@ -0,0 +1,50 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .client import KVSClient
+
+'''
+asyncio front of KVSClient: the same requests, awaited.
+
+Requests run on a pool of worker threads over the client's pooled
+connections, so up to `workers` of them are in flight at once and the event
+loop never blocks on a node. The shard map and causal metadata are the
+wrapped client's, shared with any synchronous use of it.
+'''
+
+class AsyncKVSClient:
+    def __init__(self, nodes=None, client=None, workers=10, **options):
+        '''
+        Parameters:
+         - nodes, options: what KVSClient takes, if no client is given
+         - client: a KVSClient to share
+         - workers: requests in flight at once
+        '''
+        self.client = client or KVSClient(nodes, pool_size=workers, **options)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="kvsclient")
+
+    async def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+    async def get(self, key):
+        return await self._call(self.client.get, key)
+
+    async def put(self, key, value, ttl=None):
+        return await self._call(self.client.put, key, value, ttl)
+
+    async def delete(self, key):
+        return await self._call(self.client.delete, key)
+
+    async def refresh(self):
+        return await self._call(self.client.refresh)
+
+    async def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
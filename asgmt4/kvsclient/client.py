@@ -0,0 +1,190 @@
+import hashlib
+import itertools
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+'''
+Shard-aware client for the sharded KV store.
+
+The client keeps its own copy of the shard map (GET /shard/map, or from
+older nodes GET /shard/ids and then GET /shard/members/<id> for each) and
+hashes keys the way the nodes do, so every request goes straight to a
+replica of the shard that owns the key instead of to any node that then
+forwards it. Requests name the shard in an
+X-Shard-Id header; a node that doesn't own the key by its map answers 421,
+and the client refreshes its map and tries again. The last try goes without
+the header, so a node with an older map than ours still serves it by
+forwarding.
+
+Causal metadata is kept by the client: every answer's metadata is merged in
+and sent along with the next request, to whichever shard.
+
+All nodes are reached through one requests.Session, which keeps a pool of
+keep-alive connections per node. A client is safe to share between threads.
+'''
+
+SHARD_HEADER = 'X-Shard-Id'
+
+
+class KVSError(Exception):
+    ''' The store didn't serve a request. status is the HTTP status of the
+        last answer, None if no node answered at all '''
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def shard_for(key, shard_ids):
+    ''' Return: the id in shard_ids that owns key, as the nodes compute it
+        (server.Server.KV_Store._hash); shard_ids in /shard/ids order '''
+    if not shard_ids:
+        return None
+    n = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+    return shard_ids[n % len(shard_ids)]
+
+
+class KVSClient:
+    def __init__(self, nodes, pool_size=10, timeout=5, retries=3, backoff=0.1):
+        '''
+        Parameters:
+         - nodes: addresses ("ip:port") of some nodes, to fetch the shard map from
+         - pool_size: keep-alive connections per node
+         - timeout: seconds for a node to answer
+         - retries: how many times a request is tried again after a stale
+           map, an unreachable shard or unmet causal dependencies
+         - backoff: seconds before the first retry, doubled every time
+        '''
+        self.seeds = list(nodes)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(self.seeds), 10), pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.lock = threading.Lock()
+        self.shard_ids = [] # in /shard/ids order, which the hash depends on
+        self.shard_members = {} # shard_id -> [addr]
+        self.map_etag = None # of the map we have, from GET /shard/map
+        self.causal_metadata = {}
+        self.turn = itertools.count() # spreads requests over a shard's replicas
+
+    def refresh(self):
+        ''' Fetch the shard map again, from the first node that has one '''
+        for addr in self._known_nodes():
+            try:
+                headers = {"If-None-Match": f'"{self.map_etag}"'} if self.map_etag else {}
+                res = self.session.get(f'http://{addr}/shard/map', headers=headers, timeout=self.timeout)
+                if res.status_code == 304:
+                    return
+                if res.status_code == 200:
+                    shard_map = res.json()
+                    if not shard_map["shard-ids"]:
+                        continue
+                    with self.lock:
+                        self.shard_ids = shard_map["shard-ids"]
+                        self.shard_members = shard_map["shards"]
+                        self.map_etag = res.headers.get("ETag", "").strip('"') or None
+                    return
+                # nodes without /shard/map
+                res = self.session.get(f'http://{addr}/shard/ids', timeout=self.timeout + 2)
+                shard_ids = res.json()["shard-ids"]
+                if not shard_ids:
+                    continue
+                shard_members = {}
+                for shard_id in shard_ids:
+                    res = self.session.get(f'http://{addr}/shard/members/{shard_id}', timeout=self.timeout)
+                    shard_members[shard_id] = res.json()["shard-members"]
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                continue
+            with self.lock:
+                self.shard_ids, self.shard_members = shard_ids, shard_members
+                self.map_etag = None
+            return
+        raise KVSError("no node has a shard map")
+
+    def _known_nodes(self):
+        with self.lock:
+            known = [ addr for shard_id in self.shard_ids for addr in self.shard_members[shard_id] ]
+        return list(dict.fromkeys(self.seeds + known))
+
+    def shard_of(self, key):
+        ''' Return: (shard id, its members) by our map, fetching it if we have none '''
+        if not self.shard_ids:
+            self.refresh()
+        with self.lock:
+            shard_id = shard_for(key, self.shard_ids)
+            return shard_id, list(self.shard_members[shard_id])
+
+    def get(self, key):
+        ''' Return: the value of key. Raises KeyError if there's none '''
+        res = self._request('GET', key, {})
+        if res.status_code == 404:
+            raise KeyError(key)
+        return res.json()["value"]
+
+    def put(self, key, value, ttl=None):
+        ''' Return: "created" or "replaced" '''
+        body = {"value": value}
+        if ttl is not None:
+            body["ttl"] = ttl
+        return self._request('PUT', key, body).json()["result"]
+
+    def delete(self, key):
+        ''' Raises KeyError if key doesn't exist '''
+        res = self._request('DELETE', key, {})
+        if res.status_code == 404:
+            raise KeyError(key)
+
+    def _request(self, method, key, body):
+        status, error = None, "no replica of the shard answered"
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            shard_id, members = self.shard_of(key)
+            with self.lock:
+                body["causal-metadata"] = dict(self.causal_metadata)
+            # the last try leaves routing to the node, in case its map is the stale one
+            headers = {SHARD_HEADER: shard_id} if attempt < self.retries else {}
+            start = next(self.turn)
+            for i in range(len(members)):
+                addr = members[(start + i) % len(members)]
+                try:
+                    res = self.session.request(method, f'http://{addr}/kvs/{key}', json=body,
+                                               headers=headers, timeout=self.timeout)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    continue
+                status = res.status_code
+                if status == 421 or status == 503:
+                    # 421: our map is stale. 503: the shard isn't formed yet or
+                    # hasn't caught up with our causal metadata
+                    error = res.json().get("error", error)
+                    break
+                self._observe(res)
+                if status in (200, 201, 404):
+                    return res
+                raise KVSError(res.json().get("error", f"{method} {key} failed"), status)
+            self.refresh()
+        raise KVSError(error, status)
+
+    def _observe(self, res):
+        ''' Merge the causal metadata of an answer into ours '''
+        try:
+            incoming = res.json().get("causal-metadata")
+        except ValueError:
+            return
+        if not incoming:
+            return
+        with self.lock:
+            for addr, clock in incoming.items():
+                self.causal_metadata[addr] = max(self.causal_metadata.get(addr, 0), clock)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
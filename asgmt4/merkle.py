@@ -0,0 +1,113 @@
+import hashlib
+import json
+import threading
+
+'''
+Merkle tree over the keys of a KV store, for anti-entropy between replicas.
+
+Keys are spread over fanout**depth leaves by a hash of the key. A leaf's
+hash is the XOR of the digests of its keys, and a digest covers the key
+and its version (the coordinator's timestamp of the write, which every
+replica keeps; keys that came without one use their value instead).
+An inner node's hash is the XOR of its children's, so a write only XORs
+the change into its leaf and the nodes above it: O(depth), no rehashing.
+
+Two replicas compare trees top-down: equal nodes are skipped, differing
+ones opened, and only the keys of the leaves that still differ change
+hands (see KV_Store.sync_with).
+
+Nodes are numbered like a heap: the root is 0 and the children of node i
+are fanout * i + 1 .. fanout * i + fanout.
+'''
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def stamp(value, version):
+    ''' What identifies a key's current state: its version, or its value
+        if it has none '''
+    return version if version is not None else json.dumps(value, sort_keys=True)
+
+
+class MerkleTree:
+    def __init__(self, fanout=16, depth=3):
+        self.fanout = fanout
+        self.depth = depth
+        self.n_leaves = fanout ** depth
+        self.first_leaf = (self.n_leaves - 1) // (fanout - 1)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.nodes = [0] * (self.first_leaf + self.n_leaves)
+            self.digests = {} # key -> digest
+            self.buckets = {} # leaf -> keys
+
+    def rebuild(self, items):
+        ''' Replace the whole tree. items: iterable of (key, stamp) '''
+        self.clear()
+        for key, key_stamp in items:
+            self.put(key, key_stamp)
+
+    def leaf(self, key) -> int:
+        return self.first_leaf + _hash64(key.encode('utf-8')) % self.n_leaves
+
+    def is_leaf(self, node) -> bool:
+        return node >= self.first_leaf
+
+    def children(self, node) -> range:
+        return range(self.fanout * node + 1, self.fanout * node + self.fanout + 1)
+
+    def put(self, key, key_stamp):
+        digest = _hash64(f"{key}\0{key_stamp!r}".encode('utf-8'))
+        leaf = self.leaf(key)
+        with self.lock:
+            old = self.digests.get(key, 0)
+            if old == digest:
+                return
+            self.digests[key] = digest
+            self.buckets.setdefault(leaf, set()).add(key)
+            self._toggle(leaf, old ^ digest)
+
+    def discard(self, key):
+        leaf = self.leaf(key)
+        with self.lock:
+            old = self.digests.pop(key, None)
+            if old is None:
+                return
+            bucket = self.buckets[leaf]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[leaf]
+            self._toggle(leaf, old)
+
+    def _toggle(self, node, delta):
+        while True:
+            self.nodes[node] ^= delta
+            if node == 0:
+                return
+            node = (node - 1) // self.fanout
+
+    def root(self) -> int:
+        return self.nodes[0]
+
+    def hashes(self, nodes) -> list:
+        ''' Return: for every node, the hashes of its children '''
+        with self.lock:
+            return [ [ self.nodes[child] for child in self.children(node) ] for node in nodes ]
+
+    def keys(self, leaves) -> list:
+        with self.lock:
+            return [ key for leaf in leaves for key in self.buckets.get(leaf, ()) ]
+
+    def diff(self, nodes, theirs) -> list:
+        ''' Children of nodes whose hashes differ from theirs (what
+            hashes(nodes) returned on the other side) '''
+        ours = self.hashes(nodes)
+        return [ child for node, mine, other in zip(nodes, ours, theirs)
+                 for child, a, b in zip(self.children(node), mine, other) if a != b ]
+
+    def __len__(self):
+        return len(self.digests)
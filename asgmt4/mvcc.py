@@ -0,0 +1,178 @@
+import heapq
+import threading
+from storage import StorageEngine, _MISSING
+
+'''
+Multi-version reads on top of any storage engine.
+
+Every write gets the next commit number. A reader that needs a consistent
+view of the whole store (fetchAll, resharding, /kvs/snapshot) takes a
+snapshot, which is just the commit number at that moment; it then sees the
+store exactly as it was then, however long it takes to walk it, while
+writers keep going.
+
+Old versions are only kept while someone could still need them: a write
+saves the value it replaces only if there is a snapshot that can see that
+value, and closing the last snapshot that could see a version frees it.
+With no readers around, writes cost one dict lookup more than the engine
+underneath.
+'''
+
+class MVCCEngine(StorageEngine):
+    def __init__(self, base: StorageEngine):
+        self.base = base
+        self.lock = threading.Lock()
+        self.commit = 0
+        self.history = {} # key -> [(replaced at commit, older value or _MISSING)], oldest first
+        self.readers = {} # commit a snapshot was taken at -> open snapshots at it
+
+    @property
+    def persistent(self):
+        return self.base.persistent
+
+    def _save(self, key):
+        ''' Keep the current value of key if an open snapshot can see it
+            (caller holds the lock and has already bumped self.commit) '''
+        if not self.readers:
+            return
+        versions = self.history.get(key)
+        if versions and versions[-1][0] > max(self.readers):
+            # what we'd save was written after every open snapshot
+            return
+        # not a read of the key: peek, so a cache underneath doesn't fault it in
+        self.history.setdefault(key, []).append((self.commit, self.base.peek(key, _MISSING)))
+
+    def put(self, key, value):
+        with self.lock:
+            self.commit += 1
+            self._save(key)
+            self.base.put(key, value)
+
+    def delete(self, key) -> bool:
+        with self.lock:
+            self.commit += 1
+            self._save(key)
+            return self.base.delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.commit += 1
+            if self.readers:
+                for key, _ in self.base.items():
+                    self._save(key)
+            self.base.clear()
+
+    def get(self, key, default=None):
+        return self.base.get(key, default)
+
+    def peek(self, key, default=None):
+        return self.base.peek(key, default)
+
+    def __contains__(self, key):
+        return key in self.base
+
+    def items(self):
+        return self.base.items()
+
+    def size(self) -> int:
+        return self.base.size()
+
+    def flush(self):
+        self.base.flush()
+
+    def close(self):
+        self.base.close()
+
+    def snapshot(self):
+        ''' Return: a read-only view of the store as of now; close it (or
+            use it in a with block) when done so old versions can go '''
+        with self.lock:
+            self.readers[self.commit] = self.readers.get(self.commit, 0) + 1
+            return MVCCSnapshot(self, self.commit, self.base.size())
+
+    def _read(self, key, commit, default):
+        with self.lock:
+            for replaced_at, value in self.history.get(key, ()):
+                if replaced_at > commit:
+                    return default if value is _MISSING else value
+            # snapshot reads (resharding, fetchAll) aren't uses of the key
+            return self.base.peek(key, default)
+
+    def _items(self, commit):
+        with self.lock:
+            # base.items() is fixed once called, and nothing is written while
+            # we hold the lock: what was written since the snapshot is in the
+            # history, which corrects the live view as it is streamed
+            current = self.base.items()
+            older = {}
+            for key, versions in self.history.items():
+                for replaced_at, value in versions:
+                    if replaced_at > commit:
+                        older[key] = value
+                        break
+        # keys deleted since the snapshot, merged in where they belong
+        missing = sorted((k, v) for k, v in older.items() if v is not _MISSING)
+        done = set() # keys of older already yielded
+        for key, value in heapq.merge(current, missing, key=lambda kv: kv[0]):
+            if key in older:
+                if key in done:
+                    continue
+                done.add(key)
+                value = older[key]
+                if value is _MISSING:
+                    continue
+            yield key, value
+
+    def _release(self, commit):
+        with self.lock:
+            self.readers[commit] -= 1
+            if not self.readers[commit]:
+                del self.readers[commit]
+            if not self.readers:
+                self.history.clear()
+                return
+            oldest = min(self.readers)
+            for key in list(self.history):
+                versions = [ v for v in self.history[key] if v[0] > oldest ]
+                if versions:
+                    self.history[key] = versions
+                else:
+                    del self.history[key]
+
+
+class MVCCSnapshot(StorageEngine):
+    ''' The store as of one commit. Read-only. '''
+    def __init__(self, engine: MVCCEngine, commit, n_keys):
+        self.engine = engine
+        self.commit = commit
+        self.n_keys = n_keys
+        self.closed = False
+
+    def get(self, key, default=None):
+        return self.engine._read(key, self.commit, default)
+
+    def items(self):
+        return self.engine._items(self.commit)
+
+    def size(self) -> int:
+        return self.n_keys
+
+    def put(self, key, value):
+        raise TypeError("snapshots are read-only")
+
+    def delete(self, key) -> bool:
+        raise TypeError("snapshots are read-only")
+
+    def clear(self):
+        raise TypeError("snapshots are read-only")
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.engine._release(self.commit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
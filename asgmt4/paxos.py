@@ -1,6 +1,7 @@
 import uuid
 from flask import Flask, request, jsonify
 import requests
+import peers
 import socket
 import logging
 import math
@@ -60,17 +61,16 @@ def send(results, addr, payload):
         Parameters:
         - results: a non-null array to store responses
         - addr: string of IP_ADDRESS:PORT to send the payload
-        - payload: must be JSON string
+        - payload: dict, sent as the JSON (or msgpack, see wire.py) body
         Return:
         - no return value. The responses are stored in results as
           results[addr] = response
           This is so that send() can be used in threads.
     '''
-    headers = {'Content-type': 'application/json'}
-    if ping(addr):  # check destination is alive
+    if peers.is_up(addr):  # cached liveness, see peers.py
         #logging.debug(f"[send] sending to {addr}: {json.dumps(payload)}")
         try:
-            resp = requests.post(f'http://{addr}/shard-alloc', json=json.dumps(payload), headers=headers, timeout=1)
+            resp = peers.post(f'http://{addr}/shard-alloc', json=payload, timeout=1)
             results[addr] = resp
             #logging.info(f"[send] recevied resp: {resp.status_code}, {resp.json()}")
         except requests.exceptions.Timeout as e:
@@ -0,0 +1,266 @@
+import os
+import socket
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import wire
+
+'''
+Keep-alive HTTP connections to the other nodes.
+
+Every peer ("ip:port") gets its own requests.Session with a connection pool
+of PEER_POOL_SIZE sockets, so forwarding, broadcasts, bulk pushes and paxos
+messages reuse open TCP connections instead of paying a handshake each time.
+Sessions nobody used for PEER_IDLE_TIMEOUT seconds are closed, which takes
+care of peers that left the view. A session with a request under way is
+never idle, however long the request takes; a streamed answer keeps its
+session in use until the caller closes it.
+
+Whether a peer is up is learned from the requests themselves: PeerPool
+reports every outcome to PeerHealth, and a peer whose requests keep failing
+to connect is marked down. Down peers are probed in the background until
+they answer again, so callers only ever read the cached state and never
+wait on a probe of their own.
+
+Bodies go out as msgpack to peers that have shown they read it, and
+msgpack answers are decoded by res.json() as usual (see wire.py).
+
+The module-level get/put/post/delete work like their requests.* namesakes
+(same arguments, same exceptions) on a pool shared by the whole process.
+'''
+
+PEER_POOL_SIZE = int(os.environ.get('PEER_POOL_SIZE', 10))
+PEER_IDLE_TIMEOUT = float(os.environ.get('PEER_IDLE_TIMEOUT', 60))
+# failed connections in a row before a peer counts as down, and how often
+# a down peer is probed
+PEER_FAILURE_THRESHOLD = int(os.environ.get('PEER_FAILURE_THRESHOLD', 1))
+PEER_PROBE_INTERVAL = float(os.environ.get('PEER_PROBE_INTERVAL', 1))
+
+
+class PeerHealth:
+    def __init__(self, failure_threshold=1, probe_interval=1.0, probe_timeout=1.0):
+        '''
+            Parameters:
+            - failure_threshold: connection failures in a row that mark a peer down
+            - probe_interval: seconds between background probes of a down peer
+            - probe_timeout: timeout of one probe (a TCP connect)
+        '''
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.failures = {} # "ip:port" -> connection failures in a row
+        self.down = set()
+        self.probing = set()
+        self.listeners = [] # called with the address of a peer that is back up
+
+    def is_up(self, addr) -> bool:
+        ''' Cached liveness; peers we know nothing about count as up '''
+        return addr not in self.down
+
+    def success(self, addr):
+        with self.lock:
+            self.failures.pop(addr, None)
+            recovered = addr in self.down
+            self.down.discard(addr)
+        if recovered:
+            with self.lock:
+                listeners = list(self.listeners)
+            for listener in listeners:
+                listener(addr)
+
+    def on_recovery(self, listener):
+        ''' Call listener(addr) whenever a peer is back up.
+            Return: a function that stops calling it '''
+        with self.lock:
+            self.listeners.append(listener)
+        def cancel():
+            with self.lock:
+                if listener in self.listeners:
+                    self.listeners.remove(listener)
+        return cancel
+
+    def failure(self, addr):
+        with self.lock:
+            self.failures[addr] = self.failures.get(addr, 0) + 1
+            if self.failures[addr] < self.failure_threshold or addr in self.down:
+                return
+            self.down.add(addr)
+            if addr in self.probing:
+                return
+            self.probing.add(addr)
+        threading.Thread(target=self._probe_loop, args=(addr,), daemon=True).start()
+
+    def forget(self, addr):
+        ''' addr left the view; stop tracking (and probing) it '''
+        with self.lock:
+            self.failures.pop(addr, None)
+            self.down.discard(addr)
+
+    def _probe_loop(self, addr):
+        while True:
+            time.sleep(self.probe_interval)
+            with self.lock:
+                if addr not in self.down:
+                    self.probing.discard(addr)
+                    return
+            if self._probe(addr):
+                with self.lock:
+                    self.probing.discard(addr)
+                self.success(addr)
+                return
+
+    def _probe(self, addr) -> bool:
+        host = addr.split(':')
+        try:
+            with socket.create_connection((host[0], int(host[1])), timeout=self.probe_timeout):
+                return True
+        except (OSError, ValueError, IndexError):
+            return False
+
+    def status(self) -> dict:
+        with self.lock:
+            return { "down": sorted(self.down), "failures": dict(self.failures) }
+
+
+class PeerPool:
+    def __init__(self, pool_size=10, idle_timeout=60.0, health: PeerHealth = None):
+        '''
+            Parameters:
+            - pool_size: connections kept open to each peer
+            - idle_timeout: seconds after which an unused peer's connections
+              are closed
+            - health: told about the outcome of every request
+        '''
+        self.health = health if health is not None else PeerHealth()
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.sessions = {}  # "ip:port" -> requests.Session
+        self.last_used = {} # "ip:port" -> time the last request started or ended
+        self.in_use = {}    # "ip:port" -> requests under way
+        self.last_sweep = time.monotonic()
+        self.wire_peers = set() # peers that answered in msgpack
+
+    def session(self, addr, hold=False):
+        '''
+            Parameters:
+            - hold: the caller uses the session until it calls release(addr);
+              a held session isn't swept
+        '''
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(addr)
+            if session is None:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                self.sessions[addr] = session
+            self.last_used[addr] = now
+            if hold:
+                self.in_use[addr] = self.in_use.get(addr, 0) + 1
+            idle = self._sweep(now)
+        for old in idle:
+            old.close()
+        return session
+
+    def release(self, addr):
+        with self.lock:
+            held = self.in_use.pop(addr, 0) - 1
+            if held > 0:
+                self.in_use[addr] = held
+            if addr in self.sessions:
+                self.last_used[addr] = time.monotonic()
+
+    def _sweep(self, now):
+        ''' Take idle sessions out of the pool (caller holds the lock).
+            Return: the sessions to close '''
+        if now - self.last_sweep < self.idle_timeout / 2:
+            return []
+        self.last_sweep = now
+        idle = [ addr for addr, used in self.last_used.items()
+                 if now - used > self.idle_timeout and addr not in self.in_use ]
+        for addr in idle:
+            del self.last_used[addr]
+        return [ self.sessions.pop(addr) for addr in idle ]
+
+    def request(self, method, url, **kwargs):
+        addr = urlsplit(url).netloc
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers['Accept'] = wire.ACCEPT
+        if wire.ENABLED and kwargs.get('json') is not None and addr in self.wire_peers:
+            kwargs['data'] = wire.encode(kwargs.pop('json'))
+            headers['Content-Type'] = wire.MIMETYPE
+        session = self.session(addr, hold=True)
+        try:
+            res = session.request(method, url, headers=headers, **kwargs)
+        except Exception as e:
+            self.release(addr)
+            if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout)):
+                self.health.failure(addr)
+            raise
+        if kwargs.get('stream'):
+            # the body is read after we return
+            _release_on_close(res, lambda: self.release(addr))
+        else:
+            self.release(addr)
+        # any answer, even an error status or a slow one, means the peer is alive
+        self.health.success(addr)
+        if wire.is_wire(res.headers.get('Content-Type')):
+            self.wire_peers.add(addr)
+            _decode_as_json(res)
+        return res
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            self.last_used.clear()
+            self.in_use.clear()
+        for session in sessions:
+            session.close()
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+def _release_on_close(res, release):
+    ''' Call release() (once) when res is closed '''
+    close = res.close
+    released = []
+    def closed():
+        close()
+        if not released:
+            released.append(True)
+            release()
+    res.close = closed
+
+
+def _decode_as_json(res):
+    ''' Make res.json() read the msgpack body (once) '''
+    body = []
+    def json(**kwargs):
+        if not body:
+            body.append(wire.decode(res.content))
+        return body[0]
+    res.json = json
+
+
+health = PeerHealth(PEER_FAILURE_THRESHOLD, PEER_PROBE_INTERVAL)
+pool = PeerPool(PEER_POOL_SIZE, PEER_IDLE_TIMEOUT, health)
+
+def is_up(addr) -> bool:
+    return health.is_up(addr)
+
+def get(url, **kwargs):
+    return pool.request('GET', url, **kwargs)
+
+def put(url, **kwargs):
+    return pool.request('PUT', url, **kwargs)
+
+def post(url, **kwargs):
+    return pool.request('POST', url, **kwargs)
+
+def delete(url, **kwargs):
+    return pool.request('DELETE', url, **kwargs)
@@ -1,16 +1,33 @@
 import os
 import requests
-import socket
-from flask import Flask, request, jsonify
+import peers
+from flask import Flask, request, jsonify, send_file
+from werkzeug.serving import WSGIRequestHandler
 import json
 from paxos import Proposer, Acceptor
+from wal import WriteAheadLog
+from storage import open_engine
+from snapshot import Snapshot, SnapshotEngine, write_snapshot
+from index import SortedKeyIndex
+from ttl import TimerWheel
+from compress import ValueCodec
+from tombstone import TombstoneTable
+from mvcc import MVCCEngine
+from aserver import AsyncServer, deferred_replication
+from stream import ReplicationStream, StreamReceiver
+from merkle import MerkleTree, stamp
+import wire
 import math
 import random
 import hashlib
 import logging
 import sys
 import time
+import threading
+import queue
+import zlib
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 DEBUG=os.environ.get('DEBUG')
 logging.getLogger().addHandler(logging.FileHandler('app.log'))
@@ -26,9 +43,106 @@ VIEW = os.environ.get('VIEW')
 SHARD_COUNT = os.environ.get('SHARD_COUNT') # must decide how to organize view into shards
 SHARD_NAMES = ['alligator','buffalo','cat',"dog",'elephant','fox','goat','horse','iguana','jaguar']
 
+# write-ahead log is off unless WAL_DIR is set
+WAL_DIR = os.environ.get('WAL_DIR')
+WAL_GROUP_COMMIT_MS = int(os.environ.get('WAL_GROUP_COMMIT_MS', 5))
+WAL_CHECKPOINT_EVERY = int(os.environ.get('WAL_CHECKPOINT_EVERY', 10000))
+
+# storage backend behind KV_Store: "dict" or "lsm"
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'dict')
+STORAGE_DIR = os.environ.get('STORAGE_DIR', 'data')
+LSM_MEMTABLE_LIMIT = int(os.environ.get('LSM_MEMTABLE_LIMIT', 10000))
+# STORAGE_ENGINE=lsm merges LSM_COMPACTION_TRIGGER segments of about the
+# same size into one
+LSM_COMPACTION_TRIGGER = int(os.environ.get('LSM_COMPACTION_TRIGGER', 4))
+# STORAGE_ENGINE=tiered: memory the store may use before cold entries
+# are moved to SPILL_DIR, and how they are picked ("lru" or "lfu").
+# SPILL_DIR survives a restart only if WAL_DIR is set; without a WAL it is
+# wiped and the node starts empty
+MEMORY_BUDGET_MB = float(os.environ.get('MEMORY_BUDGET_MB', 256))
+EVICTION_POLICY = os.environ.get('EVICTION_POLICY', 'lru')
+SPILL_DIR = os.environ.get('SPILL_DIR', 'spill')
+
+# "flask" (threaded dev server) or "async" (see aserver.py). async only
+# moves the /kvs/<key> data path onto the event loop; cluster routes,
+# replication streams, the compactor and anti-entropy still run on threads
+SERVER_MODE = os.environ.get('SERVER_MODE', 'flask')
+
+# binary snapshots served on /kvs/snapshot and pulled by joining nodes
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+
+# GET /kvs/fetchAll?format=ndjson sends the store in lines of this many
+# keys; a receiver resumes a broken transfer up to FETCH_RETRIES times
+FETCH_CHUNK_KEYS = int(os.environ.get('FETCH_CHUNK_KEYS', 1000))
+FETCH_RETRIES = int(os.environ.get('FETCH_RETRIES', 3))
+
+# every ANTI_ENTROPY_MS each node compares its Merkle tree with a random
+# shard member's and pulls the keys of the leaves that differ, at most
+# ANTI_ENTROPY_LEAVES leaves per request (0 turns the periodic run off)
+ANTI_ENTROPY_MS = int(os.environ.get('ANTI_ENTROPY_MS', 30000))
+ANTI_ENTROPY_LEAVES = int(os.environ.get('ANTI_ENTROPY_LEAVES', 256))
+
+# longest a GET /shard/map?wait= long poll is held open, in seconds
+SHARD_MAP_MAX_WAIT = float(os.environ.get('SHARD_MAP_MAX_WAIT', 30))
+
+# page size limits of GET /kvs range scans
+SCAN_DEFAULT_LIMIT = 100
+SCAN_MAX_LIMIT = 1000
+
+# most operations one POST /kvs/batch may carry
+BATCH_MAX_OPS = int(os.environ.get('BATCH_MAX_OPS', 1000))
+# seconds another shard may take over its part of a batch
+BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', 30))
+
+# resolution of the key expiry timer wheel (PUT with "ttl")
+TTL_TICK_MS = int(os.environ.get('TTL_TICK_MS', 100))
+
+# values whose JSON is at least this many bytes are kept and sent
+# compressed (0 = never)
+COMPRESS_THRESHOLD = int(os.environ.get('COMPRESS_THRESHOLD', 1024))
+COMPRESS_CODEC = os.environ.get('COMPRESS_CODEC', 'zlib')
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+
+# how often unacknowledged deletes are re-sent to shard members, and how
+# many go out in one request
+TOMBSTONE_SYNC_MS = int(os.environ.get('TOMBSTONE_SYNC_MS', 1000))
+TOMBSTONE_BATCH = int(os.environ.get('TOMBSTONE_BATCH', 500))
+
+# writes go to all shard members at once; the client is answered once
+# REPLICATION_ACKS of them have it: "one" (just this node), "quorum" (a
+# majority of the shard, this node included) or "all". A request can pick
+# its own with "acks" in the body.
+ACK_POLICIES = ('one', 'quorum', 'all')
+REPLICATION_ACKS = os.environ.get('REPLICATION_ACKS', 'all')
+REPLICATION_WORKERS = int(os.environ.get('REPLICATION_WORKERS', 16))
+# a replica that failed is sent the write again after REPLICATION_RETRY_MS,
+# doubling every time, up to REPLICATION_RETRIES times
+REPLICATION_RETRY_MS = int(os.environ.get('REPLICATION_RETRY_MS', 200))
+REPLICATION_RETRIES = int(os.environ.get('REPLICATION_RETRIES', 5))
+# writes go to each replica over one ordered stream (stream.py) instead of
+# a request per write; REPLICATION_STREAM=0 goes back to the requests.
+# A client waits at most REPLICATION_ACK_TIMEOUT_MS for the acks it asked
+# for, the stream keeps going after that.
+REPLICATION_STREAM = os.environ.get('REPLICATION_STREAM', '1') != '0'
+REPLICATION_ACK_TIMEOUT_MS = int(os.environ.get('REPLICATION_ACK_TIMEOUT_MS', 1000))
+REPLICATION_BATCH = int(os.environ.get('REPLICATION_BATCH', 500))
+REPLICATION_BACKLOG = int(os.environ.get('REPLICATION_BACKLOG', 100000))
+# collect writes for this long before streaming them, so a key overwritten
+# many times within the window goes out once (0: no window)
+REPLICATION_COALESCE_MS = float(os.environ.get('REPLICATION_COALESCE_MS', 0))
+# writes for a replica that is down or more than REPLICATION_BACKLOG behind
+# are spilled to a file in BACKLOG_DIR (up to BACKLOG_MAX_MB per replica)
+# and sent in order once it is back; BACKLOG_DIR='' drops them instead.
+# The files only stand in for memory: they start empty on every run, and
+# what a replica missed across a restart is left to anti-entropy
+BACKLOG_DIR = os.environ.get('BACKLOG_DIR', 'backlog')
+BACKLOG_MAX_MB = float(os.environ.get('BACKLOG_MAX_MB', 64))
+
 class Server:
     def __init__(self, name):
         self.app = Flask(name)
+        # peers talk msgpack to each other, clients JSON
+        wire.install(self.app)
         with self.app.app_context():
             self.view = self.View(self.app)
             self.kv_store = self.KV_Store(self.app, self.view)
@@ -59,6 +173,10 @@ class Server:
                 
         @self.app.route('/kvs/<key>', methods=['PUT', 'GET', 'DELETE'])
         def kvs_api(key):
+            body = request.get_json(silent=True) if request.method != 'GET' else None
+            error = self.kv_store.check_request(request.method, key, body, request.headers.get('X-Shard-Id'))
+            if error is not None:
+                return jsonify(error[0]), error[1]
             if request.method == 'PUT':
                 try:
                     # self.app.logger.info(f"Received PUT request on socket {SOCKET_ADDRESS}: {request.json}")
@@ -67,8 +185,12 @@ class Server:
                     broadcast = None
                     if 'broadcast' in request.json:
                         broadcast = request.json['broadcast']
-                        
-                    res = self.kv_store.put(key, value, request.json, broadcast)
+                    body = self.kv_store._trusted(request.json, broadcast is False)
+
+                    res = self.kv_store.put(key, value, body, broadcast)
+                    if isinstance(res, tuple):
+                        # handled here rather than forwarded
+                        return res
                     data, status_code = res["data"], res["status_code"]
                     logging.info(f"Successful PUT {key} {status_code}:\n\t{data}")
 
@@ -91,22 +213,101 @@ class Server:
             if request.method == 'DELETE':
                 try:
                     # self.app.logger.info(f"Received DELETE request on socket {SOCKET_ADDRESS}: {request.json}")
-                    value = request.json['value']
-                    return self.kv_store.put(key, value, request.json, 'broadcast' in request.json)
-                except KeyError as e:
-                    logging.warning(f"error: {e}")
-                    return jsonify({"error": "DELETE request does not specify a value"}), 400
+                    body = body or {}
+                    # replicas get "broadcast": False, clients and forwards don't
+                    from_peer = body.get('broadcast') is False
+                    res = self.kv_store.delete(key, self.kv_store._trusted(body, from_peer), from_peer)
+                    if isinstance(res, dict):
+                        return res["data"], res["status_code"]
+                    return res
                 except Exception as e1:
                     logging.error(f"Something BAD went wrong:\n\t{e1}")
 
+        @self.app.get('/kvs')
+        def kvs_scan():
+            try:
+                limit = int(request.args.get('limit', SCAN_DEFAULT_LIMIT))
+            except ValueError:
+                return jsonify({"error": "'limit' must be a positive integer"}), 400
+            if limit <= 0:
+                return jsonify({"error": "'limit' must be a positive integer"}), 400
+            return self.kv_store.scan(request.args.get('start'), request.args.get('end'),
+                                      request.args.get('prefix'), min(limit, SCAN_MAX_LIMIT),
+                                      request.args.get('cursor'))
+
         @self.app.get('/kvs/fetchAll')
         def kvs_fetch_all():
+            if request.args.get('format') == 'ndjson':
+                return self.kv_store.fetch_all_stream(request.args.get('cursor'),
+                                                      'gzip' in request.headers.get('Accept-Encoding', ''))
             return self.kv_store.fetch_all()      
 
+        @self.app.get('/kvs/snapshot')
+        def kvs_snapshot():
+            return self.kv_store.send_snapshot()
+
+        @self.app.get('/kvs/stats')
+        def kvs_stats():
+            return self.kv_store.stats()
+
+        @self.app.post('/kvs/tombstones')
+        def kvs_tombstones():
+            try:
+                return self.kv_store.apply_tombstones(request.json["tombstones"], request.json.get("socket_address"))
+            except KeyError:
+                return jsonify({"error": "POST /kvs/tombstones must specify 'tombstones' in body"}), 400
+
+        @self.app.post('/kvs/batch')
+        def kvs_batch():
+            body = request.get_json(silent=True) or {}
+            ops = body.get("ops")
+            if not isinstance(ops, list) or not ops:
+                return jsonify({"error": "POST /kvs/batch must specify a non-empty list 'ops' in body"}), 400
+            if len(ops) > BATCH_MAX_OPS:
+                return jsonify({"error": f"at most {BATCH_MAX_OPS} operations per batch"}), 400
+            if body.get('acks', REPLICATION_ACKS) not in ACK_POLICIES:
+                return jsonify({"error": f"'acks' must be one of {', '.join(ACK_POLICIES)}"}), 400
+            for i, op in enumerate(ops):
+                if not isinstance(op, dict) or op.get("op") not in ('GET', 'PUT', 'DELETE') \
+                        or not isinstance(op.get("key"), str):
+                    return jsonify({"error": f"ops[{i}] needs an 'op' (GET, PUT or DELETE) and a 'key'"}), 400
+                if op["op"] == 'PUT' and "value" not in op:
+                    return jsonify({"error": f"ops[{i}] is a PUT without a 'value'"}), 400
+                ttl = op.get('ttl')
+                if ttl is not None and (isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0):
+                    return jsonify({"error": f"ops[{i}]: 'ttl' must be a positive number of seconds"}), 400
+            return self.kv_store.batch(ops, body.get("causal-metadata"), body.get("acks"))
+
+        @self.app.post('/kvs/replicate')
+        def kvs_replicate():
+            body = request.get_json(silent=True) or {}
+            if not body.get("from") or "stream" not in body or not isinstance(body.get("entries"), list):
+                return jsonify({"error": "POST /kvs/replicate must specify 'from', 'stream' and 'entries' in body"}), 400
+            ack = self.kv_store.receiver.receive(body["from"], body["stream"], body["entries"], body.get("floor", 1))
+            return jsonify({"ack": ack}), 200
+
+        @self.app.post('/kvs/merkle')
+        def kvs_merkle():
+            nodes = (request.get_json(silent=True) or {}).get("nodes", [])
+            merkle = self.kv_store.merkle
+            if not isinstance(nodes, list) or any(not isinstance(n, int) or n < 0 or merkle.is_leaf(n) for n in nodes):
+                return jsonify({"error": "'nodes' must be a list of inner node numbers"}), 400
+            return jsonify({"root": merkle.root(), "children": merkle.hashes(nodes),
+                            "causal-metadata": self.kv_store.local_causal_metadata}), 200
+
+        @self.app.post('/kvs/merkle/leaves')
+        def kvs_merkle_leaves():
+            leaves = (request.get_json(silent=True) or {}).get("leaves")
+            if not isinstance(leaves, list):
+                return jsonify({"error": "POST /kvs/merkle/leaves must specify 'leaves' in body"}), 400
+            return self.kv_store.leaf_contents(leaves)
+
         @self.app.put('/kvs/loadAll')
         def kvs_load_all():
             try:
-                return self.kv_store.load_all(request.json["kvs"])      
+                self.kv_store.load_all(request.json["kvs"], request.json.get("expires-at"),
+                                       request.json.get("versions"), request.json.get("tombstones"))
+                return jsonify({"result": "loaded", "kv_size": self.kv_store.size()}), 200
             except KeyError:
                 return jsonify({"error": "PUT /kvs/loadAll must specify 'kvs' in body"}), 404
             
@@ -114,6 +315,19 @@ class Server:
         def shard_query_all():
             return self.shard.get("ids")
         
+        @self.app.get('/shard/map')
+        def shard_map():
+            # ?wait=<seconds> with If-None-Match holds the request until the
+            # map changes (or the time is up, then 304)
+            wait = min(request.args.get('wait', 0, type=float), SHARD_MAP_MAX_WAIT)
+            etag, shards = self.shard.map_after(request.if_none_match, wait)
+            if request.if_none_match.contains(etag):
+                res = self.app.response_class(status=304)
+            else:
+                res = jsonify({"shard-ids": list(shards), "shards": shards})
+            res.set_etag(etag)
+            return res
+
         @self.app.get('/shard/node-shard-id')
         def shard_query_one():
             return self.shard.get("id")
@@ -197,7 +411,13 @@ class Server:
             # this one and KV_Store. Instead, we use the callback
             # as the bridge between the two.
             self.shard_members: dict = {} # shard_id -> [addr]
-            
+            # what GET /shard/map serves: the map as of the last change and
+            # an ETag of its contents (no counter: a count of changes seen
+            # by this process means nothing on another node or after a restart)
+            self.map_cond = threading.Condition()
+            self.map_published = {}
+            self.map_etag = self._map_etag(self.map_published)
+
             # decide if it wants to be a Proposer
             self.is_proposer = False
             if self.address:
@@ -235,7 +455,7 @@ class Server:
             logging.info(f"###### {self.address} sending {self.shard_members}")
             results = self.acceptor.send_accepted(payload)
             self.proposer.proposal_number += 1
-            self.notify("shard_members", self.shard_members)
+            self._map_changed()
             #self.kvs.update_shard_info(self.shard_members)
 
             return jsonify({"result": "resharded"})
@@ -328,13 +548,15 @@ class Server:
             logging.info(f"##### [_redistribute_shards] shars = {shards}")
             return shards
 
-        def on_paxos_msg(self, message: str):
+        def on_paxos_msg(self, message: dict):
             ''' Parameters:
-                - message: string representation of a JSON object 
+                - message: the decoded body of the request
                 Return:
                 - a dict object so that the caller to this method can use jsonify()
             '''
-            message = json.loads(message)
+            if isinstance(message, str):
+                # older nodes send the JSON encoded twice
+                message = json.loads(message)
             #logging.info(f"##### {message} is of type {type(message)}")
             msg_type = message["type"]
             match msg_type:
@@ -406,11 +628,39 @@ class Server:
             #    if old_members and new_member in old_members:
             #        to_update = False
             #        break
+            logging.info(f"[_populate_shards] notify {self.shard_members}")
+            #self.kvs.update_shard_info(self.shard_members)
+            self._map_changed()
+            self._done_processing_accepted(proposal)
+
+        def _map_changed(self):
+            ''' Hand the new map to KV_Store, then publish it on /shard/map '''
             if self.notify:
-                logging.info(f"[_populate_shards] notify {self.shard_members}")
-                #self.kvs.update_shard_info(self.shard_members)
                 self.notify("shard_members", self.shard_members)
-            self._done_processing_accepted(proposal)
+            # hash order of the shards is part of the map
+            shards = { shard_id: list(members) for shard_id, members in self.shard_members.items() }
+            etag = self._map_etag(shards)
+            with self.map_cond:
+                if etag == self.map_etag:
+                    return
+                self.map_published, self.map_etag = shards, etag
+                self.map_cond.notify_all()
+            logging.info(f"[_map_changed] shard map {etag}: {shards}")
+
+        def _map_etag(self, shards):
+            return hashlib.sha1(json.dumps(list(shards.items())).encode('utf-8')).hexdigest()[:16]
+
+        def map_after(self, known, wait):
+            '''
+            Parameters:
+             - known: ETags the caller has (request.if_none_match)
+             - wait: seconds to wait for a map that isn't one of them
+            Return: (etag, shards) of the current map
+            '''
+            with self.map_cond:
+                if wait > 0:
+                    self.map_cond.wait_for(lambda: not known.contains(self.map_etag), timeout=wait)
+                return self.map_etag, self.map_published
 
         def _proposal_to_key(self, proposal):
             return f"{proposal['sender_id']}-{proposal['number']}"
@@ -471,7 +721,7 @@ class Server:
                     result = None                        
                     for member in members:
                         try:
-                            resp = requests.get(f'http://{member}/shard/key-count/{id}', 
+                            resp = peers.get(f'http://{member}/shard/key-count/{id}', 
                                         headers={'Content-type': 'application/json'}, 
                                         timeout=0.1)
                             result = resp.json()
@@ -510,8 +760,7 @@ class Server:
                 results = self.acceptor.send_accepted(payload, destinations)
 
             # add the address to the appropriate shard
-            if self.notify:
-                self.notify("shard_members", self.shard_members)
+            self._map_changed()
             #self.kvs.update_shard_info(self.shard_members)    
             return jsonify({"result": "node added to shard"}), 200
             
@@ -519,7 +768,15 @@ class Server:
         def __init__(self, app, view):
             self.app = app
             self.view = view
-            self.kvs = {}
+            # MVCC on top of the engine lets long reads (fetchAll, resharding,
+            # snapshots) see one consistent state without holding up writes
+            self.kvs = MVCCEngine(self._open_engine())
+            # large values are stored (and sent to peers) compressed
+            self.codec = ValueCodec(COMPRESS_THRESHOLD, COMPRESS_CODEC, COMPRESS_LEVEL)
+            # bumped on every mutation so /kvs/snapshot knows when to rebuild
+            self.mutations = 0
+            self.snapshot_mutations = None
+            self.snapshot_lock = threading.Lock()
             self.address = SOCKET_ADDRESS
             self.shard_id = None
             # shard_members replace views for kvs purposes
@@ -531,6 +788,56 @@ class Server:
             # views are still necessary to check causal dependency
             self.local_causal_metadata = {replica: 0 for replica in views}
 
+            # deadlines of keys written with a TTL; the thread that expires
+            # them is only started once there is something to expire
+            self.expiry = TimerWheel(TTL_TICK_MS / 1000.0, now=time.time())
+            self.expiry_thread = None
+            # held while a key is written, deleted or expired, so expire()
+            # can't drop a write that came in after the key's deadline passed
+            self.write_lock = threading.RLock()
+
+            # version of the last write of every key and tombstones of
+            # deleted keys, so stale copies of deleted keys are recognised
+            self.versions = {}
+            self.clock = 0.0
+            self.tombstones = TombstoneTable()
+            self.compactor_thread = None
+
+            # writes are sent to the other shard members in parallel
+            self.replicator = ThreadPoolExecutor(REPLICATION_WORKERS, thread_name_prefix='replicate')
+            # and the parts of a batch to the shards that own them
+            self.scatter = ThreadPoolExecutor(REPLICATION_WORKERS, thread_name_prefix='scatter')
+            self.md_lock = threading.Lock()
+            # or over a stream per replica; a restarted node starts new ones
+            self.stream_id = f"{time.time_ns():x}"
+            self.streams = {}
+            self.streams_lock = threading.Lock()
+            self.receiver = StreamReceiver(self._apply_replicated)
+            # peers.health is shared by every store in the process; close()
+            # takes the listener off again
+            self.stop_listening = peers.health.on_recovery(self._peer_recovered)
+            self.ack_timeout = REPLICATION_ACK_TIMEOUT_MS / 1000.0
+
+            # replaying the WAL lets a restarted node come back with its
+            # data instead of pulling the whole store from a shard peer
+            self.wal = None
+            self.recovered = False
+            expiries, versions, tombstones = {}, {}, {}
+            if WAL_DIR:
+                self.wal = WriteAheadLog(WAL_DIR, WAL_GROUP_COMMIT_MS, WAL_CHECKPOINT_EVERY)
+                _, causal_metadata = self.wal.replay(self.kvs, expiries, versions, tombstones)
+                if causal_metadata:
+                    for replica in self.local_causal_metadata:
+                        self.local_causal_metadata[replica] = causal_metadata.get(replica, 0)
+                self.recovered = bool(self.kvs) or causal_metadata is not None
+
+            # ordered view of our keys for range/prefix scans
+            self.index = SortedKeyIndex()
+            # and a hash tree of them to compare with the other replicas
+            self.merkle = MerkleTree()
+            self.anti_entropy_thread = None
+            self._rebuild_derived(expiries, versions, tombstones)
+
             print(f"Broadcasting replica {SOCKET_ADDRESS} with view {views}")
             # broadcast view to other replicas
             for view in views:
@@ -540,13 +847,178 @@ class Server:
                 try:
                     # print(f"Sending PUT /view to socket {view}")
                     #res = requests.put(f'http://{view}/view', json={"socket_address": SOCKET_ADDRESS}, timeout=1)
-                    res = requests.put(f'http://{view}/view', json={"socket_address": SOCKET_ADDRESS}, timeout=0.1)
+                    res = peers.put(f'http://{view}/view', json={"socket_address": SOCKET_ADDRESS}, timeout=0.1)
 
                 except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                     print(f"Failed to connect to socket {view}")
             
             # must wait for shards to form before we can update shard memberships
 
+        def _store(self, key, value, expires_at=None, version=None):
+            ''' Apply a write locally: engine, ordered index, expiry timer
+                and version (a write supersedes the key's tombstone) '''
+            with self.write_lock:
+                self.kvs.put(key, value)
+                self.index.add(key)
+                if expires_at is None:
+                    self.expiry.cancel(key)
+                else:
+                    self.expiry.schedule(key, expires_at)
+                    self._start_expiry()
+                if version is None:
+                    self.versions.pop(key, None)
+                else:
+                    self.versions[key] = version
+                self.tombstones.discard(key)
+                self.merkle.put(key, stamp(value, version))
+
+        def _remove(self, key) -> bool:
+            ''' Apply a delete locally. Return: True if the key was there '''
+            with self.write_lock:
+                existed = self.kvs.delete(key)
+                self.index.discard(key)
+                self.expiry.cancel(key)
+                self.versions.pop(key, None)
+                self.merkle.discard(key)
+                return existed
+
+        def _bury(self, key, version, acked=()) -> bool:
+            ''' Apply a versioned delete: leave a tombstone and drop the key,
+                unless what we hold was written after the delete.
+                Return:
+                - True if a value was removed
+            '''
+            self._observe(version)
+            if self.versions.get(key, 0) > version:
+                return False
+            self.tombstones.add(key, version, acked)
+            self._start_compactor()
+            return self._remove(key)
+
+        def _new_version(self):
+            ''' Version for a write or delete we coordinate: wall clock time,
+                but never behind a version we've already seen '''
+            self.clock = max(time.time(), self.clock + 1e-6)
+            return self.clock
+
+        def _observe(self, version):
+            if version is not None and version > self.clock:
+                self.clock = version
+
+        def _rebuild_derived(self, expiries: dict = None, versions: dict = None, tombstones: dict = None):
+            ''' Rebuild the index, the expiry timers and the versions after
+                the whole store has been replaced '''
+            self.index.rebuild(self.kvs.keys())
+            self.expiry = TimerWheel(TTL_TICK_MS / 1000.0, now=time.time())
+            for key, expires_at in (expiries or {}).items():
+                if key in self.kvs:
+                    self.expiry.schedule(key, expires_at)
+            if len(self.expiry):
+                self._start_expiry()
+            self.versions = { key: version for key, version in (versions or {}).items() if key in self.kvs }
+            self.tombstones = TombstoneTable(tombstones)
+            for version in list(self.versions.values()) + list(self.tombstones.versions.values()):
+                self._observe(version)
+            if len(self.tombstones):
+                self._start_compactor()
+            self.merkle.rebuild((key, stamp(None if key in self.versions else self.kvs.get(key), self.versions.get(key)))
+                                for key in self.kvs.keys())
+
+        def _start_compactor(self):
+            if self.compactor_thread is None:
+                self.compactor_thread = threading.Thread(target=self._compact_loop, daemon=True)
+                self.compactor_thread.start()
+
+        def _compact_loop(self):
+            while True:
+                time.sleep(TOMBSTONE_SYNC_MS / 1000.0)
+                try:
+                    self.compact_tombstones()
+                except Exception as e:
+                    logging.warning(f"[compact_tombstones] {e}")
+
+        def compact_tombstones(self):
+            ''' Re-send deletes that shard members haven't acknowledged yet,
+                then drop the tombstones everyone has.
+                Return:
+                - the keys whose tombstones were dropped
+            '''
+            members = self._shard_members()
+            if not members:
+                # no view yet (e.g. at boot): we can't tell who has acked
+                # or which keys are still ours
+                return []
+            for addr in members:
+                if addr == self.address:
+                    continue
+                batch = self.tombstones.pending(addr, TOMBSTONE_BATCH)
+                if not batch:
+                    continue
+                try:
+                    res = peers.post(f'http://{addr}/kvs/tombstones', timeout=1,
+                                        json={"tombstones": batch, "socket_address": self.address})
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    logging.info(f"[compact_tombstones] {addr} unreachable, {len(batch)} deletes pending")
+                    continue
+                if res.status_code == 200:
+                    for key in res.json()["acked"]:
+                        self.tombstones.ack(key, batch[key], addr)
+            dropped = self.tombstones.compact(members, lambda key: self._hash(key) == self.shard_id)
+            if dropped:
+                logging.info(f"[compact_tombstones] dropped {len(dropped)} tombstones")
+            return dropped
+
+        def apply_tombstones(self, batch: dict, sender=None):
+            ''' Deletes re-sent by a shard member's compactor '''
+            acked = {self.address, sender} if sender else {self.address}
+            removed = {}
+            for key, version in batch.items():
+                if self._bury(key, version, acked):
+                    removed[key] = None
+            self._log("DELETE", removed)
+            return jsonify({"acked": list(batch)}), 200
+
+        def _start_expiry(self):
+            if self.expiry_thread is None:
+                self.expiry_thread = threading.Thread(target=self._expire_loop, daemon=True)
+                self.expiry_thread.start()
+
+        def _expire_loop(self):
+            while True:
+                time.sleep(TTL_TICK_MS / 1000.0)
+                self.expire(time.time())
+
+        def expire(self, now):
+            ''' Drop keys whose TTL ran out. Every replica got the same
+                absolute deadline with the write, so each one expires the key
+                by itself; nothing is broadcast and the causal metadata
+                doesn't move.
+            '''
+            # a write that takes the lock after advance() finds the key gone
+            # and stores it anew; one that got it before moved the deadline
+            with self.write_lock:
+                expired = self.expiry.advance(now)
+                for key in expired:
+                    self._remove(key)
+                if expired:
+                    # logged before such a write logs its PUT
+                    self._log("DELETE", {key: None for key in expired})
+            if expired:
+                logging.info(f"[expire] {len(expired)} keys expired")
+            return expired
+
+        def _open_engine(self):
+            if STORAGE_ENGINE == 'lsm':
+                return open_engine('lsm', STORAGE_DIR,
+                                   memtable_limit=LSM_MEMTABLE_LIMIT,
+                                   compaction_trigger=LSM_COMPACTION_TRIGGER)
+            if STORAGE_ENGINE == 'tiered':
+                # with a WAL to replay on top, what was spilled is kept
+                return open_engine('tiered', SPILL_DIR,
+                                   budget_bytes=int(MEMORY_BUDGET_MB * 2**20),
+                                   policy=EVICTION_POLICY, keep=bool(WAL_DIR))
+            return open_engine(STORAGE_ENGINE)
+
         def _shard_members(self, shard_id=None):
             ''' Get the members in our own shard '''
             if shard_id is None:
@@ -572,34 +1044,63 @@ class Server:
                     break
 
             logging.info(f"##### {self.address} belongs to {self.shard_id} with {self.shard_members[self.shard_id]}")
-            for member in self.shard_members[self.shard_id]:
-                if member != self.address and self.replicate_kvs(member):                    
-                    if self.kvs:
+            if self.recovered:
+                # state came back from the WAL, no need to pull it over the network
+                logging.info(f"[update_shard_info] {self.address} recovered {self.kvs.size()} keys from WAL")
+                self.recovered = False
+            else:
+                for member in self.shard_members[self.shard_id]:
+                    if member == self.address:
+                        continue
+                    if self.kvs.size() and self.sync_with(member) is not None:
+                        # we have data already: only what differs comes over
                         break
+                    if self.replicate_kvs(member):
+                        if self.kvs:
+                            break
+            self._start_anti_entropy()
             logging.info(f"[update_shard_info] KV_Store shards = {self.shard_members}")
 
             # each member must cleanse its kvs of keys that don't hash into it
-            popped = self._cleanse_data()
+            popped, expiries, versions = self._cleanse_data()
             logging.info(f"{shard_id}, popped = {popped}")
             for shard_id in popped:
                 key_val_pairs = popped[shard_id]
                 if key_val_pairs:
-                    self._bulk_push(shard_id, key_val_pairs)
+                    self._bulk_push(shard_id, key_val_pairs, expiries, versions)
 
             if results:
                 results["status"] = "done"
 
         def _cleanse_data(self):
+            ''' Return:
+                - (shard_id -> {key: value} of the keys we dropped,
+                   key -> expiry time for the dropped keys that have a TTL,
+                   key -> version of the dropped keys)
+            '''
             popped = {}
-            for key in list(self.kvs):
-                hashed = self._hash(key)
-                if hashed != self.shard_id:
-                    if hashed not in popped:
-                        popped[hashed] = {}
-                    popped[hashed][key] = self.kvs.pop(key)
-            return popped
-
-        def _bulk_push(self, shard_id, data: dict):
+            expiries = {}
+            versions = {}
+            with self.kvs.snapshot() as snapshot:
+                for key, value in snapshot.items():
+                    hashed = self._hash(key)
+                    if hashed != self.shard_id:
+                        if hashed not in popped:
+                            popped[hashed] = {}
+                        popped[hashed][key] = value
+            for shard_id in popped:
+                for key in popped[shard_id]:
+                    # ship whatever was written since the snapshot was taken
+                    popped[shard_id][key] = self.kvs.get(key, popped[shard_id][key])
+                    if self.expiry.deadline(key) is not None:
+                        expiries[key] = self.expiry.deadline(key)
+                    if key in self.versions:
+                        versions[key] = self.versions[key]
+                    self._remove(key)
+                self._log("DELETE", popped[shard_id])
+            return popped, expiries, versions
+
+        def _bulk_push(self, shard_id, data: dict, expiries: dict = None, versions: dict = None):
             destinations = self.shard_members[shard_id]
             for addr in destinations:
                 if addr == self.address:
@@ -609,39 +1110,302 @@ class Server:
                 payload = {
                     "kvs" : data
                 }
+                if expiries:
+                    payload["expires-at"] = {k: t for k, t in expiries.items() if k in data}
+                if versions:
+                    payload["versions"] = {k: v for k, v in versions.items() if k in data}
                 try:
-                    res = requests.put(f'http://{addr}/kvs/loadAll', headers=headers, json=payload)
+                    res = peers.put(f'http://{addr}/kvs/loadAll', headers=headers, json=payload)
                     logging.info(f'##### [replicate_kvs] Recevied data from {addr}: {res.json()}')
                 except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                     logging.info(f"Failed to connect to socket {addr}")
 
-        def load_all(self, data):
+        def load_all(self, data, expiries: dict = None, versions: dict = None, tombstones: dict = None):
+            ''' Bulk load from another node. A value that isn't newer than
+                our tombstone for its key is a stale copy of a deleted key
+                and is skipped.
+            '''
             logging.info(f"Bulk load into store: {data}")
+            if tombstones:
+                removed = { k: None for k, version in tombstones.items() if self._bury(k, version, {self.address}) }
+                self._log("DELETE", removed)
             if data:
+                expiries = expiries or {}
+                versions = versions or {}
+                loaded = {}
                 for k, v in data.items():
-                    self.kvs[k] = v
-            logging.info(f"kvs: {self.kvs}")
+                    version = versions.get(k)
+                    deleted_at = self.tombstones.version(k)
+                    if deleted_at is not None and (version is None or version <= deleted_at):
+                        continue
+                    self._observe(version)
+                    self._store(k, v, expiries.get(k), version)
+                    loaded[k] = v
+                self._log("PUT", loaded)
+            logging.info(f"kvs size: {self.kvs.size()}")
+
+        def send_snapshot(self):
+            ''' Stream a binary snapshot of the store (see snapshot.py).
+                The file is only rebuilt if the store changed since the last
+                one was written, and it goes out as-is without re-encoding.
+            '''
+            path = os.path.join(SNAPSHOT_DIR, 'outgoing.snap')
+            with self.snapshot_lock:
+                if self.snapshot_mutations != self.mutations or not os.path.exists(path):
+                    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+                    mutations = self.mutations
+                    with self.kvs.snapshot() as snapshot:
+                        meta = {"causal_metadata": dict(self.local_causal_metadata), "expires_at": dict(self.expiry.deadlines),
+                                "versions": dict(self.versions), "tombstones": self.tombstones.to_dict()}
+                        n_keys = write_snapshot(path, snapshot.items(), meta)
+                    self.snapshot_mutations = mutations
+                    logging.info(f"[send_snapshot] wrote {n_keys} keys to {path}")
+                # open under the lock so a rebuild can't swap the file on us
+                f = open(path, 'rb')
+            return send_file(f, mimetype='application/octet-stream')
+
+        def _replicate_snapshot(self, addr):
+            ''' Pull a binary snapshot from addr and serve reads straight
+                from the mapped file; pages are loaded as keys are touched.
+                Return:
+                - True if success, False otherwise (e.g. peer without /kvs/snapshot)
+            '''
+            path = os.path.join(SNAPSHOT_DIR, 'incoming.snap')
+            try:
+                res = peers.get(f'http://{addr}/kvs/snapshot', stream=True, timeout=5)
+                with res:
+                    if res.status_code != 200:
+                        return False
+                    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+                    with open(path + '.part', 'wb') as f:
+                        for chunk in res.iter_content(chunk_size=1 << 16):
+                            f.write(chunk)
+                os.replace(path + '.part', path)
+                snapshot = Snapshot(path)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError) as e:
+                logging.info(f"[replicate_kvs] no snapshot from {addr}: {e}")
+                return False
+
+            base = self.kvs.base
+            top = base.top if isinstance(base, SnapshotEngine) else base
+            top.clear()
+            self.kvs = MVCCEngine(SnapshotEngine(snapshot, top))
+            self._rebuild_derived(snapshot.meta.get("expires_at"), snapshot.meta.get("versions"),
+                                  snapshot.meta.get("tombstones"))
+            self.local_causal_metadata = snapshot.meta["causal_metadata"]
+            logging.info(f"##### [replicate_kvs] mapped snapshot of {len(snapshot)} keys from {addr}")
+            return True
 
         def replicate_kvs(self, addr):
             ''' Replicate our kv store from addr 
                 Return:
                 - True if success, False otherwise
             '''
-            try:
-                res = requests.get(f'http://{addr}/kvs/fetchAll')
-                logging.info(f'##### [replicate_kvs] Recevied data from {addr}: {res.json()}')
-                kvs, causal_metadata = res.json()['kvs'], res.json()['causal_metadata']
-                self.kvs = kvs
-                self.local_causal_metadata = causal_metadata
+            if self._replicate_snapshot(addr):
+                self.mutations += 1
+                if self.wal:
+                    self._checkpoint()
+                return True
+            if self._replicate_stream(addr):
+                self.mutations += 1
+                if self.wal:
+                    self._checkpoint()
                 return True
-            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
-                logging.info(f"Failed to connect to socket {addr}")
+            return False
+
+        def _replicate_stream(self, addr):
+            ''' Pull the store from addr as NDJSON (see fetch_all_stream),
+                applying it line by line, so neither side holds all of it.
+                A transfer that breaks off is resumed after the last line
+                applied.
+                Return:
+                - True if the whole store came over
+            '''
+            cursor = None
+            causal_metadata = None
+            for attempt in range(FETCH_RETRIES):
+                params = {"format": "ndjson"}
+                if cursor is not None:
+                    params["cursor"] = cursor
+                try:
+                    res = peers.get(f'http://{addr}/kvs/fetchAll', params=params, stream=True, timeout=(1, 30))
+                    with res:
+                        if res.status_code != 200:
+                            return False
+                        if res.headers.get('Content-Type', '').split(';')[0] != 'application/x-ndjson':
+                            # a node without streaming: the whole store in one document
+                            data = res.json()
+                            self.kvs.clear()
+                            self.kvs.update(data['kvs'])
+                            self._rebuild_derived(data.get('expires-at'), data.get('versions'), data.get('tombstones'))
+                            self.local_causal_metadata = data['causal_metadata']
+                            return True
+                        for line in res.iter_lines():
+                            if not line:
+                                continue
+                            chunk = json.loads(line)
+                            if "causal_metadata" in chunk:
+                                if cursor is None:
+                                    # a fresh copy replaces what we have
+                                    self.kvs.clear()
+                                    self._rebuild_derived()
+                                causal_metadata = chunk["causal_metadata"]
+                            elif "tombstones" in chunk:
+                                for key, version in chunk["tombstones"].items():
+                                    self._observe(version)
+                                    self.tombstones.add(key, version)
+                                self._start_compactor()
+                            elif "kvs" in chunk:
+                                expiries, versions = chunk.get("expires-at", {}), chunk.get("versions", {})
+                                for key, value in chunk["kvs"].items():
+                                    self._observe(versions.get(key))
+                                    self._store(key, value, expiries.get(key), versions.get(key))
+                                cursor = chunk["cursor"]
+                            elif chunk.get("end"):
+                                self.local_causal_metadata = causal_metadata
+                                logging.info(f"##### [replicate_kvs] streamed {self.kvs.size()} keys from {addr}")
+                                return True
+                    logging.info(f"[replicate_kvs] fetchAll from {addr} ended early, at {cursor}")
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError, ValueError) as e:
+                    logging.info(f"[replicate_kvs] fetchAll from {addr} broke off at {cursor}: {e}")
             return False
             
+        def sync_with(self, addr):
+            ''' Anti-entropy with a shard member: walk both Merkle trees
+                down from the root, opening only the nodes that differ, and
+                pull the keys (and deletes) of the leaves that still do.
+                Keys where ours is newer stay; addr pulls those itself.
+                Return:
+                - how many keys and deletes were taken, None if addr
+                  couldn't be asked
+            '''
+            url = f'http://{addr}/kvs/merkle'
+            try:
+                theirs = peers.post(url, json={"nodes": []}, timeout=1).json()
+                causal_metadata = theirs.get("causal-metadata") or {}
+                nodes = [0] if theirs["root"] != self.merkle.root() else []
+                while nodes and not self.merkle.is_leaf(nodes[0]):
+                    theirs = peers.post(url, json={"nodes": nodes}, timeout=5).json()
+                    nodes = self.merkle.diff(nodes, theirs["children"])
+                pulled = 0
+                for i in range(0, len(nodes), ANTI_ENTROPY_LEAVES):
+                    res = peers.post(f'{url}/leaves', json={"leaves": nodes[i:i + ANTI_ENTROPY_LEAVES]},
+                                     timeout=(1, BATCH_TIMEOUT))
+                    pulled += self._merge_pulled(res.json())
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, KeyError, ValueError) as e:
+                logging.info(f"[sync_with] {addr}: {e}")
+                return None
+            with self.md_lock:
+                for replica, clock in causal_metadata.items():
+                    if replica in self.local_causal_metadata:
+                        self.local_causal_metadata[replica] = max(self.local_causal_metadata[replica], clock)
+            if pulled:
+                logging.info(f"[sync_with] pulled {pulled} keys from {addr} ({len(nodes)} leaves differed)")
+            return pulled
+
+        def leaf_contents(self, leaves):
+            ''' Keys and deletes of some Merkle leaves, for POST /kvs/merkle/leaves '''
+            wanted = set(leaves)
+            kvs, expiries, versions = {}, {}, {}
+            for key in self.merkle.keys(wanted):
+                value = self.kvs.get(key, None)
+                if value is None and key not in self.kvs:
+                    continue
+                kvs[key] = value
+                if self.expiry.deadline(key) is not None:
+                    expiries[key] = self.expiry.deadline(key)
+                if key in self.versions:
+                    versions[key] = self.versions[key]
+            tombstones = { key: version for key, version in self.tombstones.to_dict().items()
+                           if self.merkle.leaf(key) in wanted }
+            return jsonify({"kvs": kvs, "expires-at": expiries, "versions": versions, "tombstones": tombstones}), 200
+
+        def _merge_pulled(self, data) -> int:
+            ''' Take what a shard member has that is newer than ours.
+                Return: how many keys and deletes were taken '''
+            removed = { key: None for key, version in data.get("tombstones", {}).items()
+                        if self._bury(key, version, {self.address}) }
+            expiries, versions = data.get("expires-at") or {}, data.get("versions") or {}
+            loaded = {}
+            now = time.time()
+            for key, value in data.get("kvs", {}).items():
+                version = versions.get(key)
+                if expiries.get(key) is not None and expiries[key] <= now:
+                    continue
+                if key in self.kvs and (version is None or self.versions.get(key, 0) >= version):
+                    continue
+                deleted_at = self.tombstones.version(key)
+                if deleted_at is not None and (version is None or version <= deleted_at):
+                    continue
+                self._observe(version)
+                self._store(key, value, expiries.get(key), version)
+                loaded[key] = value
+            if removed:
+                self._log("DELETE", removed)
+            if loaded:
+                self._log("PUT", loaded)
+            return len(removed) + len(loaded)
+
+        def _start_anti_entropy(self):
+            if ANTI_ENTROPY_MS and self.anti_entropy_thread is None:
+                self.anti_entropy_thread = threading.Thread(target=self._anti_entropy_loop, daemon=True)
+                self.anti_entropy_thread.start()
+
+        def _anti_entropy_loop(self):
+            while True:
+                time.sleep(ANTI_ENTROPY_MS / 1000.0)
+                members = [ m for m in self._shard_members() or [] if m != self.address and peers.is_up(m) ]
+                if not members:
+                    continue
+                try:
+                    self.sync_with(random.choice(members))
+                except Exception as e:
+                    logging.warning(f"[anti-entropy] {e}")
+
+        def _log(self, op, data: dict):
+            ''' Count the mutation (see send_snapshot) and write it to the WAL
+                (if enabled) before it is acknowledged.
+                Parameters:
+                - op: "PUT" or "DELETE"
+                - data: key -> value (values are ignored for DELETE)
+            '''
+            self.mutations += 1
+            if self.wal is None or not data:
+                return
+            records = [{"op": op, "key": k, "value": v if op == "PUT" else None} for k, v in data.items()]
+            for record in records:
+                if op == "PUT":
+                    record["expires-at"] = self.expiry.deadline(record["key"])
+                    record["version"] = self.versions.get(record["key"])
+                else:
+                    record["version"] = self.tombstones.version(record["key"])
+            records[-1]["causal-metadata"] = self.local_causal_metadata
+            if self.wal.error is not None:
+                # the log lost writes to a failed fsync; a checkpoint of
+                # what we hold starts a fresh one (or raises again)
+                self._checkpoint()
+            self.wal.append(records)
+            if self.wal.needs_checkpoint():
+                self._checkpoint()
+
+        def _checkpoint(self):
+            # no write may land between the copy and the cut: it would be in
+            # neither the checkpoint nor the fresh log
+            with self.write_lock:
+                if self.kvs.persistent:
+                    # the engine has the data on disk already, only the log needs cutting
+                    self.kvs.flush()
+                    kvs = None
+                else:
+                    kvs = self.kvs.to_dict()
+                self.wal.checkpoint(kvs, dict(self.local_causal_metadata), dict(self.expiry.deadlines),
+                                    dict(self.versions), self.tombstones.to_dict())
+
         def size(self, results: dict = None, context=None):
             if results is not None:
-                results["kv_size"] = len(self.kvs)
-            return len(self.kvs)
+                results["kv_size"] = self.kvs.size()
+            return self.kvs.size()
         
         def update_view(self, view):
             self.view = view
@@ -655,11 +1419,206 @@ class Server:
                 del self.local_causal_metadata[view]
 
         def fetch_all(self):
+            # read from a snapshot so concurrent PUTs neither break the walk
+            # nor show up half-way through it
+            with self.kvs.snapshot() as snapshot:
+                causal_metadata = dict(self.local_causal_metadata)
+                kvs = snapshot.to_dict()
             return jsonify({
-                "kvs": self.kvs,
-                "causal_metadata": self.local_causal_metadata
+                "kvs": kvs,
+                "causal_metadata": causal_metadata,
+                "expires-at": dict(self.expiry.deadlines),
+                "versions": dict(self.versions),
+                "tombstones": self.tombstones.to_dict()
             }), 200
 
+        def fetch_all_stream(self, cursor=None, compress=False):
+            ''' The store for GET /kvs/fetchAll?format=ndjson: one JSON
+                document per line, FETCH_CHUNK_KEYS keys a line, in key
+                order, produced as it is sent:
+
+                    {"causal_metadata": {...}}
+                    {"tombstones": {...}}          (only from the beginning)
+                    {"kvs": {...}, "expires-at": {...}, "versions": {...}, "cursor": last key}
+                    ...
+                    {"end": true}
+
+                Parameters:
+                - cursor: start after this key (the "cursor" of the last
+                  line a broken-off transfer got)
+                - compress: gzip the stream
+            '''
+            missing = object()
+            def lines():
+                # a snapshot, so concurrent writes don't show up half-way
+                with self.kvs.snapshot() as snapshot:
+                    yield {"causal_metadata": dict(self.local_causal_metadata)}
+                    if cursor is None:
+                        tombstones = list(self.tombstones.to_dict().items())
+                        for i in range(0, len(tombstones), FETCH_CHUNK_KEYS):
+                            yield {"tombstones": dict(tombstones[i:i + FETCH_CHUNK_KEYS])}
+                    after = cursor
+                    while True:
+                        keys = self.index.scan(after=after, limit=FETCH_CHUNK_KEYS)
+                        if not keys:
+                            break
+                        after = keys[-1]
+                        chunk = {"kvs": {}, "expires-at": {}, "versions": {}, "cursor": after}
+                        for key in keys:
+                            value = snapshot.get(key, missing)
+                            if value is missing:
+                                continue # written after the snapshot
+                            chunk["kvs"][key] = value
+                            if self.expiry.deadline(key) is not None:
+                                chunk["expires-at"][key] = self.expiry.deadline(key)
+                            if key in self.versions:
+                                chunk["versions"][key] = self.versions[key]
+                        yield chunk
+                    yield {"end": True}
+
+            def body():
+                gzip = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31) if compress else None
+                for line in lines():
+                    data = json.dumps(line).encode('utf-8') + b'\n'
+                    # flushed per line, so the receiver can apply it right away
+                    yield gzip.compress(data) + gzip.flush(zlib.Z_SYNC_FLUSH) if gzip else data
+                if gzip:
+                    yield gzip.flush()
+
+            headers = {"Content-Encoding": "gzip"} if compress else {}
+            return self.app.response_class(body(), mimetype='application/x-ndjson', headers=headers)
+
+        def stats(self):
+            engine = self.kvs.base
+            if isinstance(engine, SnapshotEngine):
+                engine = engine.top
+            return jsonify({
+                "keys": self.kvs.size(),
+                "tombstones": len(self.tombstones),
+                "compression": self.codec.stats(),
+                "cache": engine.stats() if hasattr(engine, 'stats') else None,
+                "replication": {
+                    "to": { view: stream.stats() for view, stream in list(self.streams.items()) },
+                    "from": self.receiver.status()
+                }
+            }), 200
+
+        def scan(self, start=None, end=None, prefix=None, limit=SCAN_DEFAULT_LIMIT, cursor=None):
+            ''' One page of this node's keys in order, for GET /kvs.
+                Only keys of our own shard are here; scanning everything
+                means asking one member of every shard.
+                Parameters:
+                - start / end: key range, start inclusive, end exclusive
+                - prefix: only keys starting with it
+                - limit: page size
+                - cursor: "next-cursor" from the previous page
+            '''
+            keys = self.index.scan(start, end, prefix, cursor, limit + 1)
+            more = len(keys) > limit
+            page = {}
+            now = time.time()
+            for key in keys[:limit]:
+                if self.expiry.is_expired(key, now):
+                    continue
+                value = self.kvs.get(key, None)
+                if value is not None or key in self.kvs:
+                    page[key] = self.codec.decode(value)
+            return jsonify({
+                "kvs": page,
+                "next-cursor": keys[limit - 1] if more else None,
+                "shard-id": self.shard_id,
+                "causal-metadata": self.local_causal_metadata
+            }), 200
+
+        def batch(self, ops, causal_metadata=None, acks=None):
+            ''' Run many GETs, PUTs and DELETEs for POST /kvs/batch.
+                Operations are grouped by the shard that owns their key: those
+                of our own shard run here, in order, and every other shard gets
+                its part in one request, all shards at the same time.
+                Parameters:
+                - ops: [{"op": "GET" | "PUT" | "DELETE", "key": k, "value": v, "ttl": s}]
+                - causal_metadata: the client's, once for the whole batch
+                - acks: replication ack policy of the writes
+                Return:
+                - one result per operation, in order, and the causal metadata
+                  of all the shards involved merged
+            '''
+            if not self.shard_members:
+                return jsonify({"error": "Shards not yet formed; try again later"}), 503
+
+            groups = {} # shard_id -> positions in ops
+            for i, op in enumerate(ops):
+                groups.setdefault(self._hash(op["key"]), []).append(i)
+
+            remote = {}
+            for shard_id, positions in groups.items():
+                if self.address not in self.shard_members[shard_id]:
+                    part = [ ops[i] for i in positions ]
+                    remote[self.scatter.submit(self._send_batch, shard_id, part, causal_metadata, acks)] = positions
+
+            results = [None] * len(ops)
+            for shard_id, positions in groups.items():
+                if self.address in self.shard_members[shard_id]:
+                    part = self._run_batch([ ops[i] for i in positions ], causal_metadata, acks)
+                    for i, result in zip(positions, part):
+                        results[i] = result
+
+            merged = dict(self.local_causal_metadata)
+            for future, positions in remote.items():
+                part, md = future.result()
+                for i, result in zip(positions, part):
+                    results[i] = result
+                for addr, count in (md or {}).items():
+                    merged[addr] = max(merged.get(addr, 0), count)
+            return jsonify({"results": results, "causal-metadata": merged}), 200
+
+        def _run_batch(self, ops, causal_metadata, acks):
+            ''' Our shard's part of a batch; causal dependencies are checked
+                once for all of it '''
+            if causal_metadata and any(op["op"] != 'GET' for op in ops):
+                if not self.check_causal_dependencies(None, causal_metadata):
+                    return [ {"key": op["key"], "status": 503, "error": "Causal dependencies not satisfied; try again later"}
+                             for op in ops ]
+                self._update_causal_metadata(None, causal_metadata)
+
+            results = []
+            for op in ops:
+                key = op["key"]
+                req = {"acks": acks}
+                if op.get("ttl") is not None:
+                    req["ttl"] = op["ttl"]
+                if op["op"] == 'PUT':
+                    res, status = self.put(key, op["value"], req)
+                elif op["op"] == 'DELETE':
+                    res, status = self.delete(key, req)
+                else:
+                    res, status = self.get(key)
+                body = res.get_json()
+                body.pop("causal-metadata", None)
+                results.append({"key": key, "status": status, **body})
+            return results
+
+        def _send_batch(self, shard_id, ops, causal_metadata, acks):
+            ''' Hand another shard its part of a batch.
+                Return:
+                - (its results, its causal metadata or None)
+            '''
+            payload = {"ops": ops, "causal-metadata": causal_metadata}
+            if acks is not None:
+                payload["acks"] = acks
+            res = self._first_reachable(self.shard_members[shard_id], lambda addr:
+                peers.post(f'http://{addr}/kvs/batch', json=payload, timeout=(1, BATCH_TIMEOUT)))
+
+            if res is None:
+                status, error = 503, "No replica of the shard is reachable; try again later"
+            elif res.status_code != 200:
+                status, error = res.status_code, res.json().get("error")
+            else:
+                data = res.json()
+                return data["results"], data.get("causal-metadata")
+            logging.warning(f"##### batch part for shard {shard_id} failed: {status} {error}")
+            return [ {"key": op["key"], "status": status, "error": error} for op in ops ], None
+
         def check_causal_dependencies(self, sender_addr, incoming_md, is_get=False):
             if is_get:
                 return True
@@ -687,60 +1646,36 @@ class Server:
             # if request and 'causal-metadata' in request and request['causal-metadata']:
             #     self._update_causal_metadata(sender_addr, request['causal-metadata'])
 
-            if incoming_md is None:
-                self.local_causal_metadata[sender_addr] += 1
-            else:
-                for addr, value in incoming_md.items():
-                    if addr == sender_addr:
-                        self.local_causal_metadata[addr] = incoming_md[addr]
-                    else:
-                        self.local_causal_metadata[addr] = max(self.local_causal_metadata[addr], incoming_md[addr])
+            # replication acks come in on the replicator's threads
+            with self.md_lock:
+                if incoming_md is None:
+                    self.local_causal_metadata[sender_addr] += 1
+                else:
+                    for addr, value in incoming_md.items():
+                        if addr == sender_addr:
+                            self.local_causal_metadata[addr] = incoming_md[addr]
+                        else:
+                            self.local_causal_metadata[addr] = max(self.local_causal_metadata[addr], incoming_md[addr])
             logging.info(f"## updated local md: {self.local_causal_metadata}, incoming md: {incoming_md}")
 
         def _forward(self, method, addresses, req: dict):
             ''' This is pure forwarding. This node just acts as the go-between 
                 of sender and the destination node.
             '''
-            destinations = addresses.copy()
-            random.shuffle(destinations) # so don't hit the same node over again
-            res = None
-
-            # try each of them in the shard (addresses) and hope to hit one
-            for addr in destinations: # so we don't overwhelm one node
-                if addr == SOCKET_ADDRESS: continue
-
-                # check if replica running
-                host = addr.split(':')
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-
-                connection = sock.connect_ex((host[0], int(host[1])))
-                if not connection:
-                    # self.app.logger.info(f"Connection to {addr} succeeds")
-                    sock.close()
-
-                    forward_url = f'http://{addr}/kvs/{req["key"]}'
-                    payload = {"broadcast": True, "causal-metadata": req["causal-metadata"]}
-
-                    if method == 'PUT':
-                        logging.info(f"\tAttempting to forward PUT to {forward_url}: {payload}")
-                        payload["value"] = req["value"]
-                        res = requests.put(forward_url, json=payload, timeout=1)
-
-                    elif method == 'DELETE':
-                        logging.info(f"\tAttempting to forward DELETE to {forward_url}: {payload}")
-                        res = requests.delete(forward_url, json=payload, timeout=1)
-
-                    elif method == 'GET':
-                        logging.info(f"\tAttempting to forward GET to {forward_url}: {payload}")
-                        del payload["broadcast"]
-                        res = requests.get(forward_url, json=payload, timeout=1)
-                        logging.info(f"\tSuccessful foward GET to {forward_url}: {res}")
-
-                    # fowarding to addr success
-                    if res and res.status_code:
-                        break
-
+            payload = self._forward_payload(method, req)
+
+            def send(addr):
+                forward_url = f'http://{addr}/kvs/{req["key"]}'
+                logging.info(f"\tAttempting to forward {method} to {forward_url}: {payload}")
+                if method == 'PUT':
+                    return peers.put(forward_url, json=payload, timeout=1)
+                elif method == 'DELETE':
+                    return peers.delete(forward_url, json=payload, timeout=1)
+                return peers.get(forward_url, json=payload, timeout=1)
+
+            res = self._first_reachable(addresses, send)
+            if res is None:
+                return {'data': {"error": "No replica of the shard is reachable; try again later"}, 'status_code': 503}
             data = res.json()
             '''
             if res.status_code < 300 and 'causal-metadata' in data and data['causal-metadata']:
@@ -748,6 +1683,89 @@ class Server:
                 data['causal-metadata'] = self.local_causal_metadata
             '''
             return {'data': data, 'status_code': res.status_code}
+
+        def _first_reachable(self, addresses, send):
+            ''' Try send(addr) on the members of a shard in random order (so
+                we don't hit the same node over again), skipping those we
+                know are down, until one of them handles it.
+                Return:
+                - the first answer below 500, else the last answer, else
+                  None if no member could be reached
+            '''
+            destinations = addresses.copy()
+            random.shuffle(destinations)
+            res = None
+            for addr in destinations:
+                if addr == SOCKET_ADDRESS: continue
+                # skip replicas we know are down (see peers.py)
+                if not peers.is_up(addr):
+                    continue
+                try:
+                    res = send(addr)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    logging.info(f"\tFailed to reach {addr}, trying the next one")
+                    continue
+                if res.status_code < 500:
+                    break
+            return res
+
+        def _forward_payload(self, method, req: dict) -> dict:
+            ''' What _forward sends to the shard that owns req["key"] '''
+            payload = {"broadcast": True, "causal-metadata": req.get("causal-metadata")}
+            if req.get("acks") is not None:
+                payload["acks"] = req["acks"]
+            if method == 'PUT':
+                payload["value"] = req["value"]
+                if req.get("value-encoded"):
+                    payload["value-encoded"] = True
+                if req.get("ttl") is not None:
+                    payload["ttl"] = req["ttl"]
+            elif method == 'GET':
+                del payload["broadcast"]
+            return payload
+
+        def check_request(self, method, key, req, shard_id=None):
+            ''' The checks a /kvs/<key> request has to pass before it is
+                served here or forwarded (also by aserver.py)
+                Parameters:
+                 - req: the request body, None if there is none
+                 - shard_id: the X-Shard-Id header, if any
+                Return:
+                 - (error body, status) to answer with, None if it passes
+            '''
+            # smart clients (kvsclient) name the shard they think owns the key;
+            # if it isn't ours by our map, they refresh theirs and go elsewhere
+            if shard_id is not None:
+                owner = self._hash(key)
+                if owner is not None and (owner != shard_id or self.address not in self.shard_members[owner]):
+                    return {"error": f"key {key} belongs to shard {owner}", "shard-id": owner}, 421
+            if method == 'GET':
+                return None
+            req = req if isinstance(req, dict) else {}
+            if method == 'PUT':
+                if 'value' not in req:
+                    return {"error": "[kvs_api] PUT request does not specify a value"}, 400
+                ttl = req.get('ttl')
+                if ttl is not None and (isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0):
+                    return {"error": "'ttl' must be a positive number of seconds"}, 400
+            if req.get('acks', REPLICATION_ACKS) not in ACK_POLICIES:
+                return {"error": f"'acks' must be one of {', '.join(ACK_POLICIES)}"}, 400
+            return None
+
+        def _trusted(self, req: dict, from_peer: bool) -> dict:
+            ''' req without the fields only a replica of the key may set. A
+                write's version and deadline come from the node that took it
+                from the client (which sends a checked "ttl" instead); a
+                client's own version would move our clock or bury keys.
+                Only replicas and forwards (which carry "broadcast") send
+                values the codec already encoded; a client's would be
+                stored undecodable '''
+            if from_peer:
+                return req
+            untrusted = ("version", "expires-at")
+            if req.get('broadcast') is None:
+                untrusted += ("value-encoded",)
+            return { field: value for field, value in req.items() if field not in untrusted }
         
         def _hash(self, key):
             ''' Return the shard_id that contains key '''
@@ -777,15 +1795,23 @@ class Server:
             
             members = self.shard_members[shard_idx]
 
+            # values from peers are already encoded, client ones aren't yet
+            if not (request and request.get('value-encoded')):
+                value = self.codec.encode(value)
+
             # Forward request if we don't key doesn't belong to this shard:
             if self.address not in members:
-                logging.info(f"\tThis shard {self.shard_id} does NOT own {key}, forwarding to shard {shard_idx}:\n\t\t{payload}")
                 # format payload
-                payload = {"key": key, "value": value}
+                payload = {"key": key, "value": value, "value-encoded": True}
                 if broadcast: 
                     payload['broadcast'] = broadcast
                 if request and "causal-metadata" in request and request['causal-metadata']:
                     payload["causal-metadata"] = request["causal-metadata"]
+                if request and request.get("ttl") is not None:
+                    payload["ttl"] = request["ttl"]
+                if request and request.get("acks") is not None:
+                    payload["acks"] = request["acks"]
+                logging.info(f"\tThis shard {self.shard_id} does NOT own {key}, forwarding to shard {shard_idx}:\n\t\t{payload}")
                 
                 # forward to shard_idx
                 res = self._forward("PUT", members, payload)
@@ -811,7 +1837,7 @@ class Server:
                 sender_addr = request['socket_address']
 
             # format response
-            if key in self.kvs:
+            if key in self.kvs and not self.expiry.is_expired(key, time.time()):
                 res_body, res_code = "replaced", 200
             else:
                 res_body, res_code = "created", 201
@@ -819,10 +1845,40 @@ class Server:
             if request and 'causal-metadata' in request and request['causal-metadata']:
                 self._update_causal_metadata(sender_addr, request['causal-metadata'])
 
+            # the coordinator versions the write; replicas keep its version
+            if request and request.get('version') is not None:
+                version = request['version']
+                self._observe(version)
+            else:
+                version = self._new_version()
+            deleted_at = self.tombstones.version(key)
+            if deleted_at is not None and deleted_at >= version:
+                # a replayed write from before the key was deleted
+                logging.info(f"\tPUT {key} at {version} is older than its delete at {deleted_at}, ignored")
+                return jsonify({"result": "replaced", "causal-metadata": self.local_causal_metadata}), 200
+            if self.versions.get(key, 0) > version:
+                # streams from different coordinators interleave: the newer
+                # write of the key stays
+                logging.info(f"\tPUT {key} at {version} is older than the one we have, ignored")
+                return jsonify({"result": "replaced", "causal-metadata": self.local_causal_metadata}), 200
+
+            # replicas get the absolute deadline the coordinator computed,
+            # so they all expire the key at the same moment
+            expires_at = None
+            if request and request.get('expires-at') is not None:
+                expires_at = request['expires-at']
+            elif request and request.get('ttl') is not None:
+                expires_at = time.time() + request['ttl']
+
             # store kv pair
-            self.kvs[key] = value
+            self._store(key, value, expires_at, version)
             # delivery action: increment our own clock
             self.local_causal_metadata[SOCKET_ADDRESS] += 1
+            try:
+                self._log("PUT", {key: value})
+            except OSError as e:
+                logging.error(f"\tPUT {key} not logged: {e}")
+                return jsonify({"error": "Write could not be made durable; try again later"}), 503
 
             # update metadata / broadcast
             #if no_broadcast and 'socket_address' in request:
@@ -831,7 +1887,7 @@ class Server:
             logging.info(f"\tbroadcast = {broadcast} has type {type(broadcast)}")
             if broadcast is None or broadcast is True:
                 logging.info(f"\tAttempting to broadcast PUT({key}, {value})")
-                self.broadcast('PUT', key, value)
+                self.broadcast('PUT', key, value, expires_at, version, request.get('acks'))
             logging.info(f"\t{self.address} returns: {self.local_causal_metadata}")
 
             return jsonify({"result": res_body, "causal-metadata": self.local_causal_metadata}), res_code
@@ -856,11 +1912,12 @@ class Server:
                 if not self.check_causal_dependencies(None, incoming_causal_metadata, True):
                     return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
                 
-            if key not in self.kvs:
+            if key not in self.kvs or self.expiry.is_expired(key, time.time()):
                 logging.info(f"??????????? GET: {key} NOT in store   ?????? Returning 404")
                 return jsonify({"error": "Key does not exist"}), 404
-            logging.info(f"GET returns 200: {self.kvs[key]}, {self.local_causal_metadata} ")
-            return jsonify({"result": "found", "value": self.kvs[key], "causal-metadata": self.local_causal_metadata}), 200
+            value = self.codec.decode(self.kvs.get(key))
+            logging.info(f"GET returns 200: {value}, {self.local_causal_metadata} ")
+            return jsonify({"result": "found", "value": value, "causal-metadata": self.local_causal_metadata}), 200
         
         def delete(self, key, request, no_broadcast=False):
             # Find which shard the key hashes to, then forward the
@@ -877,73 +1934,267 @@ class Server:
                 }
                 if "causal-metadata" in request:
                     payload["causal-metadata"] = request["causal-metadata"]
+                if request.get("acks") is not None:
+                    payload["acks"] = request["acks"]
                 return self._forward("DELETE", members, payload)
 
-            if "causal-metadata" in request:
+            sender_addr = request.get('socket_address')
+            if request.get('causal-metadata'):
                 incoming_causal_metadata = request['causal-metadata']
-                if 'socket-address' in request:
-                    sender_addr = request['socket-address']
-                if not self.check_causal_dependencies(sender_addr, incoming_causal_metadata):
+                if not self.check_causal_dependencies(request.get('socket-address'), incoming_causal_metadata):
                     return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-                
-            if key not in self.kvs:
+
+            # the coordinator versions the delete; replicas keep its version
+            # and a tombstone even if they never had the key
+            if request.get('version') is not None:
+                version = request['version']
+            elif key not in self.kvs or self.expiry.is_expired(key, time.time()):
                 return jsonify({"error": "Key does not exist"}), 404
-            
-            # store kv pair
-            del self.kvs[key]
-            res = jsonify({"result": "deleted", "causal-metadata": self.local_causal_metadata}), 200
+            else:
+                version = self._new_version()
+            self._bury(key, version, {self.address, sender_addr} if sender_addr else {self.address})
 
             if no_broadcast:
                 # update metadata
-                self.local_causal_metadata[request['socket_address']] += 1
+                self.local_causal_metadata[sender_addr] += 1
             else:
-                # broadcast
-                self.broadcast('DELETE', key, None)
+                # delivery action, then broadcast
                 self.local_causal_metadata[SOCKET_ADDRESS] += 1
-                
-            return res
-            
-        def broadcast(self, method, key, value):
-            #views = self.view.get()[0].json['view']
-            # self.app.logger.info(f"Attempting to broadcast to {views}")
+                self.broadcast('DELETE', key, None, version=version, acks=request.get('acks'))
+            try:
+                self._log("DELETE", {key: None})
+            except OSError as e:
+                logging.error(f"\tDELETE {key} not logged: {e}")
+                return jsonify({"error": "Write could not be made durable; try again later"}), 503
+
+            return jsonify({"result": "deleted", "causal-metadata": self.local_causal_metadata}), 200
             
-            for view in self.shard_members[self.shard_id]:
-                if view == SOCKET_ADDRESS: continue
-                # self.app.logger.info(f"Attempting to broadcast to {view}")
-
-                # check if replica running
-                host = view.split(':')
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-
-                connection = sock.connect_ex((host[0], int(host[1])))
-                if not connection:
-                    # self.app.logger.info(f"Connection to {view} succeess")
-                    sock.close()
-                    url = f'http://{view}/kvs/{key}'
-                    payload = {
-                        "broadcast": False,
-                        "causal-metadata": self.local_causal_metadata,
-                        "socket_address": SOCKET_ADDRESS
-                    }
+        def broadcast(self, method, key, value, expires_at=None, version=None, acks=None):
+            ''' Send a write to every other member of our shard at once.
+
+                Parameters:
+                - acks: "one", "quorum" or "all" (default REPLICATION_ACKS);
+                  how many shard members must have the write before we return
+
+                Return:
+                - number of members (this one included) known to have the write
+
+                Replicas that haven't answered yet keep going in the background,
+                and those that fail are retried (see _replicate).
+            '''
+            members = self.shard_members[self.shard_id]
+            targets = [ view for view in members if view != SOCKET_ADDRESS ]
+            payload = {
+                "broadcast": False,
+                # what the replicas check against is the state as of this write
+                "causal-metadata": dict(self.local_causal_metadata),
+                "socket_address": SOCKET_ADDRESS,
+                "version": version
+            }
+            if method == 'PUT':
+                payload["value"] = value
+                payload["value-encoded"] = True
+                if expires_at is not None:
+                    payload["expires-at"] = expires_at
+
+            policy = acks or REPLICATION_ACKS
+            if policy == 'one':
+                needed = 0
+            elif policy == 'quorum':
+                needed = len(members) // 2 # a majority, counting ourselves
+            else:
+                needed = len(targets)
+
+            if REPLICATION_STREAM:
+                seqs = { view: self._stream(view).append(method, key, payload) for view in targets }
+                self._close_streams(members)
+                deferred = deferred_replication.get()
+                if deferred is not None:
+                    # the asyncio server waits for the acks without a thread
+                    deferred.append((method, key, payload, targets, needed, policy, seqs))
+                    return 1
+                acked = self._await_acks(seqs, needed)
+                if acked < needed:
+                    logging.warning(f"##### {method} {key}: {acked + 1}/{len(members)} replicas have it, wanted {policy}")
+                return acked + 1
+
+            deferred = deferred_replication.get()
+            if deferred is not None:
+                # the asyncio server sends it once the handler returns
+                deferred.append((method, key, payload, targets, needed, policy, None))
+                return 1
+
+            pending = { self.replicator.submit(self._replicate, method, view, key, payload) for view in targets }
+            acked = 0
+            while pending and acked < needed:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                acked += sum(1 for future in done if future.result())
+            if acked < needed:
+                logging.warning(f"##### {method} {key}: {acked + 1}/{len(members)} replicas have it, wanted {policy}")
+            return acked + 1
+
+        def _replicate(self, method, view, key, payload, attempt=0) -> bool:
+            ''' Send one replica a write; on failure schedule another try.
+                Return:
+                - True if the replica applied it
+            '''
+            url = f'http://{view}/kvs/{key}'
+            resp = None
+            # check if replica running (cached, see peers.py)
+            if peers.is_up(view):
+                logging.info(f"broadcast {method} to {view}: {payload}")
+                try:
                     if method == 'PUT':
-                        payload["value"] = value
-                        logging.info(f"broadcast {method} to {view}: {payload}")
-                        resp = requests.put(url, json=payload, timeout=1)
-                        if resp.status_code < 300:
-                            self._update_causal_metadata(view, None)
-                            logging.info(f"##### broadcast to {view} receives {resp.status_code}, {resp.json()}")
-                        else:
-                            logging.warning(f"##### Got bad response {resp.status_code} from {view}")
-                    elif method == 'DELETE':
-                        logging.info(f"broadcast {method} to {view}: {payload}")
-                        resp = requests.delete(url, json=payload, timeout=1)
-                        if resp.status_code < 300:
-                            self._update_causal_metadata(view, None)
+                        resp = peers.put(url, json=payload, timeout=1)
+                    else:
+                        resp = peers.delete(url, json=payload, timeout=1)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    logging.warning(f"##### broadcast to {view} failed")
+
+            status = None if resp is None else resp.status_code
+            ok, delay = self._replicated(method, view, key, payload, status, attempt)
+            if delay is not None:
+                retry = threading.Timer(delay, self.replicator.submit,
+                                        args=(self._replicate, method, view, key, payload, attempt + 1))
+                retry.daemon = True
+                retry.start()
+            return ok
+
+        def _stream(self, view) -> ReplicationStream:
+            ''' The replication stream to view, started on first use '''
+            with self.streams_lock:
+                stream = self.streams.get(view)
+                if stream is None:
+                    stream = self.streams[view] = ReplicationStream(
+                        view, SOCKET_ADDRESS, self.stream_id, self._send_stream,
+                        on_ack=lambda entries, view=view: self._stream_acked(view, entries),
+                        batch=REPLICATION_BATCH, retry=REPLICATION_RETRY_MS / 1000.0,
+                        limit=REPLICATION_BACKLOG, coalesce=REPLICATION_COALESCE_MS / 1000.0,
+                        spill=os.path.join(BACKLOG_DIR, view.replace(':', '_') + '.backlog') if BACKLOG_DIR else None,
+                        spill_max_bytes=int(BACKLOG_MAX_MB * 2**20))
+                return stream
+
+        def _peer_recovered(self, addr):
+            ''' A replica is reachable again: replay what it missed right away '''
+            stream = self.streams.get(addr)
+            if stream is not None:
+                logging.info(f"##### {addr} is back, replaying {stream.stats()['pending']} writes")
+                stream.wake()
+
+        def close(self):
+            ''' Stop what would outlive the store: its recovery listener,
+                replication streams and worker threads, the WAL and the
+                engine '''
+            self.stop_listening()
+            self._close_streams(())
+            self.replicator.shutdown(wait=False)
+            self.scatter.shutdown(wait=False)
+            if self.wal is not None:
+                self.wal.close()
+            self.kvs.close()
+
+        def _close_streams(self, members):
+            ''' Stop streaming to nodes that have left our shard '''
+            with self.streams_lock:
+                gone = [ view for view in self.streams if view not in members ]
+                closed = [ self.streams.pop(view) for view in gone ]
+            for stream in closed:
+                logging.info(f"##### closing replication stream to {stream.addr}")
+                stream.close()
+
+        def _send_stream(self, view, message) -> int:
+            ''' Send view a batch of its stream. Return: view's cumulative ack '''
+            if not peers.is_up(view):
+                raise ConnectionError(f"{view} is down")
+            resp = peers.post(f'http://{view}/kvs/replicate', json=message, timeout=(1, 5))
+            if resp.status_code != 200:
+                raise ConnectionError(f"{view} answered {resp.status_code}")
+            return resp.json()["ack"]
+
+        def _stream_acked(self, view, entries):
+            for entry in entries:
+                if entry["payload"] is None:
+                    # coalesced into a later write, counts as delivered
+                    self._update_causal_metadata(view, None)
+                else:
+                    self._replicated(entry["method"], view, entry["key"], entry["payload"], 200, 0)
 
+        def _await_acks(self, seqs, needed) -> int:
+            ''' Wait until needed replicas have applied their entries (seqs:
+                view -> sequence number), or REPLICATION_ACK_TIMEOUT_MS.
+                Return:
+                - how many replicas have
+            '''
+            if needed == 0:
+                return 0
+            results = queue.Queue()
+            acked = failed = 0
+            for view, seq in seqs.items():
+                if peers.is_up(view):
+                    self._stream(view).when_acked(seq, results.put)
                 else:
-                    # self.app.logger.info(f"Could not connect to {view}")
-                    self.shard_members.remove(view)
+                    failed += 1
+            deadline = time.monotonic() + self.ack_timeout
+            while acked < needed and acked + failed < len(seqs):
+                try:
+                    ok = results.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                acked += ok
+                failed += not ok
+            return acked
+
+        def _apply_replicated(self, source, entry) -> bool:
+            ''' Apply one entry of source's stream.
+                Return:
+                - False if it can't be applied yet (we aren't ready)
+            '''
+            if entry["payload"] is None:
+                # the sender coalesced it into a later write
+                return True
+            request = dict(entry["payload"])
+            causal_metadata = request.pop("causal-metadata", None)
+            # the stream already orders the writes, no causal check needed
+            if entry["method"] == 'PUT':
+                res = self.put(entry["key"], request["value"], request, broadcast=False)
+            else:
+                res = self.delete(entry["key"], request, True)
+            status = res["status_code"] if isinstance(res, dict) else res[1]
+            if status == 503:
+                return False
+            if status >= 300:
+                logging.warning(f"##### {entry['method']} {entry['key']} from {source} answered {status}, skipped")
+            if causal_metadata:
+                self._update_causal_metadata(None, causal_metadata)
+            return True
+
+        def _replicated(self, method, view, key, payload, status, attempt):
+            ''' Book-keeping after one try at sending view a write.
+
+                Parameters:
+                - status: HTTP status view answered with, None if it didn't
+
+                Return:
+                - (whether view applied it, seconds until the next try or None)
+            '''
+            if status is not None and status < 300:
+                self._update_causal_metadata(view, None)
+                if method == 'DELETE':
+                    self.tombstones.ack(key, payload["version"], view)
+                logging.info(f"##### broadcast to {view} receives {status}")
+                return True, None
+            if status is not None and status < 500:
+                # the replica refused the write; sending it again won't help
+                logging.warning(f"##### Got bad response {status} from {view}")
+                return False, None
+
+            # down, unreachable or not ready (e.g. missing causal dependencies):
+            # try again later, as long as view is still in our shard
+            if attempt < REPLICATION_RETRIES and view in self.shard_members.get(self.shard_id, ()):
+                return False, REPLICATION_RETRY_MS / 1000.0 * 2 ** attempt
+            # deletes are still re-sent by the tombstone compactor
+            logging.warning(f"##### giving up on {method} {key} to {view}")
+            return False, None
 
     class View:
         def __init__(self, app):
@@ -969,6 +2220,7 @@ class Server:
             if socket_addr not in self.view:
                 # self.app.logger.error(f'{socket_addr} does not exist on replica {SOCKET_ADDRESS} view')
                 return jsonify({"error": "View has no such replica"}), 404
+            peers.health.forget(socket_addr)
             
             # self.app.logger.info(f'Current view (before): {self.view}')
             failed_queue = []
@@ -983,7 +2235,7 @@ class Server:
                     continue
 
                 try:
-                    requests.delete(f'http://{view}/view', json={'socket_address': socket_addr}, timeout=1)
+                    peers.delete(f'http://{view}/view', json={'socket_address': socket_addr}, timeout=1)
                 except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                     # self.app.logger.error(f'Failed to connect to socket {view}')
                     failed_queue.append(view)
@@ -994,7 +2246,15 @@ class Server:
             return jsonify({"result": "deleted"}), 200
         
 
+    def close(self):
+        self.kv_store.close()
+
     def run(self, host, port):
+        if SERVER_MODE == 'async':
+            AsyncServer(self).run(host, port)
+            return
+        # HTTP/1.1 so peers can keep their connections to us open
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
         self.app.run(host=host, port=port, debug=True)
 
 if __name__ == '__main__':
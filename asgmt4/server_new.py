@@ -5,12 +5,19 @@ import socket
 import time
 import hashlib
 from flask import Flask, request, jsonify
+from storage import open_engine
 
 SOCKET_ADDRESS = os.environ.get('SOCKET_ADDRESS')
 VIEW = os.environ.get('VIEW')
 
 SHARD_COUNT = os.environ.get('SHARD_COUNT')
 
+# storage backend behind KV_Store: "dict" or "lsm"
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'dict')
+STORAGE_DIR = os.environ.get('STORAGE_DIR', 'data')
+LSM_MEMTABLE_LIMIT = int(os.environ.get('LSM_MEMTABLE_LIMIT', 10000))
+LSM_COMPACTION_TRIGGER = int(os.environ.get('LSM_COMPACTION_TRIGGER', 4))
+
 class Server:
     def __init__(self, name):
         self.app = Flask(name)
@@ -467,7 +474,12 @@ class Server:
             self.app = app
             self.view = view
             self.node_alive = node_alive
-            self.kvs = {}
+            if STORAGE_ENGINE == 'lsm':
+                self.kvs = open_engine('lsm', STORAGE_DIR,
+                                       memtable_limit=LSM_MEMTABLE_LIMIT,
+                                       compaction_trigger=LSM_COMPACTION_TRIGGER)
+            else:
+                self.kvs = open_engine(STORAGE_ENGINE)
 
             views = self.view.get()[0].json['view']
             self.local_causal_metadata = {replica: 0 for replica in views}
@@ -498,13 +510,13 @@ class Server:
             return hashed_key % n
 
         def ping_kvs_size(self):
-            kv_size = len(list(self.kvs.keys()))
-            return kv_size
+            return self.kvs.size()
         
         def replace_kvs_data(self, new_kvs=None, new_causal_metadata=None, shard_members=None):
             self.app.logger.info(f"\tUpdating {SOCKET_ADDRESS} data...")
             if new_kvs:
-                self.kvs = new_kvs
+                self.kvs.clear()
+                self.kvs.update(new_kvs)
             if new_causal_metadata:
                 self.local_causal_metadata = new_causal_metadata
             if shard_members:
@@ -547,7 +559,7 @@ class Server:
                     res_result, res_status = "created", 201
                 
                 # store kv pair
-                self.kvs[key] = value
+                self.kvs.put(key, value)
                 self.app.logger.info(f"\tSuccesfully stored ({key}, {value}) at {shard_id}")
                 res_causal_metadata = self.local_causal_metadata
                 
@@ -571,7 +583,7 @@ class Server:
                     return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
                 
             if key in self.kvs:
-                return jsonify({"result": "found", "value": self.kvs[key], "causal-metadata": self.local_causal_metadata}), 200
+                return jsonify({"result": "found", "value": self.kvs.get(key), "causal-metadata": self.local_causal_metadata}), 200
             
             # if key not in this node, search other shards
             if broadcast:
@@ -597,11 +609,9 @@ class Server:
                 if not self.check_causal_dependencies(incoming_causal_metadata):
                     return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
                 
-            if key not in self.kvs:
+            if not self.kvs.delete(key):
                 return jsonify({"error": "Key does not exist"}), 404
-            
-            # store kv pair
-            del self.kvs[key]
+
             res = jsonify({"result": "deleted", "causal-metadata": self.local_causal_metadata}), 200
 
             if broadcast:
@@ -671,7 +681,7 @@ class Server:
 
         def fetch_all(self):
             return jsonify({
-                "kvs": self.kvs,
+                "kvs": self.kvs.to_dict(),
                 "causal_metadata": self.local_causal_metadata
             }), 200
 
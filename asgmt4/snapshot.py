@@ -0,0 +1,213 @@
+import os
+import json
+import heapq
+import mmap
+import shutil
+import struct
+import tempfile
+import threading
+from storage import StorageEngine, _MISSING
+
+'''
+Binary snapshot of a KV store, meant to be read through mmap.
+
+Layout (all integers little-endian):
+
+    header   magic "KVSNAP01" | n_keys u64 | meta_len u32 | meta (JSON)
+    offsets  n_keys x u64, offset of every key record, sorted by key
+    index    per key: key_len u16 | key (UTF-8) | value_offset u64 | value_len u32
+    values   JSON encoded values, back to back
+
+Offsets are absolute file offsets. Keys are sorted by their UTF-8 bytes
+(same order as Python str comparison), so a lookup is a binary search over
+the offsets table that only touches the pages it needs.
+'''
+
+MAGIC = b'KVSNAP01'
+_HEADER = struct.Struct('<8sQI')
+_OFFSET = struct.Struct('<Q')
+_KEY_LEN = struct.Struct('<H')
+_VALUE_REF = struct.Struct('<QI')
+
+
+def write_snapshot(path, items, meta: dict = None):
+    ''' Write a snapshot file.
+        Parameters:
+        - path: destination; written to a temp file first and renamed in place
+        - items: iterable of (key, value); doesn't have to be sorted
+        - meta: small JSON-able dict stored in the header (causal metadata)
+        Return:
+        - number of keys written
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    meta_bytes = json.dumps(meta or {}).encode('utf-8')
+
+    # values go to a scratch file first; we only keep (key, offset, length) around
+    index = []
+    with tempfile.TemporaryFile(dir=directory) as values:
+        for key, value in items:
+            encoded = json.dumps(value).encode('utf-8')
+            index.append((key.encode('utf-8'), values.tell(), len(encoded)))
+            values.write(encoded)
+        index.sort(key=lambda entry: entry[0])
+
+        n_keys = len(index)
+        offsets_start = _HEADER.size + len(meta_bytes)
+        index_start = offsets_start + n_keys * _OFFSET.size
+        index_size = sum(_KEY_LEN.size + len(k) + _VALUE_REF.size for k, _, _ in index)
+        values_start = index_start + index_size
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, n_keys, len(meta_bytes)))
+            f.write(meta_bytes)
+            record_offset = index_start
+            for key, _, _ in index:
+                f.write(_OFFSET.pack(record_offset))
+                record_offset += _KEY_LEN.size + len(key) + _VALUE_REF.size
+            for key, offset, length in index:
+                f.write(_KEY_LEN.pack(len(key)))
+                f.write(key)
+                f.write(_VALUE_REF.pack(values_start + offset, length))
+            values.seek(0)
+            shutil.copyfileobj(values, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    return n_keys
+
+
+class Snapshot:
+    ''' Read-only view of a snapshot file. Nothing is loaded up front; the
+        OS pages the parts that lookups touch in on demand.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_keys, meta_len = _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a snapshot file")
+        self.meta = json.loads(self.map[_HEADER.size:_HEADER.size + meta_len])
+        self.offsets_start = _HEADER.size + meta_len
+
+    def _record(self, i):
+        ''' Return: (key bytes, value offset, value length) of the i-th key '''
+        pos = _OFFSET.unpack_from(self.map, self.offsets_start + i * _OFFSET.size)[0]
+        key_len = _KEY_LEN.unpack_from(self.map, pos)[0]
+        pos += _KEY_LEN.size
+        key = self.map[pos:pos + key_len]
+        value_offset, value_len = _VALUE_REF.unpack_from(self.map, pos + key_len)
+        return key, value_offset, value_len
+
+    def _value(self, offset, length):
+        return json.loads(self.map[offset:offset + length])
+
+    def get(self, key, default=None):
+        target = key.encode('utf-8')
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, offset, length = self._record(mid)
+            if mid_key < target:
+                lo = mid + 1
+            elif mid_key > target:
+                hi = mid
+            else:
+                return self._value(offset, length)
+        return default
+
+    def items(self):
+        ''' Iterate (key, value) in key order '''
+        for i in range(self.n_keys):
+            key, offset, length = self._record(i)
+            yield key.decode('utf-8'), self._value(offset, length)
+
+    def __len__(self):
+        return self.n_keys
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class SnapshotEngine(StorageEngine):
+    ''' Serves reads from a mapped snapshot while new writes land in a
+        regular engine on top of it. Keys deleted after the snapshot was
+        taken are remembered so the snapshot copy stays hidden.
+    '''
+    def __init__(self, snapshot: Snapshot, top: StorageEngine):
+        self.snapshot = snapshot
+        self.top = top
+        self.deleted = set()
+        self.lock = threading.Lock()
+        self.n_keys = len(snapshot) + sum(1 for k, _ in top.items() if snapshot.get(k, _MISSING) is _MISSING)
+
+    # the snapshot file is just a transfer format, so a WAL checkpoint has to
+    # copy the data even if the top engine is durable
+    persistent = False
+
+    def get(self, key, default=None):
+        value = self.top.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        snapshot = self.snapshot
+        if snapshot is None or key in self.deleted:
+            return default
+        return snapshot.get(key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            if self.get(key, _MISSING) is _MISSING:
+                self.n_keys += 1
+            self.top.put(key, value)
+            self.deleted.discard(key)
+
+    def delete(self, key) -> bool:
+        with self.lock:
+            if self.get(key, _MISSING) is _MISSING:
+                return False
+            self.top.delete(key)
+            if self.snapshot and self.snapshot.get(key, _MISSING) is not _MISSING:
+                self.deleted.add(key)
+            self.n_keys -= 1
+            return True
+
+    def items(self):
+        with self.lock:
+            top = sorted(self.top.items(), key=lambda kv: kv[0])
+            deleted = set(self.deleted)
+            snapshot = self.snapshot
+        base = ()
+        if snapshot:
+            base = ((k, 1, v) for k, v in snapshot.items() if k not in deleted)
+        # on equal keys the top engine (tagged 0) comes first and wins
+        last_key = _MISSING
+        for key, _, value in heapq.merge(((k, 0, v) for k, v in top), base, key=lambda e: (e[0], e[1])):
+            if key == last_key:
+                continue
+            last_key = key
+            yield key, value
+
+    def size(self) -> int:
+        return self.n_keys
+
+    def clear(self):
+        with self.lock:
+            self.top.clear()
+            self.deleted = set()
+            # readers may still be walking the old map; let it go with the
+            # last reference instead of closing it under them
+            self.snapshot = None
+            self.n_keys = 0
+
+    def flush(self):
+        self.top.flush()
+
+    def close(self):
+        self.top.close()
+        if self.snapshot:
+            self.snapshot.close()
@@ -0,0 +1,507 @@
+import os
+import json
+import heapq
+import bisect
+import hashlib
+import logging
+import threading
+
+'''
+Storage engines for the KV store.
+
+KV_Store only talks to a StorageEngine, so the backend can be swapped with
+STORAGE_ENGINE:
+- "dict": everything in a plain dict (what we always had)
+- "arena": compact in-memory layout without per-entry Python objects
+  (see arena.py)
+- "lsm": log-structured merge-tree; writes go to an in-memory memtable
+  which is flushed into sorted, immutable segment files once it gets big.
+  Every segment has a bloom filter and a sparse index in memory, and a
+  background thread merges segments of about the same size together
+  (size-tiered compaction), so every entry is rewritten only once per
+  tier instead of on every compaction.
+- "tiered": in memory up to a budget, cold entries spill to an LSM tree
+  on disk (see tiered.py)
+'''
+
+_MISSING = object()
+# marks a deleted key inside a memtable until it has been compacted away
+_TOMBSTONE = object()
+
+
+class StorageEngine:
+    ''' The interface every backend implements.
+        The mapping methods at the bottom are there so that code like
+        `key in kvs` keeps reading naturally.
+    '''
+    # True if the engine keeps its data on disk by itself
+    persistent = False
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def peek(self, key, default=None):
+        ''' get() that isn't a use of the key: engines that cache don't
+            promote it or count it (see tiered.py) '''
+        return self.get(key, default)
+
+    def delete(self, key) -> bool:
+        ''' Return: True if the key was there '''
+        raise NotImplementedError
+
+    def items(self):
+        ''' Iterate over (key, value) pairs, sorted by key for ordered
+            engines. What is iterated is fixed when items() is called;
+            writes after that don't show (MVCCEngine relies on it) '''
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def flush(self):
+        ''' Make everything written so far durable (no-op for in-memory engines) '''
+        pass
+
+    def close(self):
+        pass
+
+    def update(self, data: dict):
+        for k, v in data.items():
+            self.put(k, v)
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in self.items()}
+
+    def keys(self):
+        return (k for k, _ in self.items())
+
+    def pop(self, key, default=_MISSING):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        self.delete(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return self.size()
+
+    def __bool__(self):
+        return self.size() > 0
+
+    def __eq__(self, other):
+        if isinstance(other, StorageEngine):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+
+class DictEngine(StorageEngine):
+    def __init__(self):
+        self.data = {}
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def delete(self, key) -> bool:
+        return self.data.pop(key, _MISSING) is not _MISSING
+
+    def items(self):
+        # copy so that writers on other threads don't break the iteration;
+        # dict.copy() is one step, list(items()) can be interrupted midway
+        return iter(self.data.copy().items())
+
+    def size(self) -> int:
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+
+    def to_dict(self) -> dict:
+        return self.data.copy()
+
+
+class BloomFilter:
+    ''' Plain bloom filter; bits_per_key=10 gives roughly 1% false positives '''
+    def __init__(self, n_keys, bits_per_key=10):
+        self.n_bits = max(64, n_keys * bits_per_key)
+        self.n_hashes = max(1, int(bits_per_key * 0.69)) # ln(2) * m/n
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [ (h1 + i * h2) % self.n_bits for i in range(self.n_hashes) ]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class Segment:
+    ''' An immutable, sorted file of JSON lines: [key, value] or [key] for a
+        tombstone. Only a sparse index (every `index_every`-th key) and a
+        bloom filter are kept in memory.
+    '''
+    def __init__(self, path, index_every=64):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.index_keys = []
+        self.index_offsets = []
+        self.n_keys = 0
+        self.file_size = os.path.getsize(path)
+
+        keys = []
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                key = json.loads(line)[0]
+                if self.n_keys % index_every == 0:
+                    self.index_keys.append(key)
+                    self.index_offsets.append(offset)
+                keys.append(key)
+                self.n_keys += 1
+                offset += len(line)
+        self.bloom = BloomFilter(len(keys))
+        for key in keys:
+            self.bloom.add(key)
+        self.fd = os.open(path, os.O_RDONLY)
+
+    @staticmethod
+    def write(path, entries):
+        ''' entries: sorted iterable of (key, value), value may be _TOMBSTONE '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, value in entries:
+                record = [key] if value is _TOMBSTONE else [key, value]
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        ''' Return: the value, _TOMBSTONE, or _MISSING '''
+        if self.n_keys == 0 or not self.bloom.might_contain(key):
+            return _MISSING
+        idx = bisect.bisect_right(self.index_keys, key) - 1
+        if idx < 0:
+            return _MISSING
+        start = self.index_offsets[idx]
+        end = self.index_offsets[idx + 1] if idx + 1 < len(self.index_offsets) else self.file_size
+        block = os.pread(self.fd, end - start, start)
+        for line in block.splitlines():
+            record = json.loads(line)
+            if record[0] == key:
+                return record[1] if len(record) == 2 else _TOMBSTONE
+            if record[0] > key:
+                break
+        return _MISSING
+
+    def entries(self):
+        # open right away: the file may be unlinked by a compaction before
+        # the caller starts iterating
+        f = open(self.path, 'rb')
+
+        def read():
+            with f:
+                for line in f:
+                    record = json.loads(line)
+                    yield record[0], (record[1] if len(record) == 2 else _TOMBSTONE)
+        return read()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LSMEngine(StorageEngine):
+    persistent = True
+
+    def __init__(self, directory, memtable_limit=10000, compaction_trigger=4,
+                 tier_ratio=2, tier_min_bytes=2**20):
+        '''
+            Parameters:
+            - directory: where segment files and the manifest live
+            - memtable_limit: number of keys in the memtable before it is flushed
+            - compaction_trigger: number of segments in one tier that starts
+              a compaction of the tier
+            - tier_ratio: a segment up to this many times the size of the
+              newest one of a tier belongs to the tier
+            - tier_min_bytes: segments smaller than this are all one tier
+        '''
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'MANIFEST')
+        self.memtable_limit = memtable_limit
+        self.compaction_trigger = compaction_trigger
+        self.tier_ratio = tier_ratio
+        self.tier_min_bytes = tier_min_bytes
+
+        self.lock = threading.RLock()
+        self.memtable = {}
+        self.immutables = [] # memtables waiting to be flushed, newest first
+        self.segments = []   # newest first
+        self.retired = []    # compacted away, closed on the next compaction
+        self.next_segment = 1
+        self.n_keys = 0
+
+        self.work = threading.Condition(self.lock)
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_manifest()
+        self.n_keys = sum(1 for _ in self.items())
+
+        self.worker = threading.Thread(target=self._background, daemon=True)
+        self.worker.start()
+
+    def _load_manifest(self):
+        live = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            live = manifest["segments"]
+            self.next_segment = manifest["next_segment"]
+        for name in os.listdir(self.directory):
+            # leftovers of a flush or compaction that never made it into the manifest
+            if name.endswith('.sst') and name not in live or name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))
+        self.segments = [ Segment(os.path.join(self.directory, name)) for name in live ]
+        logging.info(f"[lsm] opened {len(self.segments)} segments in {self.directory}")
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"segments": [ s.name for s in self.segments ],
+                       "next_segment": self.next_segment}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def _new_segment_path(self):
+        name = f"seg-{self.next_segment:08d}.sst"
+        self.next_segment += 1
+        return os.path.join(self.directory, name)
+
+    def _lookup(self, key):
+        with self.lock:
+            tables = [self.memtable] + self.immutables
+            segments = list(self.segments)
+        for table in tables:
+            value = table.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        for segment in segments:
+            value = segment.get(key)
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING or value is _TOMBSTONE:
+            return default
+        return value
+
+    def put(self, key, value):
+        # a key the memtable doesn't have may be on disk; the segments'
+        # blooms answer for most new keys without a read. Looked up without
+        # the lock as in delete()
+        existing = self.memtable.get(key, _MISSING)
+        if existing is _MISSING:
+            existing = self._lookup(key)
+        with self.lock:
+            if existing is _MISSING or existing is _TOMBSTONE:
+                self.n_keys += 1
+            self.memtable[key] = value
+            self._maybe_rotate()
+
+    def delete(self, key) -> bool:
+        # looked up without the lock, which only guards the tables; callers
+        # don't delete a key while they write it
+        existing = self._lookup(key)
+        if existing is _MISSING or existing is _TOMBSTONE:
+            return False
+        with self.lock:
+            self.n_keys -= 1
+            self.memtable[key] = _TOMBSTONE
+            self._maybe_rotate()
+            return True
+
+    def size(self) -> int:
+        return self.n_keys
+
+    def _maybe_rotate(self):
+        if len(self.memtable) >= self.memtable_limit:
+            self.immutables.insert(0, self.memtable)
+            self.memtable = {}
+            self.work.notify()
+
+    def items(self):
+        ''' Merge memtables and segments; newer sources shadow older ones.
+            What is merged is fixed when items() is called, the merge itself
+            runs as the result is iterated '''
+        with self.lock:
+            sources = [ sorted(t.items(), key=lambda kv: kv[0]) for t in [self.memtable] + self.immutables ]
+            sources += [ s.entries() for s in self.segments ]
+        return _merge_sources(sources)
+
+    def clear(self):
+        with self.lock:
+            self.memtable = {}
+            self.immutables = []
+            for segment in self.segments:
+                os.remove(segment.path)
+            self.retired += self.segments
+            self.segments = []
+            self.n_keys = 0
+            self._write_manifest()
+
+    def flush(self):
+        with self.lock:
+            if self.memtable:
+                self.immutables.insert(0, self.memtable)
+                self.memtable = {}
+            while self.immutables:
+                self._flush_oldest()
+            # the new segments may make a tier to compact
+            self.work.notify()
+
+    def _flush_oldest(self):
+        ''' Write the oldest immutable memtable to a new segment. Caller holds the lock. '''
+        table = self.immutables[-1]
+        path = self._new_segment_path()
+        Segment.write(path, sorted(table.items(), key=lambda kv: kv[0]))
+        self.segments.insert(0, Segment(path))
+        self.immutables.pop()
+        self._write_manifest()
+
+    def _background(self):
+        while True:
+            with self.lock:
+                while not self.closed and not self.immutables and self._pick_tier() is None:
+                    self.work.wait()
+                if self.closed:
+                    return
+                if self.immutables:
+                    self._flush_oldest()
+                    continue
+                inputs = self._pick_tier()
+                path = self._new_segment_path()
+            # merging happens without the lock; new flushes only add newer segments
+            self._compact(inputs, path)
+
+    def _pick_tier(self):
+        ''' Return: the newest run of at least compaction_trigger adjacent
+            segments of about the same size (newest first), None if there
+            is none. Only adjacent segments are merged, so the output can
+            take their place without reordering what shadows what.
+            Caller holds the lock.
+        '''
+        run, smallest = [], None
+        for segment in self.segments:
+            size = max(segment.file_size, self.tier_min_bytes)
+            if run and size <= self.tier_ratio * smallest:
+                run.append(segment)
+                smallest = min(smallest, size)
+                continue
+            if len(run) >= self.compaction_trigger:
+                return run
+            run, smallest = [segment], size
+        return run if len(run) >= self.compaction_trigger else None
+
+    def _compact(self, inputs, path):
+        ''' Merge `inputs` (adjacent segments, newest first) into a single
+            segment at `path`. Tombstones can only be dropped if the oldest
+            segment is among the inputs; otherwise they still have to
+            shadow older data.
+        '''
+        with self.lock:
+            oldest = inputs[-1] is self.segments[-1]
+        Segment.write(path, _merge_sources([ s.entries() for s in inputs ], keep_tombstones=not oldest))
+        with self.lock:
+            if self.closed or any(s not in self.segments for s in inputs):
+                # cleared (or closed) while we were merging
+                os.remove(path)
+                return
+            start = self.segments.index(inputs[0])
+            self.segments[start:start + len(inputs)] = [ Segment(path) ]
+            self._write_manifest()
+            # readers may still hold the old segments; close them one round later
+            for segment in self.retired:
+                segment.close()
+            self.retired = inputs
+        for segment in inputs:
+            os.remove(segment.path)
+        logging.info(f"[lsm] compacted {len(inputs)} segments into {os.path.basename(path)}")
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.work.notify_all()
+        self.worker.join()
+        for segment in self.segments + self.retired:
+            segment.close()
+
+
+def _merge_sources(sources, keep_tombstones=False):
+    ''' sources: sorted (key, value) iterables, newest first. Yields the
+        newest entry of every key; deleted keys only if keep_tombstones '''
+    # tag every entry with its source's age so the newest wins on equal keys
+    tagged = [ ((key, age, value) for key, value in source) for age, source in enumerate(sources) ]
+    last_key = _MISSING
+    for key, _, value in heapq.merge(*tagged, key=lambda e: (e[0], e[1])):
+        if key == last_key:
+            continue
+        last_key = key
+        if value is not _TOMBSTONE or keep_tombstones:
+            yield key, value
+
+
+def open_engine(name='dict', directory=None, **options):
+    ''' Build the storage engine named by STORAGE_ENGINE '''
+    if name == 'dict':
+        return DictEngine()
+    if name == 'arena':
+        from arena import ArenaEngine # arena.py builds on this module
+        return ArenaEngine(**options)
+    if name == 'lsm':
+        return LSMEngine(directory or 'data', **options)
+    if name == 'tiered':
+        from tiered import TieredEngine
+        return TieredEngine(directory or 'spill', **options)
+    raise ValueError(f"unknown storage engine {name}")
@@ -0,0 +1,314 @@
+import logging
+import threading
+import time
+from collections import deque
+from itertools import islice
+from backlog import BacklogSpill
+
+'''
+Ordered replication streams between shard members.
+
+Instead of one HTTP request per write and replica, a coordinator keeps one
+stream per replica. Writes get consecutive sequence numbers on it, and a
+sender thread ships whatever the replica hasn't acknowledged yet in
+batches (POST /kvs/replicate over the peer's keep-alive connection; writes
+that come in while a batch is on its way go out together in the next).
+The replica answers with a cumulative ack: the sequence number up to which
+it has applied everything. Acked entries are forgotten, so after a failure
+or a gap only what the replica is missing is sent again.
+
+The replica applies the entries of a stream strictly in order. Duplicates
+are skipped and entries after a gap are held until the gap is filled, so
+nothing arrives "too early" any more.
+
+With a coalescing window the sender waits that long before sending what
+is new, and a write to a key whose previous write hasn't gone out yet
+empties the older entry: it stays in the stream as a no-op (so the
+numbering has no holes) and its waiters wait for the newer one. Hot keys
+then cost one entry per window instead of one per write.
+
+Each entry carries the coordinator's causal metadata as of the write; a
+message only carries it once, merged, on its last write, which the
+replica applies after all the others.
+
+A stream is known by its source address and an id the coordinator picks
+when it starts: a restarted coordinator numbers from 1 again and must not
+have its writes taken for duplicates. Every message also carries the
+lowest sequence number the sender still has, so a replica that restarted
+(or missed entries the sender had to drop) resumes from there.
+'''
+
+class ReplicationStream:
+    def __init__(self, addr, source, stream_id, send, on_ack=None, batch=500,
+                 retry=0.2, max_retry=5.0, limit=100000, coalesce=0.0,
+                 spill=None, spill_max_bytes=64 * 2**20):
+        '''
+            Parameters:
+            - addr: the replica
+            - source / stream_id: who we are and which numbering this is
+            - send: send(addr, message) -> the replica's cumulative ack;
+              raises if the replica couldn't be reached
+            - on_ack: on_ack(entries) with the entries the replica has
+              newly acknowledged, before their waiters are told
+            - batch: most entries in one message
+            - retry / max_retry: seconds to wait after a failed send,
+              doubling up to max_retry
+            - limit: unacknowledged entries kept in memory; past that they
+              go to the spill file, or without one the oldest are dropped
+              (and the replica has to be repaired another way)
+            - coalesce: seconds to collect writes before sending them,
+              merging the writes to the same key; 0 sends right away
+            - spill / spill_max_bytes: path and size of the file the backlog
+              past limit goes to (see backlog.py), opened once it's needed
+        '''
+        self.addr = addr
+        self.source = source
+        self.stream_id = stream_id
+        self.send = send
+        self.on_ack = on_ack
+        self.batch = batch
+        self.retry = retry
+        self.max_retry = max_retry
+        self.limit = limit
+        self.coalesce = coalesce
+        self.spill_path = spill
+        self.spill_max_bytes = spill_max_bytes
+        self.spilled = None
+        self.lost = set() # seqs that neither fit in memory nor in the spill file
+        self.lock = threading.Condition()
+        self.pending = deque() # entries not acked yet, oldest first
+        self.next_seq = 1
+        self.acked = 0
+        self.waiters = {} # seq -> [callback(ok)]
+        self.latest = {}  # key -> its last entry not acked yet
+        self.superseded = {} # seq of an emptied entry -> seq of the one that replaced it
+        self.closed = False
+        self.sent = 0    # entries sent, counting every time
+        self.resent = 0  # of those, sent again
+        self.dropped = 0
+        self.coalesced = 0
+        self.highest_sent = 0
+        self.woken = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, method, key, payload) -> int:
+        ''' Queue a write for the replica. Return: its sequence number '''
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            entry = {"seq": seq, "method": method, "key": key, "payload": payload}
+            if self.spill_path is not None and (self.spilled or len(self.pending) >= self.limit):
+                # behind by more than we keep in memory: hand it off to disk,
+                # after whatever is there already
+                self._spill(entry)
+                self.lock.notify_all()
+                return seq
+            superseded = self.latest.get(key)
+            if self.coalesce and superseded is not None and superseded["seq"] > self.highest_sent \
+                    and superseded["payload"] is not None:
+                # not sent yet: only the newer write goes out
+                superseded["payload"] = None
+                self.superseded[superseded["seq"]] = seq
+                self.waiters.setdefault(seq, []).extend(self.waiters.pop(superseded["seq"], ()))
+                self.coalesced += 1
+            self.latest[key] = entry
+            self.pending.append(entry)
+            dropped = []
+            while len(self.pending) > self.limit:
+                dropped.append(self._forget(self.pending.popleft()))
+            self.dropped += len(dropped)
+            callbacks = [ cb for s in dropped for cb in self.waiters.pop(s, ()) ]
+            self.lock.notify_all()
+        if dropped:
+            logging.warning(f"##### stream to {self.addr} is {self.limit} entries behind, dropped {len(dropped)}")
+        for callback in callbacks:
+            callback(False)
+        return seq
+
+    def when_acked(self, seq, callback):
+        ''' Call callback(True) once the replica has applied seq, or
+            callback(False) if the entry is dropped first '''
+        with self.lock:
+            while seq in self.superseded:
+                seq = self.superseded[seq]
+            if seq in self.lost:
+                ok = False
+            elif seq > self.acked and (not self.pending or seq >= self.pending[0]["seq"]):
+                self.waiters.setdefault(seq, []).append(callback)
+                return
+            else:
+                ok = seq <= self.acked
+        callback(ok)
+
+    def _spill(self, entry):
+        if self.spilled is None:
+            self.spilled = BacklogSpill(self.spill_path, self.spill_max_bytes)
+            logging.info(f"##### stream to {self.addr} is {self.limit} entries behind, spilling to {self.spill_path}")
+        if not self.spilled.append(entry):
+            if not self.lost:
+                logging.warning(f"##### spill file for {self.addr} is full, dropping writes until it catches up")
+            self.lost.add(entry["seq"])
+            self.dropped += 1
+
+    def _refill(self):
+        ''' Bring spilled entries back into memory as there is room '''
+        if self.spilled and len(self.pending) <= self.limit // 2:
+            self.pending.extend(self.spilled.read(self.limit - len(self.pending)))
+
+    def wake(self):
+        ''' The replica is back: send now instead of after the back-off '''
+        with self.lock:
+            self.woken = True
+            self.lock.notify_all()
+
+    def _run(self):
+        delay = self.retry
+        while True:
+            with self.lock:
+                self._refill()
+                while not self.pending and not self.closed:
+                    self.lock.wait()
+                    self._refill()
+                if self.closed:
+                    return
+                if self.coalesce and self.pending[-1]["seq"] > self.highest_sent:
+                    deadline = time.monotonic() + self.coalesce
+                    while not self.closed and time.monotonic() < deadline:
+                        self.lock.wait(deadline - time.monotonic())
+                    if self.closed:
+                        return
+                entries = list(islice(self.pending, self.batch))
+                self.sent += len(entries)
+                self.resent += sum(1 for e in entries if e["seq"] <= self.highest_sent)
+                self.highest_sent = max(self.highest_sent, entries[-1]["seq"])
+                message = { "from": self.source, "stream": self.stream_id,
+                            "floor": entries[0]["seq"], "entries": _pack(entries) }
+            try:
+                ack = self.send(self.addr, message)
+            except Exception as e:
+                logging.info(f"##### stream to {self.addr} failed: {e}")
+                ack = None
+
+            if ack is not None and ack > self.acked:
+                self._advance(ack)
+                delay = self.retry
+                continue
+            # unreachable, or it applied nothing new: don't hammer it
+            with self.lock:
+                # new writes don't cut the back-off short, only wake() does
+                deadline = time.monotonic() + delay
+                while not self.closed and not self.woken and time.monotonic() < deadline:
+                    self.lock.wait(deadline - time.monotonic())
+                woken, self.woken = self.woken, False
+            delay = self.retry if woken else min(delay * 2, self.max_retry)
+
+    def _advance(self, ack):
+        with self.lock:
+            ack = min(ack, self.next_seq - 1)
+            done = []
+            while self.pending and self.pending[0]["seq"] <= ack:
+                done.append(self.pending.popleft())
+                self._forget(done[-1])
+            self.acked = max(self.acked, ack)
+            if self.lost:
+                self.lost = { seq for seq in self.lost if seq > self.acked }
+            callbacks = [ cb for e in done for cb in self.waiters.pop(e["seq"], ()) ]
+        if self.on_ack is not None and done:
+            self.on_ack(done)
+        for callback in callbacks:
+            callback(True)
+
+    def _forget(self, entry) -> int:
+        if self.latest.get(entry["key"]) is entry:
+            del self.latest[entry["key"]]
+        self.superseded.pop(entry["seq"], None)
+        return entry["seq"]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            callbacks = [ cb for cbs in self.waiters.values() for cb in cbs ]
+            self.waiters.clear()
+            self.lock.notify_all()
+            if self.spilled is not None:
+                self.spilled.close()
+                self.spilled = None
+        for callback in callbacks:
+            callback(False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "acked": self.acked,
+                "sent": self.sent,
+                "resent": self.resent,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "spilled": len(self.spilled) if self.spilled else 0,
+            }
+
+
+def _pack(entries) -> list:
+    ''' The entries as sent: the causal metadata of all of them merged onto
+        the last write (entries are shared by the streams of a write, so
+        they are copied, not changed) '''
+    merged = {}
+    packed = []
+    for entry in entries:
+        payload = entry["payload"]
+        if payload is not None and "causal-metadata" in payload:
+            for addr, clock in payload["causal-metadata"].items():
+                merged[addr] = max(merged.get(addr, 0), clock)
+            payload = { k: v for k, v in payload.items() if k != "causal-metadata" }
+        packed.append(dict(entry, payload=payload))
+    last = next((e for e in reversed(packed) if e["payload"] is not None), None)
+    if merged and last is not None:
+        last["payload"]["causal-metadata"] = merged
+    return packed
+
+
+class StreamReceiver:
+    def __init__(self, apply):
+        '''
+            Parameters:
+            - apply: apply(source, entry) -> bool; False means it can't be
+              applied yet, and it is tried again with the next message
+        '''
+        self.apply = apply
+        self.lock = threading.Lock()
+        self.streams = {} # source -> [stream id, last applied seq, {seq: held entry}]
+        self.locks = {}   # source -> lock; streams from different sources apply in parallel
+
+    def receive(self, source, stream_id, entries, floor=1) -> int:
+        ''' Apply what can be applied in order.
+            Return:
+            - the cumulative ack: everything up to it has been applied
+        '''
+        with self.lock:
+            lock = self.locks.setdefault(source, threading.Lock())
+        with lock:
+            state = self.streams.get(source)
+            if state is None or state[0] != stream_id:
+                # new coordinator (or we restarted): start where it is
+                state = self.streams[source] = [stream_id, floor - 1, {}]
+            elif state[1] < floor - 1:
+                logging.warning(f"##### stream from {source} skips {state[1] + 1}..{floor - 1}, the sender dropped them")
+                state[1] = floor - 1
+                state[2] = { seq: e for seq, e in state[2].items() if seq >= floor }
+
+            held = state[2]
+            for entry in entries:
+                if entry["seq"] > state[1]:
+                    held.setdefault(entry["seq"], entry)
+            while state[1] + 1 in held:
+                if not self.apply(source, held[state[1] + 1]):
+                    break
+                del held[state[1] + 1]
+                state[1] += 1
+            return state[1]
+
+    def status(self) -> dict:
+        with self.lock:
+            return { source: {"applied": state[1], "held": len(state[2])} for source, state in self.streams.items() }
@@ -0,0 +1,55 @@
+import unittest
+from arena import ArenaEngine
+from storage import open_engine
+from test_storage import EngineContract
+
+class TestArenaEngine(EngineContract, unittest.TestCase):
+    def make_engine(self):
+        return open_engine('arena')
+
+    def test_grows_index(self):
+        kvs = ArenaEngine(capacity=8)
+        for i in range(1000):
+            kvs.put(f"key{i}", i)
+        self.assertEqual(kvs.size(), 1000)
+        self.assertGreaterEqual(len(kvs.key_slots), 1024)
+        for i in range(1000):
+            self.assertEqual(kvs.get(f"key{i}"), i)
+
+    def test_overwrite_and_delete_leave_garbage_until_compaction(self):
+        kvs = ArenaEngine()
+        kvs.put("a", "x" * 100)
+        kvs.put("a", "y" * 100)
+        self.assertEqual(kvs.get("a"), "y" * 100)
+        self.assertGreater(kvs.dead_bytes, 100)
+        kvs.put("b", 1)
+        kvs.delete("b")
+        kvs.compact()
+        self.assertEqual(kvs.dead_bytes, 0)
+        self.assertEqual(kvs.to_dict(), {"a": "y" * 100})
+        self.assertEqual(kvs.used_slots, 1)
+
+    def test_automatic_compaction_bounds_buffers(self):
+        kvs = ArenaEngine()
+        for round in range(50):
+            for i in range(100):
+                kvs.put(f"key{i}", f"value-{round}-{i}")
+        live = sum(len(f'"value-49-{i}"') + 4 for i in range(100))
+        self.assertLess(len(kvs.values), live * 3)
+        self.assertEqual(kvs.get("key7"), "value-49-7")
+
+    def test_deleted_slots_are_reused(self):
+        kvs = ArenaEngine(capacity=16)
+        for round in range(100):
+            kvs.put(f"key{round}", round)
+            kvs.delete(f"key{round}")
+        self.assertEqual(kvs.size(), 0)
+        self.assertLessEqual(len(kvs.key_slots), 16)
+
+    def test_key_too_long(self):
+        with self.assertRaises(ValueError):
+            ArenaEngine().put("ü" * 200, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
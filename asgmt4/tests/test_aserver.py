@@ -0,0 +1,149 @@
+import asyncio
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import requests
+import server
+from aserver import AsyncServer
+
+ME = '10.10.0.2:8090'
+
+class Peer(BaseHTTPRequestHandler):
+    ''' Another node: records what it gets and says "created" '''
+    protocol_version = "HTTP/1.1"
+    received = []
+
+    def _answer(self):
+        length = int(self.headers.get('Content-Length', 0))
+        Peer.received.append((self.command, self.path, json.loads(self.rfile.read(length) or b'{}')))
+        body = b'{"result": "created", "causal-metadata": {}}'
+        self.send_response(201)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_GET = do_DELETE = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsyncServer(unittest.TestCase):
+    def setUp(self):
+        Peer.received = []
+        self.peer = ThreadingHTTPServer(('127.0.0.1', 0), Peer)
+        self.peer_addr = f'127.0.0.1:{self.peer.server_address[1]}'
+        threading.Thread(target=self.peer.serve_forever, daemon=True).start()
+        self.addCleanup(self.peer.server_close)
+        self.addCleanup(self.peer.shutdown)
+
+        self.kserver = server.Server("test_aserver")
+        patcher = mock.patch('server.SOCKET_ADDRESS', ME)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.kserver.kv_store
+        self.store.address = ME
+        self.store.local_causal_metadata = {ME: 0, self.peer_addr: 0}
+        self.store.shard_members = {"s0": [ME]}
+        self.store.shard_id = "s0"
+        self.store.compactor_thread = mock.Mock()
+
+        loop = asyncio.new_event_loop()
+        self.aserver = AsyncServer(self.kserver, workers=4)
+        listener = loop.run_until_complete(self.aserver.start('127.0.0.1', 0))
+        self.url = f'http://127.0.0.1:{listener.sockets[0].getsockname()[1]}'
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def shutdown():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            listener.close()
+            # let the open connections see they are cancelled
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            async def drain():
+                await asyncio.gather(*tasks, return_exceptions=True)
+            loop.run_until_complete(drain())
+            loop.close()
+        self.addCleanup(shutdown)
+
+    def test_local_routes(self):
+        res = requests.put(f'{self.url}/kvs/a', json={"value": 1})
+        self.assertEqual(res.status_code, 201)
+        res = requests.get(f'{self.url}/kvs/a', json={})
+        self.assertEqual(res.json()["value"], 1)
+        self.assertEqual(requests.get(f'{self.url}/shard/node-shard-id').status_code, 200)
+        self.assertEqual(requests.get(f'{self.url}/nope').status_code, 404)
+
+    def test_streamed_response(self):
+        for i in range(5):
+            self.store.load_all({f"k{i}": i})
+        res = requests.get(f'{self.url}/kvs/fetchAll', params={"format": "ndjson"}, stream=True)
+        self.assertEqual(res.headers["Transfer-Encoding"], 'chunked')
+        lines = [ json.loads(line) for line in res.iter_lines() ]
+        self.assertEqual(lines[1]["kvs"], { f"k{i}": i for i in range(5) })
+        self.assertEqual(lines[-1], {"end": True})
+
+    def test_keep_alive(self):
+        with requests.Session() as session:
+            for i in range(5):
+                self.assertEqual(session.put(f'{self.url}/kvs/k{i}', json={"value": i}).status_code, 201)
+        self.assertEqual(self.store.kvs.size(), 5)
+
+    def test_forwards_to_owning_shard(self):
+        self.store.shard_members = {"s0": [ME], "s1": [self.peer_addr]}
+        key = next(k for k in (f"k{i}" for i in range(100)) if self.store._hash(k) == "s1")
+        res = requests.put(f'{self.url}/kvs/{key}', json={"value": 1, "acks": "one"})
+        self.assertEqual(res.status_code, 201)
+        method, path, payload = Peer.received[0]
+        self.assertEqual((method, path), ('PUT', f'/kvs/{key}'))
+        self.assertEqual(payload["value"], 1)
+        self.assertTrue(payload["broadcast"])
+        self.assertEqual(payload["acks"], "one")
+        self.assertNotIn(key, self.store.kvs)
+
+    def test_checks_before_forwarding(self):
+        self.store.shard_members = {"s0": [ME], "s1": [self.peer_addr]}
+        key = next(k for k in (f"k{i}" for i in range(100)) if self.store._hash(k) == "s1")
+        res = requests.put(f'{self.url}/kvs/{key}', json={"value": 1}, headers={"X-Shard-Id": "s0"})
+        self.assertEqual(res.status_code, 421)
+        self.assertEqual(res.json()["shard-id"], "s1")
+        for bad in ({"value": 1, "ttl": -1}, {"value": 1, "acks": "some"}, {}):
+            self.assertEqual(requests.put(f'{self.url}/kvs/{key}', json=bad).status_code, 400)
+        self.assertEqual(requests.delete(f'{self.url}/kvs/{key}', json={"acks": "some"}).status_code, 400)
+        self.assertEqual(Peer.received, [])
+
+    def test_replicates_on_the_loop(self):
+        self.store.shard_members = {"s0": [ME, self.peer_addr]}
+        with mock.patch('server.REPLICATION_STREAM', False), \
+             mock.patch('server.peers.put') as blocking_put:
+            res = requests.put(f'{self.url}/kvs/a', json={"value": 1, "acks": "all"})
+        blocking_put.assert_not_called()
+        self.assertEqual(res.status_code, 201)
+        # the reply carries the replica's ack
+        self.assertEqual(res.json()["causal-metadata"][self.peer_addr], 1)
+        method, _, payload = Peer.received[0]
+        self.assertEqual(method, 'PUT')
+        self.assertFalse(payload["broadcast"])
+        self.assertEqual(payload["version"], self.store.versions["a"])
+
+    def test_waits_for_stream_acks_on_the_loop(self):
+        self.store.shard_members = {"s0": [ME, self.peer_addr]}
+        sent = []
+        def send(view, message):
+            sent.append(view)
+            return message["entries"][-1]["seq"]
+        self.store._send_stream = send
+        with mock.patch('server.REPLICATION_STREAM', True):
+            res = requests.put(f'{self.url}/kvs/a', json={"value": 1, "acks": "all"})
+        self.addCleanup(self.store.streams[self.peer_addr].close)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json()["causal-metadata"][self.peer_addr], 1)
+        self.assertEqual(sent, [self.peer_addr])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from unittest import mock
+import requests
+import server
+
+ME, PEER = '10.10.0.2:8090', '10.10.0.3:8090'
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.kserver = server.Server("test_batch")
+        patcher = mock.patch('server.SOCKET_ADDRESS', ME)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.kserver.kv_store
+        self.store.address = ME
+        self.store.local_causal_metadata = {ME: 0, PEER: 0}
+        self.store.shard_members = {"s0": [ME]}
+        self.store.shard_id = "s0"
+        self.store.compactor_thread = mock.Mock()
+        self.client = self.kserver.app.test_client()
+
+    def test_local_ops_run_in_order(self):
+        ops = [{"op": "PUT", "key": "a", "value": 1}, {"op": "PUT", "key": "b", "value": 2},
+               {"op": "GET", "key": "a"}, {"op": "DELETE", "key": "b"}, {"op": "GET", "key": "b"}]
+        res = self.client.post('/kvs/batch', json={"ops": ops})
+        self.assertEqual(res.status_code, 200)
+        results = res.json["results"]
+        self.assertEqual([r["status"] for r in results], [201, 201, 200, 200, 404])
+        self.assertEqual(results[2]["value"], 1)
+        self.assertEqual(res.json["causal-metadata"][ME], 3)
+
+    def test_scatter_one_request_per_shard(self):
+        self.store.shard_members = {"s0": [ME], "s1": [PEER]}
+        keys = [ f"k{i}" for i in range(10) ]
+        theirs = [ k for k in keys if self.store._hash(k) == "s1" ]
+        answer = mock.Mock(status_code=200)
+        answer.json.return_value = {
+            "results": [ {"key": k, "status": 201, "result": "created"} for k in theirs ],
+            "causal-metadata": {ME: 0, PEER: 7}
+        }
+        with mock.patch('server.peers.post', return_value=answer) as post:
+            res = self.client.post('/kvs/batch', json={"ops": [ {"op": "PUT", "key": k, "value": k} for k in keys ]})
+        post.assert_called_once()
+        self.assertEqual(post.call_args.args[0], f'http://{PEER}/kvs/batch')
+        self.assertEqual([ op["key"] for op in post.call_args.kwargs["json"]["ops"] ], theirs)
+        self.assertEqual([ r["key"] for r in res.json["results"] ], keys)
+        self.assertTrue(all(r["status"] == 201 for r in res.json["results"]))
+        self.assertEqual(res.json["causal-metadata"], {ME: len(keys) - len(theirs), PEER: 7})
+
+    def test_unreachable_shard(self):
+        self.store.shard_members = {"s0": [ME], "s1": [PEER]}
+        key = next(k for k in (f"k{i}" for i in range(100)) if self.store._hash(k) == "s1")
+        with mock.patch('server.peers.post', side_effect=requests.exceptions.ConnectionError()), \
+             mock.patch('server.peers.is_up', return_value=True):
+            res = self.client.post('/kvs/batch', json={"ops": [{"op": "GET", "key": key}]})
+        self.assertEqual(res.json["results"][0]["status"], 503)
+
+    def test_bad_batches(self):
+        self.assertEqual(self.client.post('/kvs/batch', json={}).status_code, 400)
+        self.assertEqual(self.client.post('/kvs/batch', json={"ops": [{"op": "PUT", "key": "a"}]}).status_code, 400)
+        self.assertEqual(self.client.post('/kvs/batch', json={"ops": [{"op": "POP", "key": "a"}]}).status_code, 400)
+        self.assertEqual(self.store.kvs.size(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
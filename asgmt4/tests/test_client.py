@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from urllib.parse import urlsplit
+import server
+from kvsclient import KVSClient, AsyncKVSClient, shard_for
+
+A, B = '10.10.0.2:8090', '10.10.0.3:8090'
+SHARDS = {"s0": [A], "s1": [B]}
+
+class TestSmartClient(unittest.TestCase):
+    def node(self, addr, shard_id):
+        kserver = server.Server(f"test_client_{addr}")
+        store = kserver.kv_store
+        store.address = addr
+        store.local_causal_metadata = {A: 0, B: 0}
+        store.shard_members = {k: list(v) for k, v in SHARDS.items()}
+        kserver.shard.shard_members = {k: list(v) for k, v in SHARDS.items()}
+        # publish it on /shard/map; the store above is set up already
+        with mock.patch.object(kserver.shard, 'notify', None):
+            kserver.shard._map_changed()
+        store.shard_id = shard_id
+        store.compactor_thread = mock.Mock()
+        return kserver
+
+    def setUp(self):
+        self.nodes = {A: self.node(A, "s0"), B: self.node(B, "s1")}
+        self.clients = {addr: node.app.test_client() for addr, node in self.nodes.items()}
+        self.sent = []
+        self.lock = threading.Lock()
+        self.client = KVSClient([A], backoff=0.01, retries=5)
+        self.client.session.request = self.route
+        self.client.session.get = lambda url, **kwargs: self.route('GET', url, **kwargs)
+        # nodes may not forward: every request has to land on the owner
+        for name in ('get', 'put', 'post', 'delete'):
+            patcher = mock.patch(f'server.peers.{name}', side_effect=AssertionError("forwarded"))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def route(self, method, url, json=None, headers=None, **kwargs):
+        parts = urlsplit(url)
+        # the nodes share the module, so one at a time
+        with self.lock, mock.patch('server.SOCKET_ADDRESS', parts.netloc):
+            res = self.clients[parts.netloc].open(parts.path, method=method, json=json, headers=headers)
+        self.sent.append((method, parts.netloc, parts.path, dict(headers or {}), res.status_code))
+        return mock.Mock(status_code=res.status_code, json=res.get_json, headers=res.headers)
+
+    def test_hash_matches_server(self):
+        store = self.nodes[A].kv_store
+        for i in range(500):
+            self.assertEqual(shard_for(f"key{i}", list(SHARDS)), store._hash(f"key{i}"))
+
+    def test_goes_straight_to_owner(self):
+        keys = [ f"key{i}" for i in range(20) ]
+        for i, key in enumerate(keys):
+            self.assertEqual(self.client.put(key, i), "created")
+        for i, key in enumerate(keys):
+            self.assertEqual(self.client.get(key), i)
+        for method, addr, path, headers, status in self.sent:
+            if path.startswith('/kvs/'):
+                owner = shard_for(path[len('/kvs/'):], list(SHARDS))
+                self.assertEqual([addr], SHARDS[owner])
+                self.assertEqual(headers["X-Shard-Id"], owner)
+        self.client.delete(keys[0])
+        with self.assertRaises(KeyError):
+            self.client.get(keys[0])
+
+    def test_tracks_causal_metadata(self):
+        self.client.put("x", 1)
+        self.client.put("y", 2)
+        clocks = { addr: self.nodes[addr].kv_store.local_causal_metadata[addr] for addr in (A, B) }
+        self.assertEqual(self.client.causal_metadata, clocks)
+        self.sent.clear()
+        with mock.patch.object(self.client.session, 'request', wraps=self.route) as request:
+            self.client.get("x")
+        self.assertEqual(request.call_args.kwargs["json"]["causal-metadata"], clocks)
+
+    def test_refreshes_stale_map(self):
+        self.client.refresh()
+        # what an older node told us: the shards swapped nodes since
+        self.client.shard_members = {"s0": [B], "s1": [A]}
+        self.client.map_etag = None
+        self.client.put("x", 1)
+        owner = SHARDS[shard_for("x", list(SHARDS))][0]
+        other = B if owner == A else A
+        self.assertEqual([ (addr, status) for _, addr, path, _, status in self.sent if path == '/kvs/x' ],
+                         [(other, 421), (owner, 201)])
+        self.assertEqual(self.client.shard_members, SHARDS)
+
+    def test_async(self):
+        async def run():
+            async with AsyncKVSClient(client=self.client) as client:
+                await asyncio.gather(*[ client.put(f"k{i}", i) for i in range(10) ])
+                return await asyncio.gather(*[ client.get(f"k{i}") for i in range(10) ])
+        self.assertEqual(asyncio.run(run()), list(range(10)))
+
+if __name__ == '__main__':
+    unittest.main()
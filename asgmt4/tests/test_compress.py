@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+import server
+from compress import ValueCodec, is_encoded
+
+BLOB = {"items": [{"id": i, "name": "widget", "tags": ["a", "b", "c"]} for i in range(200)]}
+
+class TestValueCodec(unittest.TestCase):
+    def test_small_values_untouched(self):
+        codec = ValueCodec(threshold=1024)
+        self.assertEqual(codec.encode("short"), "short")
+        self.assertEqual(codec.encode({"a": 1}), {"a": 1})
+
+    def test_round_trip(self):
+        for name in ("zlib", "lzma"):
+            codec = ValueCodec(threshold=64, codec=name)
+            encoded = codec.encode(BLOB)
+            self.assertTrue(is_encoded(encoded))
+            self.assertEqual(encoded["$z"], name)
+            self.assertEqual(codec.decode(encoded), BLOB)
+            stats = codec.stats()
+            self.assertEqual(stats["values-compressed"], 1)
+            self.assertGreater(stats["ratio"], 5)
+
+    def test_marker_lookalike_is_escaped(self):
+        codec = ValueCodec(threshold=0)
+        value = {"$z": "zlib", "data": "not really"}
+        self.assertEqual(codec.decode(codec.encode(value)), value)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            ValueCodec(codec="snappy")
+
+
+class TestCompressedStore(unittest.TestCase):
+    def setUp(self):
+        self.kserver = server.Server("test_compress")
+        patcher = mock.patch('server.SOCKET_ADDRESS', '10.10.0.2:8090')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.kserver.kv_store
+        self.store.address = '10.10.0.2:8090'
+        self.store.local_causal_metadata = {'10.10.0.2:8090': 0}
+        self.store.shard_members = {"s0": ['10.10.0.2:8090']}
+        self.store.shard_id = "s0"
+        self.client = self.kserver.app.test_client()
+
+    def test_stored_compressed_read_back_raw(self):
+        res = self.client.put('/kvs/blob', json={"value": BLOB, "broadcast": False})
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(is_encoded(self.store.kvs.get("blob")))
+        self.assertEqual(self.client.get('/kvs/blob', json={}).json["value"], BLOB)
+        self.assertEqual(self.client.get('/kvs?prefix=blob').json["kvs"], {"blob": BLOB})
+
+        stats = self.client.get('/kvs/stats').json["compression"]
+        self.assertEqual(stats["values-compressed"], 1)
+        self.assertEqual(stats["values-decompressed"], 2)
+
+    def test_peer_values_not_encoded_twice(self):
+        encoded = self.store.codec.encode(BLOB)
+        self.client.put('/kvs/blob', json={"value": encoded, "value-encoded": True, "broadcast": False})
+        self.assertEqual(self.store.kvs.get("blob"), encoded)
+        self.assertEqual(self.client.get('/kvs/blob', json={}).json["value"], BLOB)
+
+    def test_client_cannot_claim_encoded(self):
+        # a client's "value-encoded" is dropped: its value is just a value
+        lookalike = {"$z": "zlib", "data": "garbage"}
+        res = self.client.put('/kvs/fake', json={"value": lookalike, "value-encoded": True})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(self.client.get('/kvs/fake', json={}).json["value"], lookalike)
+        self.assertEqual(self.client.get('/kvs?prefix=fake').json["kvs"], {"fake": lookalike})
+
+if __name__ == '__main__':
+    unittest.main()
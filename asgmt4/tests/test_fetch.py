@@ -0,0 +1,88 @@
+import gzip
+import json
+import unittest
+from unittest import mock
+import requests
+import server
+
+class TestStreamingFetchAll(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('server.FETCH_CHUNK_KEYS', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.donor = server.Server("donor")
+        self.donor.kv_store.compactor_thread = mock.Mock()
+        self.data = { f"k{i:03}": i for i in range(25) }
+        self.donor.kv_store.load_all(self.data, {"k001": 4e9}, { k: 100.0 + i for i, k in enumerate(self.data) },
+                                     {"gone": 50.0})
+        self.client = self.donor.app.test_client()
+
+    def lines(self, **params):
+        res = self.client.get('/kvs/fetchAll', query_string=dict(params, format="ndjson"),
+                              headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(res.headers["Content-Encoding"], 'gzip')
+        return [ json.loads(line) for line in gzip.decompress(res.data).splitlines() ]
+
+    def test_chunks_in_key_order(self):
+        lines = self.lines()
+        self.assertIn("causal_metadata", lines[0])
+        self.assertEqual(lines[1], {"tombstones": {"gone": 50.0}})
+        chunks = lines[2:-1]
+        self.assertEqual([ len(c["kvs"]) for c in chunks ], [10, 10, 5])
+        self.assertEqual([ k for c in chunks for k in c["kvs"] ], sorted(self.data))
+        self.assertEqual(chunks[0]["expires-at"], {"k001": 4e9})
+        self.assertEqual(chunks[0]["cursor"], "k009")
+        self.assertEqual(lines[-1], {"end": True})
+
+    def test_resume_after_cursor(self):
+        lines = self.lines(cursor="k019")
+        self.assertEqual([ list(line) for line in lines ], [["causal_metadata"], ["kvs", "expires-at", "versions", "cursor"], ["end"]])
+        self.assertEqual(list(lines[1]["kvs"]), [ f"k{i:03}" for i in range(20, 25) ])
+
+    def answer(self, params, cut=None):
+        ''' What the donor sends, the way requests hands it over; with
+            `cut` the connection drops after that many lines '''
+        res = self.client.get('/kvs/fetchAll', query_string=params)
+        lines = res.data.splitlines()
+        def iter_lines():
+            for i, line in enumerate(lines):
+                if i == cut:
+                    raise requests.exceptions.ChunkedEncodingError("connection reset")
+                yield line
+        answer = mock.MagicMock(status_code=200, headers={"Content-Type": res.headers["Content-Type"]})
+        answer.__enter__.return_value = answer
+        answer.iter_lines = iter_lines
+        return answer
+
+    def test_receiver_resumes_broken_transfer(self):
+        joiner = server.Server("joiner")
+        joiner.kv_store.compactor_thread = mock.Mock()
+        joiner.kv_store.load_all({"stale": 1})
+        sent = []
+        def get(url, params=None, **kwargs):
+            sent.append(dict(params))
+            # the first transfer breaks off after the second chunk
+            return self.answer(params, cut=4 if len(sent) == 1 else None)
+        with mock.patch('server.peers.get', side_effect=get), \
+             mock.patch.object(joiner.kv_store, '_replicate_snapshot', return_value=False):
+            self.assertTrue(joiner.kv_store.replicate_kvs("donor:8090"))
+        self.assertEqual(sent, [{"format": "ndjson"}, {"format": "ndjson", "cursor": "k019"}])
+        store = joiner.kv_store
+        self.assertEqual(store.kvs.to_dict(), self.data)
+        self.assertEqual(store.versions, self.donor.kv_store.versions)
+        self.assertEqual(store.expiry.deadline("k001"), 4e9)
+        self.assertEqual(store.tombstones.version("gone"), 50.0)
+
+    def test_receiver_takes_whole_document_from_old_nodes(self):
+        joiner = server.Server("joiner")
+        old = mock.MagicMock(status_code=200, headers={"Content-Type": "application/json"})
+        old.__enter__.return_value = old
+        old.json.return_value = self.client.get('/kvs/fetchAll').json
+        with mock.patch('server.peers.get', return_value=old), \
+             mock.patch.object(joiner.kv_store, '_replicate_snapshot', return_value=False):
+            self.assertTrue(joiner.kv_store.replicate_kvs("donor:8090"))
+        self.assertEqual(joiner.kv_store.kvs.to_dict(), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import random
+import unittest
+from index import SortedKeyIndex
+from server import Server
+
+class TestSortedKeyIndex(unittest.TestCase):
+    def setUp(self):
+        self.keys = [ f"user:{i:04d}" for i in range(1000) ] + [ f"cart:{i:03d}" for i in range(100) ]
+        shuffled = self.keys.copy()
+        random.shuffle(shuffled)
+        self.index = SortedKeyIndex(block_size=16)
+        for key in shuffled:
+            self.index.add(key)
+
+    def test_adds_keep_order(self):
+        self.assertEqual(len(self.index), 1100)
+        self.assertEqual(self.index.scan(), sorted(self.keys))
+        self.index.add("user:0001")
+        self.assertEqual(len(self.index), 1100)
+
+    def test_range(self):
+        self.assertEqual(self.index.scan(start="user:0010", end="user:0013"),
+                         ["user:0010", "user:0011", "user:0012"])
+        self.assertEqual(self.index.scan(start="cart:098", limit=3), ["cart:098", "cart:099", "user:0000"])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.scan(prefix="cart:"), sorted(k for k in self.keys if k.startswith("cart:")))
+        self.assertEqual(self.index.scan(prefix="user:099"), [ f"user:099{i}" for i in range(10) ])
+        self.assertEqual(self.index.scan(prefix="nothing"), [])
+
+    def test_paging_with_after(self):
+        seen = []
+        after = None
+        while True:
+            page = self.index.scan(prefix="user:", after=after, limit=64)
+            if not page:
+                break
+            seen += page
+            after = page[-1]
+        self.assertEqual(seen, sorted(k for k in self.keys if k.startswith("user:")))
+
+    def test_discard(self):
+        for key in self.keys[:500]:
+            self.index.discard(key)
+        self.index.discard("not-there")
+        self.assertEqual(len(self.index), 600)
+        self.assertEqual(self.index.scan(), sorted(self.keys[500:]))
+
+
+class TestScanApi(unittest.TestCase):
+    def test_paginated_prefix_scan(self):
+        kserver = Server("test_scan")
+        kserver.kv_store.load_all({f"a{i}": i for i in range(5)} | {"b": "x"})
+        client = kserver.app.test_client()
+
+        res = client.get('/kvs?prefix=a&limit=3')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json["kvs"], {"a0": 0, "a1": 1, "a2": 2})
+        self.assertEqual(res.json["next-cursor"], "a2")
+
+        res = client.get(f'/kvs?prefix=a&limit=3&cursor={res.json["next-cursor"]}')
+        self.assertEqual(res.json["kvs"], {"a3": 3, "a4": 4})
+        self.assertIsNone(res.json["next-cursor"])
+
+        res = client.get('/kvs?start=a4&end=c')
+        self.assertEqual(res.json["kvs"], {"a4": 4, "b": "x"})
+
+        self.assertEqual(client.get('/kvs?limit=0').status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+from unittest import mock
+import server
+from merkle import MerkleTree
+
+ME, PEER = '10.10.0.2:8090', '10.10.0.3:8090'
+
+class TestMerkleTree(unittest.TestCase):
+    def test_incremental_matches_rebuild(self):
+        tree = MerkleTree(fanout=4, depth=3)
+        for i in range(200):
+            tree.put(f"k{i}", i)
+        tree.put("k7", 1000)
+        tree.discard("k8")
+        tree.discard("nope")
+        fresh = MerkleTree(fanout=4, depth=3)
+        fresh.rebuild([ (f"k{i}", 1000 if i == 7 else i) for i in range(200) if i != 8 ])
+        self.assertEqual(tree.root(), fresh.root())
+        self.assertEqual(tree.nodes, fresh.nodes)
+        self.assertEqual(len(tree), 199)
+
+    def test_diff_narrows_to_leaves(self):
+        a, b = MerkleTree(fanout=4, depth=3), MerkleTree(fanout=4, depth=3)
+        for i in range(200):
+            a.put(f"k{i}", i)
+            b.put(f"k{i}", i)
+        b.put("k42", 43)
+        nodes = [0]
+        while not a.is_leaf(nodes[0]):
+            nodes = a.diff(nodes, b.hashes(nodes))
+        self.assertEqual(nodes, [a.leaf("k42")])
+        self.assertIn("k42", a.keys(nodes))
+        a.discard("k42")
+        a.put("k42", 43)
+        self.assertEqual(a.root(), b.root())
+
+
+class TestAntiEntropy(unittest.TestCase):
+    def node(self, addr):
+        kserver = server.Server(f"test_merkle_{addr}")
+        store = kserver.kv_store
+        store.address = addr
+        store.local_causal_metadata = {ME: 0, PEER: 0}
+        store.shard_members = {"s0": [ME, PEER]}
+        store.shard_id = "s0"
+        store.compactor_thread = mock.Mock()
+        return kserver
+
+    def setUp(self):
+        self.mine = self.node(ME)
+        self.theirs = self.node(PEER)
+        data = { f"k{i}": i for i in range(2000) }
+        versions = { key: 100.0 + i for i, key in enumerate(data) }
+        self.mine.kv_store.load_all(data, None, versions)
+        self.theirs.kv_store.load_all(data, None, versions)
+        client = self.theirs.app.test_client()
+        self.requests = []
+        def post(url, json=None, **kwargs):
+            path = url[len(f'http://{PEER}'):]
+            self.requests.append((path, json))
+            res = client.post(path, json=json)
+            return mock.Mock(status_code=res.status_code, json=res.get_json)
+        patcher = mock.patch('server.peers.post', side_effect=post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_in_sync(self):
+        self.assertEqual(self.mine.kv_store.sync_with(PEER), 0)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_pulls_only_what_differs(self):
+        theirs = self.theirs.kv_store
+        theirs.load_all({"k5": "new", "extra": 1}, None, {"k5": 5000.0, "extra": 5000.0}, {"k9": 5000.0})
+        # ours is newer here, it stays
+        self.mine.kv_store.load_all({"k6": "mine"}, None, {"k6": 6000.0})
+        self.theirs.kv_store.local_causal_metadata[PEER] = 3
+
+        mine = self.mine.kv_store
+        self.assertEqual(mine.sync_with(PEER), 3)
+        self.assertEqual(mine.kvs.get("k5"), "new")
+        self.assertEqual(mine.kvs.get("extra"), 1)
+        self.assertNotIn("k9", mine.kvs)
+        self.assertEqual(mine.kvs.get("k6"), "mine")
+        self.assertEqual(mine.local_causal_metadata[PEER], 3)
+        # only the leaves that differ came over
+        pulled = [ body["leaves"] for path, body in self.requests if path == '/kvs/merkle/leaves' ]
+        self.assertLessEqual(sum(len(leaves) for leaves in pulled), 4)
+
+        # and the other way round they converge
+        self.requests.clear()
+        with mock.patch('server.peers.post', side_effect=self.mirror()):
+            theirs.sync_with(ME)
+        self.assertEqual(theirs.kvs.get("k6"), "mine")
+        self.assertEqual(mine.merkle.root(), theirs.merkle.root())
+
+    def mirror(self):
+        client = self.mine.app.test_client()
+        def post(url, json=None, **kwargs):
+            res = client.post(url[len(f'http://{ME}'):], json=json)
+            return mock.Mock(status_code=res.status_code, json=res.get_json)
+        return post
+
+    def test_unreachable(self):
+        with mock.patch('server.peers.post', side_effect=server.requests.exceptions.ConnectionError()):
+            self.assertIsNone(self.mine.kv_store.sync_with(PEER))
+
+if __name__ == '__main__':
+    unittest.main()
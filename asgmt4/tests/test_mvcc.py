@@ -0,0 +1,109 @@
+import tempfile
+import threading
+import unittest
+from mvcc import MVCCEngine
+from storage import DictEngine, LSMEngine
+from tiered import TieredEngine
+from test_storage import EngineContract
+
+class TestMVCCEngine(EngineContract, unittest.TestCase):
+    def make_engine(self):
+        return MVCCEngine(DictEngine())
+
+    def test_snapshot_ignores_later_writes(self):
+        kvs = self.make_engine()
+        kvs.update({"a": 1, "b": 2})
+        with kvs.snapshot() as snapshot:
+            kvs.put("a", 10)
+            kvs.put("a", 11)
+            kvs.delete("b")
+            kvs.put("c", 3)
+            self.assertEqual(snapshot.get("a"), 1)
+            self.assertEqual(snapshot.get("b"), 2)
+            self.assertIsNone(snapshot.get("c"))
+            self.assertEqual(sorted(snapshot.items()), [("a", 1), ("b", 2)])
+            self.assertEqual(snapshot.size(), 2)
+        self.assertEqual(kvs.to_dict(), {"a": 11, "c": 3})
+
+    def test_nested_snapshots_and_gc(self):
+        kvs = self.make_engine()
+        kvs.put("a", 1)
+        first = kvs.snapshot()
+        kvs.put("a", 2)
+        second = kvs.snapshot()
+        kvs.put("a", 3)
+        self.assertEqual((first.get("a"), second.get("a")), (1, 2))
+        first.close()
+        self.assertEqual(second.get("a"), 2)
+        self.assertEqual(len(kvs.history["a"]), 1)
+        second.close()
+        self.assertEqual(kvs.history, {})
+
+    def test_no_history_without_readers(self):
+        kvs = self.make_engine()
+        for i in range(100):
+            kvs.put("a", i)
+        self.assertEqual(kvs.history, {})
+
+    def test_clear_under_snapshot(self):
+        kvs = self.make_engine()
+        kvs.update({"a": 1, "b": 2})
+        with kvs.snapshot() as snapshot:
+            kvs.clear()
+            self.assertEqual(snapshot.to_dict(), {"a": 1, "b": 2})
+        self.assertEqual(kvs.size(), 0)
+
+    def test_scan_while_writing(self):
+        kvs = self.make_engine()
+        kvs.update({f"k{i}": 0 for i in range(2000)})
+        stop = threading.Event()
+        def writer():
+            n = 1
+            while not stop.is_set():
+                for i in range(0, 2000, 7):
+                    kvs.put(f"k{i}", n)
+                kvs.put(f"new{n}", n)
+                n += 1
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for _ in range(20):
+                with kvs.snapshot() as snapshot:
+                    seen = snapshot.to_dict()
+                    self.assertEqual(len(seen), snapshot.size())
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_snapshot_of_lsm_streams(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        kvs = MVCCEngine(LSMEngine(tmp.name, memtable_limit=4, compaction_trigger=100))
+        self.addCleanup(kvs.close)
+        kvs.update({f"k{i}": i for i in range(10)})
+        with kvs.snapshot() as snapshot:
+            items = snapshot.items()
+            self.assertEqual(next(items), ("k0", 0))
+            # written while the scan is under way
+            kvs.delete("k5")
+            kvs.put("k6", "new")
+            kvs.put("k55", "new")
+            self.assertEqual(list(items), [ (f"k{i}", i) for i in range(1, 10) ])
+
+    def test_snapshot_doesnt_fault_in(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        base = TieredEngine(tmp.name, 700, memtable_limit=4, compaction_trigger=100)
+        kvs = MVCCEngine(base)
+        self.addCleanup(kvs.close)
+        kvs.update({f"k{i}": "v" * 10 for i in range(10)})
+        self.assertNotIn("k0", base.hot)
+        with kvs.snapshot() as snapshot:
+            kvs.delete("k0")
+            self.assertEqual(snapshot.get("k0"), "v" * 10)
+            self.assertEqual(snapshot.get("k1"), "v" * 10)
+        self.assertNotIn("k1", base.hot)
+        self.assertEqual(base.stats()["misses"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,57 +1,29 @@
-import hashlib
-from collections import namedtuple
-import uuid
-import math
+import socket
 import requests
 import unittest
 from unittest import mock
 import paxos
-from paxos import Proposer, Acceptor, MessageType
 from unittest.mock import patch, Mock
 
-def mocked_send_post(*args, **kwargs):
-    print(f"##### args = {args}")
-    class MockResponse:
-        def __init__(self, json_data, status_code):
-            self.json_data = json_data
-            self.status_code = status_code
-
-        def json(self):
-            return self.json_data
-
-    if args[0] == 'http://alice:8090/shardalloc':
-        return MockResponse(args[1], 200)
-    elif args[0] == 'http://someotherurl.com/anothertest.json':
-        return MockResponse({"key2": "value2"}, 200)
-
-    return MockResponse(None, 404)
-
 class TestPaxos(unittest.TestCase):
 
     def test_ping(self):
-        self.assertTrue(paxos.ping("google.com:80"))
+        # something listening locally, and the same port once it's closed
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            addr = f'127.0.0.1:{listener.getsockname()[1]}'
+            self.assertTrue(paxos.ping(addr))
+        self.assertFalse(paxos.ping(addr))
         # fails
-        self.assertFalse(paxos.ping("google.comm"))
-        self.assertFalse(paxos.ping("google.comm:80"))
-        self.assertFalse(paxos.ping("google.com:81"))
-
-    @mock.patch('paxos.ping')
-    @mock.patch('requests.post', side_effect=mocked_send_post)
-    def atest_send(self, ping_mock, send_mock):
-        ping_mock.return_value = True
-        results = []
-        paxos.send(results, 0, 'alice:8090', {"key1": "value1"})
-        self.assertEqual(ping_mock.call_count, 1)
-        ping_mock.assert_called_once()
-        self.assertIn(mock.call('http://alice:8090/shardalloc'), send_mock.call_args_list)
-
-        self.assertEqual(len(send_mock.call_args_list), 4)
-        print(results)
-
-    @patch('requests.post')
-    @patch('paxos.ping')
-    def test_send_success(self, mock_ping, mock_post):
-        mock_ping.return_value = True
+        self.assertFalse(paxos.ping("127.0.0.1"))
+        self.assertFalse(paxos.ping("127.0.0.1:port"))
+
+    # send() asks peers.py whether addr is up instead of pinging it
+    @patch('peers.post')
+    @patch('peers.is_up')
+    def test_send_success(self, mock_is_up, mock_post):
+        mock_is_up.return_value = True
         mock_response = Mock()
         mock_response.status_code = 200
         mock_post.return_value = mock_response
@@ -65,25 +37,26 @@ class TestPaxos(unittest.TestCase):
         self.assertEqual(results[addr], mock_response)
         
         # We can even assert that our mocked method was called with the right parameters
-        mock_post.assert_called_once_with(f'http://{addr}/shardalloc', json=payload, headers={'Content-type': 'application/json'}, timeout=5)
+        mock_is_up.assert_called_once_with(addr)
+        mock_post.assert_called_once_with(f'http://{addr}/shard-alloc', json=payload, timeout=1)
         # same as calling
-        self.assertIn(mock.call(f'http://{addr}/shardalloc', json=payload, headers={'Content-type': 'application/json'}, timeout=5), mock_post.call_args_list)
+        self.assertIn(mock.call(f'http://{addr}/shard-alloc', json=payload, timeout=1), mock_post.call_args_list)
         # can even check to different parameters that were used in the mock_post
         # As specified in requests.post() function signature,
         # *args (args_list) contain only f'http://{addr}/shardalloc'
         # you can see args in mock_post.call_args.args
         print(f"##### args = {mock_post.call_args.args}")
         self.assertEqual(len(mock_post.call_args.args), 1)
-        # **kwargs (keyword args, expanded out), thus kwargs_list, has 3: json=, headers=, and timeout=
+        # **kwargs (keyword args, expanded out), thus kwargs_list, has 2: json= and timeout=
         # you can see kwargs in mock_post.call_args.kwargs
         print(f"##### kwargs = {mock_post.call_args.kwargs}")
-        self.assertEqual(len(mock_post.call_args.kwargs), 3)
-        
-    @patch('requests.post')
-    @patch('paxos.ping')
-    def test_send_failure(self, mock_ping, mock_post):
-        mock_ping.return_value = False
-        
+        self.assertEqual(len(mock_post.call_args.kwargs), 2)
+
+    @patch('peers.post')
+    @patch('peers.is_up')
+    def test_send_failure(self, mock_is_up, mock_post):
+        mock_is_up.return_value = False
+
         results = {}
         addr = 'localhost'
         payload = {'key': 'value'}
@@ -91,8 +64,18 @@ class TestPaxos(unittest.TestCase):
         paxos.send(results, addr, payload)
         
         self.assertIsNone(results[addr])
+        mock_is_up.assert_called_once_with(addr)
         mock_post.assert_not_called()
 
+    @patch('peers.post')
+    @patch('peers.is_up')
+    def test_send_timeout(self, mock_is_up, mock_post):
+        mock_is_up.return_value = True
+        mock_post.side_effect = requests.exceptions.ReadTimeout()
+        results = {}
+        paxos.send(results, 'localhost', {})
+        self.assertEqual(results['localhost'], "timed out")
+
 
 
 if __name__ == '__main__':
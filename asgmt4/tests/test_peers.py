@@ -0,0 +1,120 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import requests
+from peers import PeerPool, PeerHealth
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_GET(self):
+        # one entry per TCP connection the server accepted
+        Handler.connections.add(self.client_address)
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPeerPool(unittest.TestCase):
+    def setUp(self):
+        Handler.connections = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.addr = f'127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pool = PeerPool(pool_size=2, idle_timeout=60)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        for _ in range(20):
+            res = self.pool.request('GET', f'http://{self.addr}/kvs/a', timeout=1)
+            self.assertEqual(res.json(), {"ok": True})
+        self.assertEqual(len(Handler.connections), 1)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_idle_sessions_are_closed(self):
+        self.pool.last_sweep = 1000.0
+        with mock.patch('peers.time.monotonic', return_value=1000.0):
+            session = self.pool.session(self.addr)
+        with mock.patch.object(session, 'close') as close, \
+             mock.patch('peers.time.monotonic', return_value=1100.0):
+            self.pool.session('10.10.0.9:8090')
+        close.assert_called_once()
+        self.assertEqual(list(self.pool.sessions), ['10.10.0.9:8090'])
+
+    def test_sessions_in_use_are_kept(self):
+        # a streamed answer still being read, e.g. a fetchAll
+        with mock.patch('peers.time.monotonic', return_value=1000.0):
+            res = self.pool.request('GET', f'http://{self.addr}/kvs/a', stream=True, timeout=1)
+        self.pool.last_sweep = 1000.0
+        with mock.patch('peers.time.monotonic', return_value=1100.0):
+            self.pool.session('10.10.0.9:8090')
+        self.assertIn(self.addr, self.pool.sessions)
+        self.assertEqual(res.json(), {"ok": True})
+
+        # idle from the moment the answer is closed
+        with mock.patch('peers.time.monotonic', return_value=1100.0):
+            res.close()
+        res.close()
+        self.assertEqual(self.pool.in_use, {})
+        with mock.patch('peers.time.monotonic', return_value=1200.0):
+            self.pool.session('10.10.0.9:8090')
+        self.assertNotIn(self.addr, self.pool.sessions)
+
+class TestPeerHealth(unittest.TestCase):
+    def test_failures_mark_down_and_probe_brings_back(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        addr = f'127.0.0.1:{server.server_address[1]}'
+        health = PeerHealth(failure_threshold=2, probe_interval=0.01)
+        recovered = []
+        health.on_recovery(recovered.append)
+        self.assertTrue(health.is_up(addr))
+        health.failure(addr)
+        self.assertTrue(health.is_up(addr))
+        health.failure(addr)
+        self.assertFalse(health.is_up(addr))
+        # the listening socket accepts connections, so the probe succeeds
+        for _ in range(200):
+            if health.is_up(addr):
+                break
+            threading.Event().wait(0.01)
+        server.server_close()
+        self.assertTrue(health.is_up(addr))
+        self.assertEqual(health.status(), {"down": [], "failures": {}})
+        self.assertEqual(recovered, [addr])
+
+    def test_stop_listening(self):
+        health = PeerHealth(probe_interval=60)
+        recovered = []
+        stop = health.on_recovery(recovered.append)
+        health.down.add('10.10.0.9:8090')
+        health.success('10.10.0.9:8090')
+        stop()
+        health.down.add('10.10.0.9:8090')
+        health.success('10.10.0.9:8090')
+        self.assertEqual(recovered, ['10.10.0.9:8090'])
+        self.assertEqual(health.listeners, [])
+
+    def test_pool_reports_outcomes(self):
+        health = PeerHealth(probe_interval=60)
+        pool = PeerPool(health=health)
+        # nothing listens on port 1
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            pool.request('GET', 'http://127.0.0.1:1/kvs/a', timeout=1)
+        self.assertFalse(health.is_up('127.0.0.1:1'))
+        health.forget('127.0.0.1:1')
+        self.assertTrue(health.is_up('127.0.0.1:1'))
+        pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import threading
+import unittest
+from unittest import mock
+import requests
+import server
+
+ME, P1, P2 = '10.10.0.2:8090', '10.10.0.3:8090', '10.10.0.4:8090'
+
+def ok():
+    return mock.Mock(status_code=200)
+
+class TestFanOutReplication(unittest.TestCase):
+    def setUp(self):
+        self.kserver = server.Server("test_replication")
+        patcher = mock.patch('server.SOCKET_ADDRESS', ME)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # a request per write and replica (see test_stream.py for streams)
+        patcher = mock.patch('server.REPLICATION_STREAM', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.kserver.kv_store
+        self.store.address = ME
+        self.store.local_causal_metadata = {ME: 0, P1: 0, P2: 0}
+        self.store.shard_members = {"s0": [ME, P1, P2]}
+        self.store.shard_id = "s0"
+        self.store.compactor_thread = mock.Mock()
+        self.client = self.kserver.app.test_client()
+        # P2 answers only once the test lets it
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.sent = []
+
+    def slow_p2(self, url, **kwargs):
+        self.sent.append(url)
+        if P2 in url:
+            self.release.wait(5)
+        return ok()
+
+    def test_quorum_does_not_wait_for_straggler(self):
+        with mock.patch('server.peers.put', side_effect=self.slow_p2):
+            res = self.client.put('/kvs/a', json={"value": 1, "acks": "quorum"})
+            self.assertEqual(res.status_code, 201)
+            self.assertFalse(self.release.is_set())
+            self.assertEqual(res.json["causal-metadata"][P1], 1)
+            self.release.set()
+        # the straggler still got the write
+        self.assertEqual(sorted(self.sent), [f'http://{P1}/kvs/a', f'http://{P2}/kvs/a'])
+
+    def test_all_waits_for_every_replica(self):
+        threading.Timer(0.2, self.release.set).start()
+        with mock.patch('server.peers.put', side_effect=self.slow_p2):
+            res = self.client.put('/kvs/a', json={"value": 1, "acks": "all"})
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(self.release.is_set())
+        self.assertEqual(res.json["causal-metadata"][P2], 1)
+
+    def test_failed_replica_is_retried(self):
+        attempts = []
+        done = threading.Event()
+        def flaky(url, **kwargs):
+            attempts.append(url)
+            if len(attempts) == 1:
+                raise requests.exceptions.ConnectionError()
+            done.set()
+            return ok()
+        self.store.shard_members = {"s0": [ME, P1]}
+        with mock.patch('server.REPLICATION_RETRY_MS', 10), \
+             mock.patch('server.peers.put', side_effect=flaky), \
+             mock.patch('server.peers.is_up', return_value=True):
+            res = self.client.put('/kvs/a', json={"value": 1, "acks": "one"})
+            self.assertEqual(res.status_code, 201)
+            self.assertTrue(done.wait(5))
+        self.assertEqual(attempts, [f'http://{P1}/kvs/a'] * 2)
+
+    def test_bad_ack_policy(self):
+        res = self.client.put('/kvs/a', json={"value": 1, "acks": "most"})
+        self.assertEqual(res.status_code, 400)
+        self.assertNotIn("a", self.store.kvs)
+
+if __name__ == '__main__':
+    unittest.main()
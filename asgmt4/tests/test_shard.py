@@ -2,6 +2,8 @@ import hashlib
 from collections import namedtuple
 import uuid
 import math
+import threading
+import time
 from server import Server
 import unittest
 
@@ -148,6 +150,53 @@ class TestShard(unittest.TestCase):
         s = set(l)
         self.assertEqual(len(s), len(l))
 
+
+class TestShardMap(unittest.TestCase):
+    def setUp(self):
+        self.kserver = Server("test_shard_map")
+        self.shard = self.kserver.shard
+        self.shard.notify = None
+        self.client = self.kserver.app.test_client()
+
+    def set_map(self, shards):
+        self.shard.shard_members = shards
+        self.shard._map_changed()
+
+    def test_etag(self):
+        res = self.client.get('/shard/map')
+        self.assertEqual(res.json, {"shard-ids": [], "shards": {}})
+        empty = res.headers["ETag"]
+
+        self.set_map({"alligator": ["a:1", "b:1"], "buffalo": ["c:1", "d:1"]})
+        res = self.client.get('/shard/map', headers={"If-None-Match": empty})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json["shard-ids"], ["alligator", "buffalo"])
+        etag = res.headers["ETag"]
+        self.assertNotEqual(etag, empty)
+
+        res = self.client.get('/shard/map', headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+        # the same map again is no change
+        self.set_map({"alligator": ["a:1", "b:1"], "buffalo": ["c:1", "d:1"]})
+        self.assertEqual(self.client.get('/shard/map').headers["ETag"], etag)
+        # the hash order of the shards is part of the map
+        self.set_map({"buffalo": ["c:1", "d:1"], "alligator": ["a:1", "b:1"]})
+        self.assertNotEqual(self.client.get('/shard/map').headers["ETag"], etag)
+
+    def test_long_poll(self):
+        etag = self.client.get('/shard/map').headers["ETag"]
+        start = time.monotonic()
+        res = self.client.get('/shard/map?wait=0.2', headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+        threading.Timer(0.1, self.set_map, [{"alligator": ["a:1", "b:1"]}]).start()
+        res = self.client.get('/shard/map?wait=5', headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json["shards"], {"alligator": ["a:1", "b:1"]})
+        self.assertLess(time.monotonic() - start, 5)
+
 if __name__ == '__main__':
     try:
         unittest.main(verbosity=0)
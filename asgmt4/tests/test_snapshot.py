@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from snapshot import Snapshot, SnapshotEngine, write_snapshot
+from storage import DictEngine
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.snap')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        data = {"b": 2, "a": {"nested": [1, 2]}, "ü": "x", "z": None}
+        n = write_snapshot(self.path, data.items(), {"causal_metadata": {"alice": 4}})
+        self.assertEqual(n, 4)
+
+        snap = Snapshot(self.path)
+        self.assertEqual(len(snap), 4)
+        self.assertEqual(snap.meta, {"causal_metadata": {"alice": 4}})
+        for key, value in data.items():
+            self.assertEqual(snap.get(key, "missing"), value)
+        self.assertEqual(snap.get("c", "missing"), "missing")
+        self.assertEqual([k for k, _ in snap.items()], sorted(data))
+        snap.close()
+
+    def test_empty(self):
+        write_snapshot(self.path, [])
+        snap = Snapshot(self.path)
+        self.assertEqual(len(snap), 0)
+        self.assertIsNone(snap.get("a"))
+        snap.close()
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'{"kvs": {}}' + b' ' * 20)
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+    def test_engine_overlay(self):
+        write_snapshot(self.path, {"a": 1, "b": 2, "c": 3}.items())
+        kvs = SnapshotEngine(Snapshot(self.path), DictEngine())
+        kvs.put("b", 20)
+        kvs.put("d", 4)
+        self.assertTrue(kvs.delete("c"))
+        self.assertFalse(kvs.delete("c"))
+        self.assertEqual(kvs.get("b"), 20)
+        self.assertIsNone(kvs.get("c"))
+        self.assertEqual(kvs.size(), 3)
+        self.assertEqual(list(kvs.items()), [("a", 1), ("b", 20), ("d", 4)])
+        kvs.put("c", 30)
+        self.assertEqual(kvs.get("c"), 30)
+        kvs.clear()
+        self.assertEqual(kvs.size(), 0)
+        self.assertEqual(list(kvs.items()), [])
+
+    def test_replicate_from_peer_snapshot(self):
+        import server
+        with mock.patch('server.SNAPSHOT_DIR', self.tmp.name):
+            donor = server.Server("donor")
+            donor.kv_store.load_all({"a": 1, "b": [2]})
+            body = donor.app.test_client().get('/kvs/snapshot').data
+
+            joiner = server.Server("joiner")
+            res = mock.MagicMock(status_code=200)
+            res.iter_content.return_value = [body[:7], body[7:]]
+            with mock.patch('server.peers.get', return_value=res):
+                self.assertTrue(joiner.kv_store.replicate_kvs("donor:8090"))
+            self.assertEqual(joiner.kv_store.kvs.to_dict(), {"a": 1, "b": [2]})
+            self.assertEqual(joiner.kv_store.size(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import tempfile
+import time
+import unittest
+from storage import LSMEngine, BloomFilter, open_engine
+
+class EngineContract:
+    ''' Checks every storage engine has to pass '''
+    def make_engine(self):
+        raise NotImplementedError
+
+    def test_put_get_delete(self):
+        kvs = self.make_engine()
+        kvs.put("a", 1)
+        kvs.put("b", {"x": [1, 2]})
+        self.assertEqual(kvs.get("a"), 1)
+        self.assertEqual(kvs.get("b"), {"x": [1, 2]})
+        self.assertIsNone(kvs.get("c"))
+        self.assertTrue(kvs.delete("a"))
+        self.assertFalse(kvs.delete("a"))
+        self.assertNotIn("a", kvs)
+        self.assertEqual(kvs.size(), 1)
+
+    def test_items_and_clear(self):
+        kvs = self.make_engine()
+        kvs.update({"b": 2, "a": 1, "c": 3})
+        self.assertEqual(sorted(kvs.items()), [("a", 1), ("b", 2), ("c", 3)])
+        self.assertEqual(kvs.to_dict(), {"a": 1, "b": 2, "c": 3})
+        kvs.clear()
+        self.assertEqual(kvs.size(), 0)
+        self.assertEqual(list(kvs.items()), [])
+
+    def test_none_value(self):
+        kvs = self.make_engine()
+        kvs.put("a", None)
+        self.assertIn("a", kvs)
+        self.assertEqual(kvs.size(), 1)
+
+
+class TestDictEngine(EngineContract, unittest.TestCase):
+    def make_engine(self):
+        return open_engine('dict')
+
+
+class TestLSMEngine(EngineContract, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.close()
+        self.tmp.cleanup()
+
+    def make_engine(self, **options):
+        options.setdefault("memtable_limit", 4)
+        options.setdefault("compaction_trigger", 100)
+        engine = LSMEngine(self.tmp.name, **options)
+        self.engines.append(engine)
+        return engine
+
+    def test_reads_through_segments(self):
+        kvs = self.make_engine()
+        for i in range(50):
+            kvs.put(f"key{i:03d}", i)
+        kvs.delete("key010")
+        kvs.flush()
+        self.assertGreater(len(kvs.segments), 1)
+        self.assertEqual(kvs.get("key000"), 0)
+        self.assertEqual(kvs.get("key049"), 49)
+        self.assertIsNone(kvs.get("key010"))
+        self.assertEqual(kvs.size(), 49)
+        self.assertEqual([k for k, _ in kvs.items()][:3], ["key000", "key001", "key002"])
+
+    def test_reopen_keeps_data(self):
+        kvs = self.make_engine()
+        for i in range(10):
+            kvs.put(str(i), i)
+        kvs.delete("3")
+        kvs.close()
+        self.engines.remove(kvs)
+
+        kvs = self.make_engine()
+        self.assertEqual(kvs.size(), 9)
+        self.assertEqual(kvs.get("9"), 9)
+        self.assertNotIn("3", kvs)
+
+    def test_background_compaction(self):
+        kvs = self.make_engine(memtable_limit=2, compaction_trigger=3)
+        for i in range(20):
+            kvs.put(str(i % 5), i)
+        kvs.delete("0")
+        kvs.flush()
+        deadline = time.time() + 5
+        while len(kvs.segments) >= 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertLess(len(kvs.segments), 3)
+        self.assertEqual(kvs.to_dict(), {"1": 16, "2": 17, "3": 18, "4": 19})
+        live = sorted(s.name for s in kvs.segments)
+        on_disk = sorted(f for f in os.listdir(self.tmp.name) if f.endswith('.sst'))
+        self.assertEqual(live, on_disk)
+
+    def test_size_of_keys_on_disk(self):
+        kvs = self.make_engine(compaction_trigger=2, tier_min_bytes=1)
+        kvs.put("k", 1)
+        kvs.flush()
+        # overwritten and deleted while the first copy is on disk
+        kvs.put("k", 2)
+        self.assertEqual(kvs.size(), 1)
+        kvs.delete("k")
+        kvs.flush()
+        # flush() wakes the compactor up itself
+        deadline = time.time() + 5
+        while len(kvs.segments) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(kvs.segments), 1)
+        self.assertEqual(kvs.size(), 0)
+        self.assertEqual(kvs.to_dict(), {})
+
+    def wait_for_segments(self, kvs, n):
+        with kvs.lock:
+            kvs.work.notify()
+        deadline = time.time() + 5
+        while len(kvs.segments) > n and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(kvs.segments), n)
+
+    def test_size_tiered_compaction(self):
+        kvs = self.make_engine(memtable_limit=100, tier_min_bytes=1)
+        for i in range(100):
+            kvs.put(f"key{i:03d}", i)
+        kvs.flush()
+        big = kvs.segments[0]
+        kvs.put("key000", "new")
+        kvs.flush()
+        kvs.delete("key001")
+        kvs.flush()
+        kvs.put("key002", "new")
+        kvs.flush()
+        self.assertEqual(kvs.size(), 99)
+
+        # the three small segments are a tier of their own
+        kvs.compaction_trigger = 3
+        self.wait_for_segments(kvs, 2)
+        self.assertIs(kvs.segments[-1], big)
+        # the tombstone still hides the old copy
+        self.assertIsNone(kvs.get("key001"))
+        self.assertEqual(kvs.get("key000"), "new")
+        self.assertEqual(len(kvs.to_dict()), 99)
+
+        kvs.compaction_trigger, kvs.tier_ratio = 2, 1000
+        self.wait_for_segments(kvs, 1)
+        self.assertEqual(kvs.size(), 99)
+        self.assertEqual(len(kvs.to_dict()), 99)
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f"key{i}")
+        for i in range(1000):
+            self.assertTrue(bloom.might_contain(f"key{i}"))
+        false_positives = sum(bloom.might_contain(f"other{i}") for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
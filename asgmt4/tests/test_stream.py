@@ -0,0 +1,252 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import server
+from stream import ReplicationStream, StreamReceiver
+
+ME, PEER = '10.10.0.2:8090', '10.10.0.3:8090'
+
+def entry(seq, key="a"):
+    return {"seq": seq, "method": "PUT", "key": key, "payload": {"value": seq}}
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestStreamReceiver(unittest.TestCase):
+    def setUp(self):
+        self.applied = []
+        self.ready = True
+        self.receiver = StreamReceiver(lambda source, e: self.ready and not self.applied.append(e["seq"]))
+
+    def test_in_order_once(self):
+        self.assertEqual(self.receiver.receive(ME, "x", [entry(1), entry(2)]), 2)
+        self.assertEqual(self.receiver.receive(ME, "x", [entry(2), entry(3)], floor=2), 3)
+        self.assertEqual(self.applied, [1, 2, 3])
+
+    def test_gap_is_held(self):
+        self.assertEqual(self.receiver.receive(ME, "x", [entry(1), entry(3), entry(4)]), 1)
+        self.assertEqual(self.applied, [1])
+        self.assertEqual(self.receiver.receive(ME, "x", [entry(2)], floor=2), 4)
+        self.assertEqual(self.applied, [1, 2, 3, 4])
+
+    def test_not_ready(self):
+        self.ready = False
+        self.assertEqual(self.receiver.receive(ME, "x", [entry(1)]), 0)
+        self.ready = True
+        self.assertEqual(self.receiver.receive(ME, "x", [entry(1)]), 1)
+
+    def test_restarted_sender_and_dropped_entries(self):
+        self.receiver.receive(ME, "x", [entry(1), entry(2)])
+        # new stream id: numbering starts over
+        self.assertEqual(self.receiver.receive(ME, "y", [entry(1)]), 1)
+        # the sender no longer has 2..4
+        self.assertEqual(self.receiver.receive(ME, "y", [entry(5)], floor=5), 5)
+        self.assertEqual(self.applied, [1, 2, 1, 5])
+
+
+class TestReplicationStream(unittest.TestCase):
+    def test_resends_only_the_gap(self):
+        applied = []
+        receiver = StreamReceiver(lambda source, e: not applied.append(e["seq"]))
+        messages = []
+        acked_entries = []
+        release = threading.Event()
+
+        def lossy(addr, message):
+            release.wait(5)
+            entries = message["entries"]
+            messages.append([ e["seq"] for e in entries ])
+            if len(messages) == 1:
+                entries = [ e for e in entries if e["seq"] != 2 ]
+            return receiver.receive(message["from"], message["stream"], entries, message["floor"])
+
+        stream = ReplicationStream(PEER, ME, "x", lossy, on_ack=acked_entries.extend, retry=0.01)
+        self.addCleanup(stream.close)
+        seqs = [ stream.append("PUT", "a", {"value": i}) for i in range(4) ]
+        done = threading.Event()
+        results = []
+        stream.when_acked(seqs[-1], lambda ok: (results.append(ok), done.set()))
+        release.set()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [True])
+        self.assertEqual(messages, [[1, 2, 3, 4], [2, 3, 4]])
+        self.assertEqual(applied, [1, 2, 3, 4])
+        self.assertEqual([ e["seq"] for e in acked_entries ], [1, 2, 3, 4])
+        self.assertEqual(stream.stats()["pending"], 0)
+
+    def test_retries_unreachable_replica(self):
+        calls = []
+        def flaky(addr, message):
+            calls.append(message["floor"])
+            if len(calls) < 3:
+                raise ConnectionError("refused")
+            return message["entries"][-1]["seq"]
+        stream = ReplicationStream(PEER, ME, "x", flaky, retry=0.01)
+        self.addCleanup(stream.close)
+        stream.append("PUT", "a", {})
+        self.assertTrue(wait_for(lambda: stream.stats()["acked"] == 1))
+        self.assertEqual(calls, [1, 1, 1])
+
+    def test_coalescing_window(self):
+        messages = []
+        def send(addr, message):
+            messages.append(message["entries"])
+            return message["entries"][-1]["seq"]
+        stream = ReplicationStream(PEER, ME, "x", send, coalesce=0.2)
+        self.addCleanup(stream.close)
+        results = []
+        for i in range(100):
+            seq = stream.append("PUT", f"k{i % 5}", {"value": i, "causal-metadata": {ME: i + 1}})
+            if i == 0:
+                stream.when_acked(seq, results.append)
+        self.assertTrue(wait_for(lambda: stream.stats()["acked"] == 100))
+        self.assertEqual(len(messages), 1)
+        writes = [ e for e in messages[0] if e["payload"] is not None ]
+        self.assertEqual([ (e["key"], e["payload"]["value"]) for e in writes ],
+                         [ (f"k{i % 5}", i) for i in range(95, 100) ])
+        # the metadata goes once, on the last write
+        self.assertEqual([ "causal-metadata" in e["payload"] for e in writes ], [False] * 4 + [True])
+        self.assertEqual(writes[-1]["payload"]["causal-metadata"], {ME: 100})
+        self.assertEqual(results, [True])
+        self.assertEqual(stream.stats()["coalesced"], 95)
+
+    def test_backlog_limit(self):
+        stream = ReplicationStream(PEER, ME, "x", mock.Mock(side_effect=ConnectionError()), retry=10, limit=2)
+        self.addCleanup(stream.close)
+        results = []
+        first = stream.append("PUT", "a", {})
+        stream.when_acked(first, results.append)
+        stream.append("PUT", "b", {})
+        stream.append("PUT", "c", {})
+        self.assertEqual(results, [False])
+        self.assertEqual(stream.stats()["dropped"], 1)
+
+
+class TestBacklogSpill(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'peer.backlog')
+        self.up = threading.Event()
+        self.applied = []
+        self.receiver = StreamReceiver(lambda source, e: not self.applied.append(e["key"]))
+
+    def send(self, addr, message):
+        if not self.up.is_set():
+            raise ConnectionError("down")
+        return self.receiver.receive(message["from"], message["stream"], message["entries"], message["floor"])
+
+    def test_replayed_in_order_when_back(self):
+        stream = ReplicationStream(PEER, ME, "x", self.send, retry=60, limit=4, spill=self.path)
+        self.addCleanup(stream.close)
+        for i in range(20):
+            stream.append("PUT", f"k{i}", {"value": i})
+        self.assertEqual(stream.stats()["spilled"], 16)
+        self.assertLess(os.path.getsize(self.path), 2000)
+        # back: replayed right away, not after the minute of back-off
+        self.up.set()
+        stream.wake()
+        self.assertTrue(wait_for(lambda: stream.stats()["acked"] == 20))
+        self.assertEqual(self.applied, [ f"k{i}" for i in range(20) ])
+        self.assertEqual(stream.stats()["spilled"], 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_new_run_starts_empty(self):
+        # a previous run's backlog belongs to a stream that is gone
+        with open(self.path, 'w') as f:
+            f.write('{"seq": 1, "method": "PUT", "key": "old", "payload": {}}\n')
+        stream = ReplicationStream(PEER, ME, "x", self.send, retry=60, limit=1, spill=self.path)
+        self.addCleanup(stream.close)
+        for i in range(3):
+            stream.append("PUT", f"k{i}", {"value": i})
+        self.up.set()
+        stream.wake()
+        self.assertTrue(wait_for(lambda: stream.stats()["acked"] == 3))
+        self.assertEqual(self.applied, ["k0", "k1", "k2"])
+
+    def test_full_spill_file(self):
+        stream = ReplicationStream(PEER, ME, "x", self.send, retry=0.01, limit=2, spill=self.path,
+                                   spill_max_bytes=200)
+        self.addCleanup(stream.close)
+        seqs = [ stream.append("PUT", f"k{i}", {"value": i}) for i in range(8) ]
+        results = []
+        stream.when_acked(seqs[-1], results.append)
+        self.assertEqual(results, [False])
+        self.up.set()
+        self.assertTrue(wait_for(lambda: stream.stats()["pending"] == 0 and stream.stats()["spilled"] == 0))
+        # what fit arrived in order, past the writes that didn't
+        lost = 8 - len(self.applied)
+        self.assertGreater(lost, 0)
+        self.assertEqual(stream.stats()["dropped"], lost)
+        self.assertEqual(self.applied, sorted(self.applied, key=lambda k: int(k[1:])))
+
+
+class TestStreamReplication(unittest.TestCase):
+    ''' A coordinator and its replica, the stream between them going
+        through the replica's /kvs/replicate route '''
+    def node(self, addr):
+        kserver = server.Server(f"test_stream_{addr}")
+        store = kserver.kv_store
+        store.address = addr
+        store.local_causal_metadata = {ME: 0, PEER: 0}
+        store.shard_members = {"s0": [ME, PEER]}
+        store.shard_id = "s0"
+        store.compactor_thread = mock.Mock()
+        self.addCleanup(kserver.close)
+        return kserver
+
+    def setUp(self):
+        self.coordinator = self.node(ME)
+        self.replica = self.node(PEER)
+        replica_client = self.replica.app.test_client()
+
+        def post(url, json=None, **kwargs):
+            self.assertEqual(url, f'http://{PEER}/kvs/replicate')
+            res = replica_client.post('/kvs/replicate', json=json)
+            return mock.Mock(status_code=res.status_code, json=res.get_json)
+
+        for target, value in (('server.SOCKET_ADDRESS', ME), ('server.REPLICATION_STREAM', True),
+                              ('server.peers.post', post), ('server.peers.is_up', lambda addr: True)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = self.coordinator.app.test_client()
+
+    def test_write_waits_for_the_replica(self):
+        res = self.client.put('/kvs/a', json={"value": 1, "acks": "all"})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json["causal-metadata"][PEER], 1)
+        self.assertIn("a", self.replica.kv_store.kvs)
+        res = self.client.delete('/kvs/a', json={"acks": "all"})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("a", self.replica.kv_store.kvs)
+
+    def test_writes_arrive_in_order(self):
+        for i in range(50):
+            self.client.put('/kvs/a', json={"value": i, "acks": "one"})
+        stream = self.coordinator.kv_store.streams[PEER]
+        self.assertTrue(wait_for(lambda: stream.stats()["acked"] == 50))
+        store = self.replica.kv_store
+        self.assertEqual(store.codec.decode(store.kvs.get("a")), 49)
+        self.assertEqual(store.receiver.status()[ME], {"applied": 50, "held": 0})
+
+    def test_close_stops_listening(self):
+        self.client.put('/kvs/a', json={"value": 1, "acks": "all"})
+        stream = self.coordinator.kv_store.streams[PEER]
+        listeners = len(server.peers.health.listeners)
+        self.coordinator.close()
+        self.assertEqual(len(server.peers.health.listeners), listeners - 1)
+        self.assertTrue(stream.closed)
+        self.assertEqual(self.coordinator.kv_store.streams, {})
+
+if __name__ == '__main__':
+    unittest.main()
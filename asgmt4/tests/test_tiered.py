@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from storage import open_engine
+from test_storage import EngineContract
+from tiered import TieredEngine, LFUPolicy, ENTRY_OVERHEAD
+
+# room for about three 10-character values
+BUDGET = 3 * (ENTRY_OVERHEAD + 16)
+
+class TestTieredEngine(EngineContract, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.close()
+        self.tmp.cleanup()
+
+    def make_engine(self, budget_bytes=BUDGET, policy="lru", directory=None, keep=False):
+        directory = directory or os.path.join(self.tmp.name, str(len(self.engines)))
+        engine = TieredEngine(directory, budget_bytes, policy, keep, memtable_limit=4, compaction_trigger=100)
+        self.engines.append(engine)
+        return engine
+
+    def test_spills_and_faults_back(self):
+        kvs = self.make_engine()
+        for i in range(10):
+            kvs.put(f"k{i}", "v" * 10)
+        self.assertLessEqual(kvs.hot_bytes, BUDGET)
+        self.assertEqual(len(kvs.hot), 3)
+        self.assertEqual(kvs.size(), 10)
+        self.assertEqual(kvs.to_dict(), {f"k{i}": "v" * 10 for i in range(10)})
+
+        self.assertEqual(kvs.get("k0"), "v" * 10)
+        self.assertIn("k0", kvs.hot)
+        self.assertEqual(kvs.get("k0"), "v" * 10)
+        stats = kvs.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["evictions"], 8)
+
+    def test_lru_keeps_recently_used(self):
+        kvs = self.make_engine()
+        kvs.update({"a": "v" * 10, "b": "v" * 10, "c": "v" * 10})
+        kvs.get("a")
+        kvs.put("d", "v" * 10)
+        self.assertEqual(set(kvs.hot), {"a", "c", "d"})
+
+    def test_lfu_keeps_frequently_used(self):
+        kvs = self.make_engine(policy="lfu")
+        kvs.update({"a": "v" * 10, "b": "v" * 10, "c": "v" * 10})
+        for _ in range(3):
+            kvs.get("b")
+        kvs.get("c")
+        kvs.put("d", "v" * 10)
+        self.assertEqual(set(kvs.hot), {"b", "c", "d"})
+
+    def test_delete_from_either_tier(self):
+        kvs = self.make_engine()
+        for i in range(6):
+            kvs.put(f"k{i}", "v" * 10)
+        self.assertTrue(kvs.delete("k0")) # on disk
+        self.assertTrue(kvs.delete("k5")) # in memory
+        self.assertNotIn("k0", kvs)
+        self.assertEqual(kvs.size(), 4)
+
+    def test_faulted_in_keys_keep_their_disk_copy(self):
+        kvs = self.make_engine()
+        for i in range(10):
+            kvs.put(f"k{i}", "v" * 10)
+        kvs.get("k0")
+        self.assertIn("k0", kvs.shadowed)
+        evictions = kvs.stats()["evictions"]
+        # k0 is clean: pushing it out again writes nothing
+        with mock.patch.object(kvs.cold, 'put', wraps=kvs.cold.put) as put:
+            for i in range(3):
+                kvs.get(f"k{i + 1}")
+            self.assertNotIn("k0", kvs.hot)
+            self.assertNotIn(mock.call("k0", "v" * 10), put.call_args_list)
+        self.assertGreater(kvs.stats()["evictions"], evictions)
+
+        kvs.get("k0")
+        kvs.put("k0", "new")
+        self.assertEqual(kvs.size(), 10)
+        items = list(kvs.items())
+        self.assertEqual(len(items), 10)
+        self.assertEqual(dict(items)["k0"], "new")
+        self.assertTrue(kvs.delete("k0"))
+        self.assertNotIn("k0", kvs)
+        self.assertEqual(kvs.size(), 9)
+
+    def test_items_streams_the_disk_tier(self):
+        kvs = self.make_engine()
+        for i in range(20):
+            kvs.put(f"k{i:02}", i)
+        kvs.cold.flush()
+        items = kvs.items()
+        # moving keys between the tiers after the call doesn't change what it yields
+        kvs.get("k00")
+        kvs.put("k19", "late")
+        self.assertEqual(list(items), [ (f"k{i:02}", i) for i in range(20) ])
+
+    def test_flush_makes_it_persistent(self):
+        directory = os.path.join(self.tmp.name, "p")
+        kvs = self.make_engine(directory=directory)
+        for i in range(10):
+            kvs.put(f"k{i}", i)
+        kvs.get("k0")
+        kvs.put("k1", "changed")
+        kvs.delete("k2")
+        kvs.close()
+        self.engines.remove(kvs)
+
+        kvs = self.make_engine(directory=directory, keep=True)
+        expected = { f"k{i}": i for i in range(10) if i != 2 }
+        expected["k1"] = "changed"
+        self.assertEqual(kvs.to_dict(), expected)
+        self.assertEqual(kvs.size(), 9)
+        kvs.close()
+        self.engines.remove(kvs)
+
+        self.assertEqual(self.make_engine(directory=directory).size(), 0)
+
+    def test_open_engine(self):
+        engine = open_engine('tiered', os.path.join(self.tmp.name, 'x'), policy="lfu")
+        self.engines.append(engine)
+        self.assertIsInstance(engine.policy, LFUPolicy)
+        with self.assertRaises(ValueError):
+            open_engine('tiered', os.path.join(self.tmp.name, 'y'), policy="fifo")
+
+if __name__ == '__main__':
+    unittest.main()
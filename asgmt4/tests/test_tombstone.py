@@ -0,0 +1,113 @@
+import unittest
+from unittest import mock
+import server
+from tombstone import TombstoneTable
+
+ME, PEER = '10.10.0.2:8090', '10.10.0.3:8090'
+
+class TestTombstoneTable(unittest.TestCase):
+    def test_newer_delete_wins(self):
+        table = TombstoneTable()
+        self.assertTrue(table.add("k", 2.0, {ME}))
+        self.assertFalse(table.add("k", 1.0))
+        self.assertEqual(table.version("k"), 2.0)
+        self.assertTrue(table.add("k", 3.0))
+        self.assertEqual(table.pending(ME), {"k": 3.0})
+
+    def test_compact_after_all_acks(self):
+        table = TombstoneTable()
+        table.add("a", 1.0, {ME})
+        table.add("b", 1.0, {ME})
+        table.ack("a", 1.0, PEER)
+        table.ack("b", 0.5, PEER) # ack of an older delete doesn't count
+        self.assertEqual(table.pending(PEER), {"b": 1.0})
+        self.assertEqual(table.compact([ME, PEER]), ["a"])
+        self.assertNotIn("a", table)
+        self.assertEqual(len(table), 1)
+        # nobody to have acked: nothing goes
+        self.assertEqual(table.compact([]), [])
+        self.assertEqual(len(table), 1)
+
+
+class TestReplicatedDeletes(unittest.TestCase):
+    def setUp(self):
+        self.kserver = server.Server("test_tombstone")
+        patcher = mock.patch('server.SOCKET_ADDRESS', ME)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.kserver.kv_store
+        self.store.address = ME
+        self.store.local_causal_metadata = {ME: 0, PEER: 0}
+        self.store.shard_members = {"s0": [ME]}
+        self.store.shard_id = "s0"
+        # the tests run the compactor by hand
+        self.store.compactor_thread = mock.Mock()
+        self.client = self.kserver.app.test_client()
+
+    def test_delete_leaves_tombstone(self):
+        self.client.put('/kvs/a', json={"value": 1})
+        res = self.client.delete('/kvs/a', json={})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("a", self.store.kvs)
+        self.assertIn("a", self.store.tombstones)
+        self.assertEqual(self.client.delete('/kvs/a', json={}).status_code, 404)
+        # writing it again clears the tombstone
+        self.assertEqual(self.client.put('/kvs/a', json={"value": 2}).status_code, 201)
+        self.assertNotIn("a", self.store.tombstones)
+
+    def test_client_version_ignored(self):
+        # only replicas send versions; a client's can't push the clock ahead
+        self.client.put('/kvs/a', json={"value": 1, "version": 1e18})
+        self.assertLess(self.store.versions["a"], 1e18)
+        self.assertEqual(self.client.put('/kvs/a', json={"value": 2}).status_code, 200)
+        self.assertEqual(self.store.kvs.get("a"), 2)
+        # nor bury a key that isn't there
+        res = self.client.delete('/kvs/b', json={"version": 1e18})
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn("b", self.store.tombstones)
+
+    def test_stale_bulk_load_skipped(self):
+        self.client.put('/kvs/a', json={"value": 1})
+        old_version = self.store.versions["a"]
+        self.client.delete('/kvs/a', json={})
+        self.store.load_all({"a": 1, "b": 2}, versions={"a": old_version})
+        self.assertNotIn("a", self.store.kvs)
+        self.assertEqual(self.store.kvs.get("b"), 2)
+
+        self.store.load_all({"a": 3}, versions={"a": self.store.tombstones.version("a") + 1})
+        self.assertEqual(self.store.kvs.get("a"), 3)
+
+    def test_resent_delete_does_not_remove_newer_write(self):
+        self.client.put('/kvs/a', json={"value": 1})
+        version = self.store.versions["a"]
+        res = self.client.post('/kvs/tombstones', json={"tombstones": {"a": version - 1, "b": 5.0},
+                                                        "socket_address": PEER})
+        self.assertEqual(sorted(res.json["acked"]), ["a", "b"])
+        self.assertEqual(self.store.kvs.get("a"), 1)
+        self.assertEqual(self.store.tombstones.version("b"), 5.0)
+
+    def test_compactor_resends_then_drops(self):
+        self.store.shard_members = {"s0": [ME, PEER]}
+        self.client.put('/kvs/a', json={"value": 1, "broadcast": False})
+        self.client.delete('/kvs/a', json={"broadcast": False, "socket_address": PEER,
+                                           "version": self.store._new_version()})
+        self.store.tombstones.add("b", 1.0, {ME})
+
+        res = mock.Mock(status_code=200)
+        res.json.return_value = {"acked": ["b"]}
+        with mock.patch('server.peers.post', return_value=res) as post:
+            dropped = self.store.compact_tombstones()
+        # "a" came from PEER, so only "b" had to be re-sent
+        self.assertEqual(post.call_args.kwargs["json"]["tombstones"], {"b": 1.0})
+        self.assertEqual(sorted(dropped), ["a", "b"])
+        self.assertEqual(len(self.store.tombstones), 0)
+
+    def test_compactor_waits_for_a_view(self):
+        self.store.tombstones.add("a", 1.0, {ME})
+        for members in ({}, {"s0": []}):
+            self.store.shard_members = members
+            self.assertEqual(self.store.compact_tombstones(), [])
+        self.assertIn("a", self.store.tombstones)
+
+if __name__ == '__main__':
+    unittest.main()
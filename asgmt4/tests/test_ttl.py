@@ -0,0 +1,115 @@
+import threading
+import time
+import unittest
+from unittest import mock
+import server
+from ttl import TimerWheel
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expires_on_deadline(self):
+        wheel = TimerWheel(tick=1, slots=4, levels=2, now=0)
+        wheel.schedule("a", 3)
+        wheel.schedule("b", 10)
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(wheel.advance(3), ["a"])
+        self.assertEqual(wheel.advance(9), [])
+        self.assertEqual(wheel.advance(10), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_beyond_horizon(self):
+        # 4 slots * 2 levels only spans 16 ticks
+        wheel = TimerWheel(tick=1, slots=4, levels=2, now=0)
+        wheel.schedule("far", 50)
+        self.assertEqual(wheel.advance(49), [])
+        self.assertEqual(wheel.advance(50), ["far"])
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel(tick=1, slots=8, levels=3, now=0)
+        for i in range(100):
+            wheel.schedule(f"k{i}", i + 1)
+        wheel.schedule("k0", 200)
+        wheel.cancel("k1")
+        expired = wheel.advance(100)
+        self.assertEqual(len(expired), 98)
+        self.assertNotIn("k0", expired)
+        self.assertNotIn("k1", expired)
+        self.assertEqual(wheel.deadline("k0"), 200)
+        self.assertTrue(wheel.is_expired("k0", 200))
+
+
+class TestKeyExpiry(unittest.TestCase):
+    def setUp(self):
+        self.kserver = server.Server("test_ttl")
+        patcher = mock.patch('server.SOCKET_ADDRESS', '10.10.0.2:8090')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.kserver.kv_store
+        self.store.address = '10.10.0.2:8090'
+        self.store.local_causal_metadata = {'10.10.0.2:8090': 0}
+        self.store.shard_members = {"s0": ['10.10.0.2:8090']}
+        self.store.shard_id = "s0"
+        # the test drives expire() itself instead of the background thread
+        self.store.expiry_thread = mock.Mock()
+        self.client = self.kserver.app.test_client()
+
+    def test_put_with_ttl(self):
+        now = time.time()
+        with mock.patch('server.time.time', return_value=now):
+            res = self.client.put('/kvs/a', json={"value": 1, "ttl": 5, "broadcast": False})
+            self.assertEqual(res.status_code, 201)
+            self.client.put('/kvs/b', json={"value": 2, "broadcast": False})
+        self.assertEqual(self.store.expiry.deadline("a"), now + 5)
+
+        with mock.patch('server.time.time', return_value=now + 6):
+            # expired keys are hidden even before the wheel gets to them
+            self.assertEqual(self.client.get('/kvs/a', json={}).status_code, 404)
+            self.assertEqual(self.client.get('/kvs').json["kvs"], {"b": 2})
+        self.assertEqual(self.store.expire(now + 6), ["a"])
+        self.assertNotIn("a", self.store.kvs)
+        self.assertEqual(self.client.get('/kvs/b', json={}).json["value"], 2)
+
+    def test_expiry_drops_version(self):
+        now = time.time()
+        with mock.patch('server.time.time', return_value=now):
+            self.client.put('/kvs/a', json={"value": 1, "ttl": 5, "broadcast": False, "version": now})
+        self.assertIn("a", self.store.versions)
+        self.store.expire(now + 6)
+        self.assertNotIn("a", self.store.versions)
+
+    def test_write_racing_expiry_survives(self):
+        now = time.time()
+        with mock.patch('server.time.time', return_value=now):
+            self.client.put('/kvs/a', json={"value": 1, "ttl": 5, "broadcast": False})
+        advance = self.store.expiry.advance
+        writer = threading.Thread(target=lambda: self.store._store("a", 2))
+
+        def advance_then_write(at):
+            # the deadline is gone; a write now must not be expired with it
+            expired = advance(at)
+            writer.start()
+            writer.join(0.2)
+            return expired
+
+        with mock.patch.object(self.store.expiry, 'advance', advance_then_write):
+            self.assertEqual(self.store.expire(now + 6), ["a"])
+        writer.join()
+        self.assertEqual(self.store.kvs.get("a"), 2)
+
+    def test_overwrite_clears_ttl(self):
+        self.client.put('/kvs/a', json={"value": 1, "ttl": 5, "broadcast": False})
+        self.client.put('/kvs/a', json={"value": 2, "broadcast": False})
+        self.assertIsNone(self.store.expiry.deadline("a"))
+
+    def test_client_deadline_ignored(self):
+        # clients give a ttl; only replicas pass on an absolute deadline
+        self.client.put('/kvs/a', json={"value": 1, "expires-at": 1})
+        self.assertIsNone(self.store.expiry.deadline("a"))
+        self.assertEqual(self.client.get('/kvs/a', json={}).json["value"], 1)
+
+    def test_invalid_ttl(self):
+        for ttl in (0, -1, "10", True):
+            res = self.client.put('/kvs/a', json={"value": 1, "ttl": ttl})
+            self.assertEqual(res.status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from wal import WriteAheadLog
+
+class TestWal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_replay_empty(self):
+        wal = WriteAheadLog(self.dir)
+        kvs, md = wal.replay()
+        self.assertEqual(kvs, {})
+        self.assertIsNone(md)
+        wal.close()
+
+    def test_replay_puts_and_deletes(self):
+        wal = WriteAheadLog(self.dir, group_commit_ms=0)
+        wal.replay()
+        wal.append([{"op": "PUT", "key": "a", "value": 1}])
+        wal.append([{"op": "PUT", "key": "b", "value": 2}])
+        wal.append([{"op": "DELETE", "key": "a", "value": None, "causal-metadata": {"alice": 3}}])
+        wal.close()
+
+        kvs, md = WriteAheadLog(self.dir).replay()
+        self.assertEqual(kvs, {"b": 2})
+        self.assertEqual(md, {"alice": 3})
+
+    def test_replay_versions_and_tombstones(self):
+        wal = WriteAheadLog(self.dir, group_commit_ms=0)
+        wal.replay()
+        wal.append([{"op": "PUT", "key": "a", "value": 1, "version": 1.0},
+                    {"op": "PUT", "key": "b", "value": 2, "version": 2.0},
+                    {"op": "DELETE", "key": "a", "value": None, "version": 3.0}])
+        wal.close()
+
+        versions, tombstones = {}, {}
+        kvs, _ = WriteAheadLog(self.dir).replay(None, None, versions, tombstones)
+        self.assertEqual(kvs, {"b": 2})
+        self.assertEqual(versions, {"b": 2.0})
+        self.assertEqual(tombstones, {"a": 3.0})
+
+    def test_torn_record_is_dropped(self):
+        wal = WriteAheadLog(self.dir, group_commit_ms=0)
+        wal.replay()
+        wal.append([{"op": "PUT", "key": "a", "value": 1}])
+        wal.close()
+        with open(os.path.join(self.dir, 'wal.log'), 'a') as f:
+            f.write('{"op": "PUT", "key": "b", "val')
+
+        wal = WriteAheadLog(self.dir, group_commit_ms=0)
+        kvs, _ = wal.replay()
+        self.assertEqual(kvs, {"a": 1})
+        # new records must not be glued onto the torn one
+        wal.append([{"op": "PUT", "key": "c", "value": 3}])
+        wal.close()
+        kvs, _ = WriteAheadLog(self.dir).replay()
+        self.assertEqual(kvs, {"a": 1, "c": 3})
+
+    def test_checkpoint_truncates_log(self):
+        wal = WriteAheadLog(self.dir, group_commit_ms=0, checkpoint_every=2)
+        wal.replay()
+        wal.append([{"op": "PUT", "key": "a", "value": 1}, {"op": "PUT", "key": "b", "value": 2}])
+        self.assertTrue(wal.needs_checkpoint())
+        wal.checkpoint({"a": 1, "b": 2}, {"alice": 2})
+        self.assertFalse(wal.needs_checkpoint())
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, 'wal.log')), 0)
+        wal.append([{"op": "DELETE", "key": "b", "value": None}])
+        wal.close()
+
+        kvs, md = WriteAheadLog(self.dir).replay()
+        self.assertEqual(kvs, {"a": 1})
+        self.assertEqual(md, {"alice": 2})
+
+    def test_group_commit_batches_fsyncs(self):
+        wal = WriteAheadLog(self.dir, group_commit_ms=50)
+        wal.replay()
+        with mock.patch('wal.os.fsync') as fsync:
+            writers = [ threading.Thread(target=wal.append, args=([{"op": "PUT", "key": str(i), "value": i}],))
+                        for i in range(20) ]
+            for t in writers:
+                t.start()
+            for t in writers:
+                t.join()
+            self.assertLess(fsync.call_count, 20)
+            self.assertEqual(wal.synced_seq, 20)
+        wal.close()
+
+    def test_failed_fsync_fails_the_writers(self):
+        wal = WriteAheadLog(self.dir, group_commit_ms=0)
+        wal.replay()
+        wal.append([{"op": "PUT", "key": "a", "value": 1}])
+        with mock.patch('wal.os.fsync', side_effect=OSError(5, "EIO")):
+            with self.assertRaises(OSError):
+                wal.append([{"op": "PUT", "key": "b", "value": 2}])
+        self.assertEqual(wal.synced_seq, 1)
+        # the log can't be trusted anymore, even once fsync works again
+        with self.assertRaises(OSError):
+            wal.append([{"op": "PUT", "key": "c", "value": 3}])
+        wal.checkpoint({"a": 1, "b": 2}, None)
+        wal.append([{"op": "PUT", "key": "c", "value": 3}])
+        wal.close()
+        kvs, _ = WriteAheadLog(self.dir).replay()
+        self.assertEqual(kvs, {"a": 1, "b": 2, "c": 3})
+
+    def test_kv_store_write_fails_without_fsync(self):
+        import server
+        address = '10.10.0.2:8090'
+        with mock.patch('server.WAL_DIR', self.dir):
+            kserver = server.Server("test_kv_store_write_fails_without_fsync")
+        with mock.patch('server.WAL_DIR', self.dir), mock.patch('server.SOCKET_ADDRESS', address):
+            store = kserver.kv_store
+            store.address = address
+            store.local_causal_metadata = {address: 0}
+            store.shard_members = {"s0": [address]}
+            store.shard_id = "s0"
+            client = kserver.app.test_client()
+            with mock.patch('wal.os.fsync', side_effect=OSError(5, "EIO")):
+                self.assertEqual(client.put('/kvs/a', json={"value": 1}).status_code, 503)
+            # the next write checkpoints a fresh log
+            self.assertEqual(client.put('/kvs/b', json={"value": 2}).status_code, 201)
+            store.wal.close()
+
+        with mock.patch('server.WAL_DIR', self.dir):
+            kserver = server.Server("test_kv_store_write_fails_without_fsync")
+            self.assertEqual(kserver.kv_store.kvs, {"a": 1, "b": 2})
+            kserver.kv_store.wal.close()
+
+    def test_kv_store_checkpoint_holds_writes(self):
+        import server
+        with mock.patch('server.WAL_DIR', self.dir):
+            kserver = server.Server("test_kv_store_checkpoint_holds_writes")
+        store = kserver.kv_store
+        blocked = []
+
+        def try_write():
+            free = store.write_lock.acquire(blocking=False)
+            if free:
+                store.write_lock.release()
+            blocked.append(not free)
+
+        def checkpoint(*args):
+            # a write from another thread while the log is cut
+            writer = threading.Thread(target=try_write)
+            writer.start()
+            writer.join()
+
+        with mock.patch.object(store.wal, 'checkpoint', side_effect=checkpoint):
+            store._checkpoint()
+        self.assertEqual(blocked, [True])
+        store.wal.close()
+
+    def test_kv_store_recovers_from_wal(self):
+        import server
+        with mock.patch('server.WAL_DIR', self.dir):
+            kserver = server.Server("test_kv_store_recovers_from_wal")
+            kserver.kv_store.load_all({"a": 1, "b": 2})
+            kserver.kv_store.wal.close()
+
+            kserver = server.Server("test_kv_store_recovers_from_wal")
+            self.assertEqual(kserver.kv_store.kvs, {"a": 1, "b": 2})
+            self.assertTrue(kserver.kv_store.recovered)
+            kserver.kv_store.wal.close()
+
+    def test_tiered_store_checkpoints_without_copying(self):
+        import server
+        spill = os.path.join(self.dir, 'spill')
+        with mock.patch('server.WAL_DIR', self.dir), mock.patch('server.STORAGE_ENGINE', 'tiered'), \
+             mock.patch('server.SPILL_DIR', spill), mock.patch('server.MEMORY_BUDGET_MB', 0.001), \
+             mock.patch('server.WAL_CHECKPOINT_EVERY', 10):
+            kserver = server.Server("test_tiered_store_checkpoints")
+            store = kserver.kv_store
+            for i in range(25):
+                store.load_all({f"k{i}": i})
+            store.load_all({"k3": "new"})
+            with open(os.path.join(self.dir, 'checkpoint.json')) as f:
+                self.assertIsNone(json.load(f)["kvs"])
+            # no close: the node dies with the log past the checkpoint
+            store.wal.close()
+
+            kserver = server.Server("test_tiered_store_checkpoints")
+            expected = { f"k{i}": i for i in range(25) }
+            expected["k3"] = "new"
+            self.assertEqual(kserver.kv_store.kvs.to_dict(), expected)
+            kserver.kv_store.wal.close()
+            kserver.kv_store.kvs.close()
+            store.kvs.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import threading
+import unittest
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+import wire
+from peers import PeerPool
+
+def echo_app():
+    app = Flask("test_wire")
+    wire.install(app)
+    app.seen = []
+
+    @app.put('/echo')
+    def echo():
+        app.seen.append(request.mimetype)
+        return jsonify({"got": request.json["value"], "ttl": request.json.get("ttl")})
+
+    return app
+
+
+@unittest.skipUnless(wire.ENABLED, "msgpack is not installed")
+class TestWire(unittest.TestCase):
+    def setUp(self):
+        self.app = echo_app()
+        self.client = self.app.test_client()
+
+    def test_clients_get_json(self):
+        res = self.client.put('/echo', json={"value": [1, "a"]})
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(res.json, {"got": [1, "a"], "ttl": None})
+
+    def test_peers_get_msgpack(self):
+        res = self.client.put('/echo', data=wire.encode({"value": {"x": 1.5}, "ttl": 3}),
+                              headers={"Content-Type": wire.MIMETYPE, "Accept": wire.ACCEPT})
+        self.assertEqual(res.mimetype, wire.MIMETYPE)
+        self.assertEqual(wire.decode(res.data), {"got": {"x": 1.5}, "ttl": 3})
+        self.assertEqual(res.get_json(), {"got": {"x": 1.5}, "ttl": 3})
+
+    def test_bad_body(self):
+        res = self.client.put('/echo', data=b'\xc1', headers={"Content-Type": wire.MIMETYPE})
+        self.assertEqual(res.status_code, 400)
+
+    def test_pool_switches_after_first_answer(self):
+        server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        url = f'http://127.0.0.1:{server.server_port}/echo'
+        pool = PeerPool()
+        self.addCleanup(pool.close)
+        for i in range(3):
+            res = pool.request('PUT', url, json={"value": i}, timeout=1)
+            self.assertEqual(res.json()["got"], i)
+        # JSON until the peer showed it speaks msgpack
+        self.assertEqual(self.app.seen, ['application/json', wire.MIMETYPE, wire.MIMETYPE])
+
+if __name__ == '__main__':
+    unittest.main()
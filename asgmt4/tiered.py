@@ -0,0 +1,280 @@
+import heapq
+import json
+import threading
+from collections import OrderedDict
+from storage import StorageEngine, LSMEngine, _MISSING
+
+'''
+Memory-capped storage engine (STORAGE_ENGINE=tiered).
+
+Entries live in an in-memory hot tier until its estimated size goes over
+the budget. Then the policy picks cold entries, which are moved to an
+on-disk LSM tier (see storage.py). A GET for an evicted key is served from
+disk and brings the key back into memory, pushing something else out if
+needed.
+
+A key faulted back in keeps its copy on disk, so it can be dropped from
+memory again without a write as long as it isn't changed. flush() writes
+the changed hot entries to disk as well, after which the disk tier holds
+the whole store: the engine is persistent, and a WAL checkpoint only has
+to cut the log instead of copying the store (which wouldn't fit in memory).
+
+The size of an entry is estimated from its JSON encoding plus a fixed
+per-entry overhead, which is close enough to decide when to spill.
+
+With keep=False the disk tier is wiped on start-up: without a WAL to
+replay the writes since the last flush it could hold a mix of old and new
+state, so the store starts empty like the in-memory engines do.
+'''
+
+# dict slot, key/value objects and policy bookkeeping, roughly
+ENTRY_OVERHEAD = 200
+
+
+class LRUPolicy:
+    ''' Evict the entry that was used longest ago '''
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def add(self, key):
+        self.order[key] = None
+        self.order.move_to_end(key)
+
+    def touch(self, key):
+        self.order.move_to_end(key)
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+    def victim(self):
+        return next(iter(self.order))
+
+    def clear(self):
+        self.order.clear()
+
+
+class LFUPolicy:
+    ''' Evict the entry used the fewest times; the oldest one among equals.
+        All operations are O(1) (buckets of keys per use count). '''
+    def __init__(self):
+        self.counts = {}  # key -> uses
+        self.buckets = {} # uses -> keys with that count, in insertion order
+        self.min_count = 0
+
+    def add(self, key):
+        self.remove(key)
+        self.counts[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_count = 1
+
+    def touch(self, key):
+        count = self.counts[key]
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+        self.counts[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def remove(self, key):
+        count = self.counts.pop(key, None)
+        if count is None:
+            return
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+    def victim(self):
+        while self.min_count not in self.buckets:
+            # only happens after remove() emptied the lowest bucket
+            self.min_count = min(self.buckets)
+        return next(iter(self.buckets[self.min_count]))
+
+    def clear(self):
+        self.counts.clear()
+        self.buckets.clear()
+        self.min_count = 0
+
+
+POLICIES = {"lru": LRUPolicy, "lfu": LFUPolicy}
+
+
+def _merge_tiers(hot, cold):
+    ''' hot wins over an older copy of the same key on disk '''
+    hot = iter(hot)
+    entry = next(hot, None)
+    for key, value in cold:
+        while entry is not None and entry[0] < key:
+            yield entry
+            entry = next(hot, None)
+        if entry is not None and entry[0] == key:
+            continue
+        yield key, value
+    while entry is not None:
+        yield entry
+        entry = next(hot, None)
+
+
+def _entry_size(key, value):
+    return ENTRY_OVERHEAD + len(key) + len(json.dumps(value))
+
+
+class TieredEngine(StorageEngine):
+    persistent = True
+
+    def __init__(self, directory, budget_bytes=256 * 2**20, policy="lru", keep=False, **lsm_options):
+        '''
+            Parameters:
+            - directory: where the disk tier keeps its segments
+            - budget_bytes: estimated memory the hot tier may use
+            - policy: "lru" or "lfu"
+            - keep: start from what the disk tier holds instead of empty
+            - lsm_options: passed on to the LSMEngine of the disk tier
+        '''
+        if policy not in POLICIES:
+            raise ValueError(f"unknown eviction policy {policy}, expected one of {sorted(POLICIES)}")
+        self.budget = budget_bytes
+        self.policy_name = policy
+        self.policy = POLICIES[policy]()
+        self.lock = threading.RLock()
+        self.hot = {}
+        self.sizes = {} # key -> estimated size in the hot tier
+        self.hot_bytes = 0
+        self.shadowed = set() # hot keys that also have a copy on disk
+        self.dirty = set()    # hot keys whose value isn't the one on disk
+        self.cold = LSMEngine(directory, **lsm_options)
+        if not keep:
+            self.cold.clear()
+        self.hits = 0      # GETs answered from memory
+        self.misses = 0    # GETs that had to go to disk
+        self.evictions = 0 # entries moved to disk
+
+    def _admit(self, key, value):
+        ''' Put key in the hot tier (caller holds the lock and has made
+            sure the key is not on disk) '''
+        size = _entry_size(key, value)
+        if key in self.hot:
+            self.hot_bytes -= self.sizes[key]
+            self.policy.touch(key)
+        else:
+            self.policy.add(key)
+        self.hot[key] = value
+        self.sizes[key] = size
+        self.hot_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.hot_bytes > self.budget and len(self.hot) > 1:
+            key = self.policy.victim()
+            self.policy.remove(key)
+            self.hot_bytes -= self.sizes.pop(key)
+            value = self.hot.pop(key)
+            if key in self.dirty:
+                self.cold.put(key, value)
+            # else the disk has it already
+            self.dirty.discard(key)
+            self.shadowed.discard(key)
+            self.evictions += 1
+
+    def put(self, key, value):
+        with self.lock:
+            if key not in self.hot:
+                self.cold.delete(key)
+            self.dirty.add(key)
+            self._admit(key, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.hot.get(key, _MISSING)
+            if value is not _MISSING:
+                self.hits += 1
+                self.policy.touch(key)
+                return value
+            value = self.cold.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self.misses += 1
+            self.shadowed.add(key)
+            self._admit(key, value)
+            return value
+
+    def peek(self, key, default=None):
+        # neither counts nor faults in
+        with self.lock:
+            value = self.hot.get(key, _MISSING)
+            if value is _MISSING:
+                value = self.cold.get(key, _MISSING)
+            return default if value is _MISSING else value
+
+    def __contains__(self, key):
+        # a membership test is not a use either
+        return self.peek(key, _MISSING) is not _MISSING
+
+    def delete(self, key) -> bool:
+        with self.lock:
+            if key in self.hot:
+                del self.hot[key]
+                self.hot_bytes -= self.sizes.pop(key)
+                self.policy.remove(key)
+                self.dirty.discard(key)
+                if key in self.shadowed:
+                    self.shadowed.discard(key)
+                    self.cold.delete(key)
+                return True
+            return self.cold.delete(key)
+
+    def items(self):
+        ''' Both tiers merged as they are read; only the hot tier (which is
+            in memory anyway) is copied, the disk tier is streamed '''
+        with self.lock:
+            hot = sorted(self.hot.items(), key=lambda kv: kv[0])
+            # taken under the same lock, so no key moves between the tiers
+            # in between and gets missed
+            cold = self.cold.items()
+        return _merge_tiers(hot, cold)
+
+    def size(self) -> int:
+        with self.lock:
+            return len(self.hot) + self.cold.size() - len(self.shadowed)
+
+    def clear(self):
+        with self.lock:
+            self.hot.clear()
+            self.sizes.clear()
+            self.hot_bytes = 0
+            self.shadowed.clear()
+            self.dirty.clear()
+            self.policy.clear()
+            self.cold.clear()
+
+    def flush(self):
+        ''' Write the changed hot entries to the disk tier and make it
+            durable; they stay in memory too '''
+        with self.lock:
+            for key in self.dirty:
+                self.cold.put(key, self.hot[key])
+            self.shadowed |= self.dirty
+            self.dirty.clear()
+            self.cold.flush()
+
+    def close(self):
+        self.flush()
+        self.cold.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "policy": self.policy_name,
+                "budget-bytes": self.budget,
+                "hot-bytes": self.hot_bytes,
+                "hot-keys": len(self.hot),
+                "cold-keys": self.cold.size(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit-ratio": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,88 @@
+import threading
+
+'''
+Tombstones for replicated deletes.
+
+A delete leaves key -> version behind instead of just dropping the key, so
+a late or replayed copy of the value (a bulk load, a snapshot from a peer
+that missed the delete) can be recognised as older and ignored. Each
+tombstone remembers which shard members are known to have applied it; the
+compactor in KV_Store re-sends it to the others in batches and drops it
+once all of them have.
+
+Versions are coordinator timestamps (see KV_Store._new_version): a write
+with a higher version than the tombstone is newer than the delete.
+'''
+
+class TombstoneTable:
+    def __init__(self, versions: dict = None):
+        self.lock = threading.Lock()
+        self.versions = dict(versions or {}) # key -> version of the delete
+        self.acked = { key: set() for key in self.versions } # key -> members that applied it
+
+    def add(self, key, version, acked=()) -> bool:
+        ''' Record a delete.
+            Return:
+            - False if we already have this delete or a newer one
+        '''
+        with self.lock:
+            current = self.versions.get(key)
+            if current is not None and current >= version:
+                if current == version:
+                    self.acked[key].update(acked)
+                return False
+            self.versions[key] = version
+            self.acked[key] = set(acked)
+            return True
+
+    def ack(self, key, version, addr):
+        with self.lock:
+            if self.versions.get(key) == version:
+                self.acked[key].add(addr)
+
+    def discard(self, key):
+        with self.lock:
+            self.versions.pop(key, None)
+            self.acked.pop(key, None)
+
+    def version(self, key):
+        return self.versions.get(key)
+
+    def pending(self, addr, limit=None) -> dict:
+        ''' Return: key -> version of the deletes addr hasn't acknowledged '''
+        batch = {}
+        with self.lock:
+            for key, acked in self.acked.items():
+                if addr not in acked:
+                    batch[key] = self.versions[key]
+                    if limit is not None and len(batch) >= limit:
+                        break
+        return batch
+
+    def compact(self, members, keep=None) -> list:
+        ''' Drop tombstones every member has acknowledged, and those `keep`
+            rejects (e.g. keys that moved to another shard). Without any
+            members nobody can have acknowledged anything: nothing is dropped.
+            Return:
+            - the keys that were dropped
+        '''
+        members = set(members)
+        if not members:
+            return []
+        with self.lock:
+            dropped = [ key for key, acked in self.acked.items()
+                        if members <= acked or (keep is not None and not keep(key)) ]
+            for key in dropped:
+                del self.versions[key]
+                del self.acked[key]
+        return dropped
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return dict(self.versions)
+
+    def __contains__(self, key):
+        return key in self.versions
+
+    def __len__(self):
+        return len(self.versions)
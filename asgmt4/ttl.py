@@ -0,0 +1,113 @@
+import math
+import threading
+
+'''
+Hierarchical timer wheel for key expiry.
+
+Level 0 has one slot per tick, level 1 one slot per `slots` ticks, and so
+on. A key goes into the coarsest level its deadline needs; when the wheel
+below wraps around, the matching slot one level up is emptied and its keys
+are placed again, closer to their deadline. Scheduling, cancelling and
+advancing one tick are all O(1) no matter how many keys are tracked (the
+cascades amortise to O(1) per key).
+
+Deadlines are absolute wall-clock times (time.time()), so every replica
+that was given the same deadline expires the key on its own, without any
+message going over the network.
+'''
+
+class TimerWheel:
+    def __init__(self, tick=0.1, slots=64, levels=4, now=0.0):
+        '''
+            Parameters:
+            - tick: length of one level-0 slot, in seconds
+            - slots: slots per level
+            - levels: number of levels; the wheel spans tick * slots**levels
+              seconds, later deadlines are parked in the last level and
+              re-placed until they are in range
+            - now: current time, where the wheel starts
+        '''
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [ [set() for _ in range(slots)] for _ in range(levels) ]
+        self.deadlines = {} # key -> absolute expiry time
+        self.where = {}     # key -> (level, slot)
+        self.current = int(now / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, key, expires_at):
+        with self.lock:
+            self._cancel(key)
+            self.deadlines[key] = expires_at
+            due = max(int(math.ceil(expires_at / self.tick)), self.current + 1)
+            self._place(key, due)
+
+    def cancel(self, key):
+        with self.lock:
+            self._cancel(key)
+
+    def _cancel(self, key):
+        if key in self.where:
+            level, slot = self.where.pop(key)
+            self.wheels[level][slot].discard(key)
+        self.deadlines.pop(key, None)
+
+    def _place(self, key, due):
+        ''' Put key in the slot for tick `due` (due >= self.current) '''
+        horizon = self.current + self.slots ** self.levels - 1
+        due = min(due, horizon)
+        delta = due - self.current
+        level = 0
+        while level < self.levels - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+        slot = (due // self.slots ** level) % self.slots
+        self.wheels[level][slot].add(key)
+        self.where[key] = (level, slot)
+
+    def advance(self, now):
+        ''' Move the wheel up to `now`.
+            Return:
+            - keys whose deadline has passed; they are no longer tracked
+        '''
+        expired = []
+        target = int(now / self.tick)
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                self._cascade()
+                bucket = self.wheels[0][self.current % self.slots]
+                for key in list(bucket):
+                    bucket.discard(key)
+                    del self.where[key]
+                    if self.deadlines[key] <= now:
+                        expired.append(key)
+                        del self.deadlines[key]
+                    else:
+                        # parked beyond the horizon, still not due
+                        self._place(key, int(math.ceil(self.deadlines[key] / self.tick)))
+        return expired
+
+    def _cascade(self):
+        level = 1
+        while level < self.levels and self.current % self.slots ** level == 0:
+            slot = (self.current // self.slots ** level) % self.slots
+            bucket = self.wheels[level][slot]
+            self.wheels[level][slot] = set()
+            for key in bucket:
+                due = max(int(math.ceil(self.deadlines[key] / self.tick)), self.current)
+                self._place(key, due)
+            level += 1
+
+    def deadline(self, key):
+        return self.deadlines.get(key)
+
+    def is_expired(self, key, now):
+        ''' Checked on reads so a key is gone the moment its deadline passes,
+            even if the background tick hasn't got to it yet
+        '''
+        deadline = self.deadlines.get(key)
+        return deadline is not None and deadline <= now
+
+    def __len__(self):
+        return len(self.deadlines)
@@ -0,0 +1,235 @@
+import os
+import json
+import logging
+import threading
+import time
+
+'''
+Append-only write-ahead log for the KV store.
+
+Every mutation is written as one JSON line to <directory>/wal.log. Writers
+do not fsync on their own: a background flusher collects everything that was
+appended during a small window (group commit) and syncs it with a single
+fsync, then wakes all writers of that batch up at once.
+
+A checkpoint is a full copy of the store in <directory>/checkpoint.json.
+Taking one truncates the log, so recovery is "load the checkpoint, then
+replay whatever is left in the log".
+
+A failed fsync may have lost anything written since the last good one, so
+it fails the writers of its batch and every append after it, until a
+checkpoint starts a fresh log.
+'''
+
+LOG_FILE = 'wal.log'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+class WriteAheadLog:
+    def __init__(self, directory, group_commit_ms=5, checkpoint_every=10000):
+        '''
+            Parameters:
+            - directory: where the log and the checkpoint live
+            - group_commit_ms: how long the flusher waits to gather a batch
+              before syncing it (0 syncs as soon as the previous sync is done)
+            - checkpoint_every: number of logged records after which
+              needs_checkpoint() starts returning True
+        '''
+        self.directory = directory
+        self.log_path = os.path.join(directory, LOG_FILE)
+        self.checkpoint_path = os.path.join(directory, CHECKPOINT_FILE)
+        self.window = max(group_commit_ms, 0) / 1000.0
+        self.checkpoint_every = checkpoint_every
+
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.pending = threading.Event()
+        self.written_seq = 0 # last record handed to the file
+        self.synced_seq = 0  # last record known to be on disk
+        self.records = 0     # records since the last checkpoint
+        self.error = None    # a failed fsync, until the next checkpoint
+        self.file = None
+        self.flusher = None
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+
+    def replay(self, kvs=None, expiries=None, versions=None, tombstones=None):
+        ''' Rebuild the store from the checkpoint and the log, then open the
+            log for appending.
+
+            A torn record at the end of the log (crash in the middle of a
+            write) is dropped and cut off the file so new records don't get
+            glued onto it.
+
+            Parameters:
+            - kvs: mapping to replay into (a plain dict if not given)
+            - expiries: if given, filled with key -> expiry time of keys
+              that were written with a TTL
+            - versions / tombstones: if given, filled with key -> version of
+              the last write / of the delete for deleted keys
+            Return:
+            - (kvs, causal_metadata); causal_metadata is None if nothing
+              was ever logged
+        '''
+        if kvs is None:
+            kvs = {}
+        if expiries is None:
+            expiries = {}
+        if versions is None:
+            versions = {}
+        if tombstones is None:
+            tombstones = {}
+        causal_metadata = None
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            # None means the storage engine keeps the data itself
+            if checkpoint["kvs"] is not None:
+                kvs.clear()
+                kvs.update(checkpoint["kvs"])
+            expiries.update(checkpoint.get("expires_at") or {})
+            versions.update(checkpoint.get("versions") or {})
+            tombstones.update(checkpoint.get("tombstones") or {})
+            causal_metadata = checkpoint["causal_metadata"]
+
+        good_offset = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"[wal] dropping torn record at offset {good_offset}")
+                        break
+                    self._apply(kvs, expiries, versions, tombstones, record)
+                    if record.get("causal-metadata") is not None:
+                        causal_metadata = record["causal-metadata"]
+                    good_offset += len(line)
+                    self.records += 1
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(good_offset)
+
+        logging.info(f"[wal] replayed {len(kvs)} keys ({self.records} log records) from {self.directory}")
+        self._open()
+        return kvs, causal_metadata
+
+    def _apply(self, kvs, expiries, versions, tombstones, record):
+        op = record["op"]
+        key = record["key"]
+        if op == "PUT":
+            kvs[key] = record["value"]
+            if record.get("expires-at") is not None:
+                expiries[key] = record["expires-at"]
+            else:
+                expiries.pop(key, None)
+            if record.get("version") is not None:
+                versions[key] = record["version"]
+            else:
+                versions.pop(key, None)
+            tombstones.pop(key, None)
+        elif op == "DELETE":
+            kvs.pop(key, None)
+            expiries.pop(key, None)
+            versions.pop(key, None)
+            if record.get("version") is not None:
+                tombstones[key] = record["version"]
+
+    def _open(self):
+        self.file = open(self.log_path, 'a', encoding='utf-8')
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def append(self, records: list, wait=True):
+        ''' Append records to the log.
+            Parameters:
+            - records: list of {"op": "PUT"|"DELETE", "key": ..., "value": ...,
+              "expires-at": ..., "version": ..., "causal-metadata": ...}
+            - wait: block until the records are on disk
+            Return:
+            - sequence number of the last record. If the log failed to
+              sync, the fsync's OSError is raised instead (see checkpoint())
+        '''
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            for record in records:
+                self.file.write(json.dumps(record) + '\n')
+            self.written_seq += len(records)
+            self.records += len(records)
+            seq = self.written_seq
+            self.pending.set()
+            if wait:
+                while self.synced_seq < seq and self.error is None and not self.closed:
+                    self.synced.wait()
+                if self.synced_seq < seq and self.error is not None:
+                    raise self.error
+        return seq
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.pending.wait()
+            if self.window:
+                time.sleep(self.window) # let the batch fill up
+            self.pending.clear()
+            self._sync()
+
+    def _sync(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            target = self.written_seq
+            fd = self.file.fileno()
+        # fsync outside the lock so writers can keep appending to the next batch
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            logging.warning(f"[wal] fsync failed: {e}")
+            with self.lock:
+                self.error = e
+                self.synced.notify_all()
+            return
+        with self.lock:
+            if self.error is None:
+                self.synced_seq = max(self.synced_seq, target)
+            self.synced.notify_all()
+
+    def needs_checkpoint(self):
+        return self.records >= self.checkpoint_every
+
+    def checkpoint(self, kvs: dict, causal_metadata: dict, expiries: dict = None,
+                   versions: dict = None, tombstones: dict = None):
+        ''' Write a full copy of the store and truncate the log.
+            The caller passes the state it wants persisted; records appended
+            afterwards land in the fresh log. kvs=None is for storage engines
+            that are durable on their own and only need the log cut.
+            This is also how the log recovers from a failed fsync.
+        '''
+        with self.lock:
+            tmp_path = self.checkpoint_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"kvs": kvs, "causal_metadata": causal_metadata, "expires_at": expiries,
+                           "versions": versions, "tombstones": tombstones}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.checkpoint_path)
+
+            self.file.close()
+            self.file = open(self.log_path, 'w', encoding='utf-8')
+            self.records = 0
+            self.error = None
+            # everything before the checkpoint is durable now
+            self.synced_seq = self.written_seq
+            self.synced.notify_all()
+        logging.info(f"[wal] checkpoint written to {self.checkpoint_path}")
+
+    def close(self):
+        self._sync()
+        with self.lock:
+            self.closed = True
+            self.synced.notify_all()
+            if self.file:
+                self.file.close()
+                self.file = None
+        self.pending.set()
@@ -0,0 +1,82 @@
+import os
+from flask import Request, Response, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest
+try:
+    import msgpack
+except ImportError: # nodes without it just keep talking JSON
+    msgpack = None
+
+'''
+Binary (msgpack) encoding of node-to-node messages.
+
+Peers ask for it, clients don't, so clients keep getting JSON:
+
+- every request a node sends to a peer (peers.py, aserver.py) says
+  "Accept: application/x-msgpack"; a node that can, answers in msgpack
+- once a peer has answered in msgpack, request bodies to it are msgpack
+  too; a peer that never does (an older node, one without msgpack, or
+  PEER_WIRE=json) only ever gets JSON
+
+On the Flask side install(app) makes this invisible to the routes:
+request.json / get_json() decode either encoding, jsonify() and dicts
+returned by routes come out in whatever the request accepts, and
+Response.get_json() reads both (for the few places that call our own
+routes' handlers and look at the result).
+'''
+
+MIMETYPE = 'application/x-msgpack'
+ENABLED = msgpack is not None and os.environ.get('PEER_WIRE', 'msgpack') == 'msgpack'
+
+# sent with every request to a peer
+ACCEPT = f'{MIMETYPE}, application/json' if ENABLED else 'application/json'
+
+
+def encode(value) -> bytes:
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def decode(data: bytes):
+    return msgpack.unpackb(data, raw=False)
+
+
+def is_wire(content_type) -> bool:
+    return bool(content_type) and content_type.split(';')[0].strip() == MIMETYPE
+
+
+class WireRequest(Request):
+    def get_json(self, force=False, silent=False, cache=True):
+        if not is_wire(self.mimetype):
+            return super().get_json(force=force, silent=silent, cache=cache)
+        if cache and hasattr(self, '_wire_body'):
+            return self._wire_body
+        try:
+            body = decode(self.get_data(cache=cache))
+        except Exception as e:
+            if silent:
+                return None
+            raise BadRequest(f"cannot decode {MIMETYPE} body: {e}")
+        if cache:
+            self._wire_body = body
+        return body
+
+
+class WireResponse(Response):
+    def get_json(self, force=False, silent=False):
+        if is_wire(self.mimetype):
+            return decode(self.get_data())
+        return super().get_json(force=force, silent=silent)
+
+
+class WireJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        if ENABLED and has_request_context() and MIMETYPE in request.headers.get('Accept', ''):
+            value = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(encode(value), mimetype=MIMETYPE)
+        return super().response(*args, **kwargs)
+
+
+def install(app):
+    app.request_class = WireRequest
+    app.response_class = WireResponse
+    app.json = WireJSONProvider(app)